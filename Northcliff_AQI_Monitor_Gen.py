@@ -2,41 +2,32 @@
 #Northcliff Environment Monitor
 # Requires Home Manager >=8.54 with Enviro Monitor timeout
 
-import paho.mqtt.client as mqtt
+import time
+startup_start_time = time.monotonic() # Start of the startup timeline
 import colorsys
 import math
 import json
-import requests
-import st7735 as ST7735
+import collections
+import statistics
 import os
-import time
+import asyncio
+import selectors
+import atexit
+import numpy as np
 from datetime import datetime, timedelta
-from fonts.ttf import RobotoMedium as UserFont
-import pytz
-from pytz import timezone
-from astral.geocoder import database, lookup, add_locations
-from astral.sun import sun
-try:
-    from smbus2 import SMBus
-except ImportError:
-    from smbus import SMBus
-
-try:
-    # Transitional fix for breaking change in LTR559
-    from ltr559 import LTR559
-    ltr559 = LTR559()
-except ImportError:
-    import ltr559
-from enviroplus import gas
-from bme280 import BME280
-from pms5003 import PMS5003, ReadTimeoutError, ChecksumMismatchError
 from subprocess import check_output
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
-try:
-    from smbus2 import SMBus
-except ImportError:
-    from smbus import SMBus
 import logging
+from Northcliff_Enviro_Monitor_Config_Watch import ConfigFileWatcher
+from Northcliff_Enviro_Monitor_Systemd import SystemdNotifier, Heartbeats
+from Northcliff_Enviro_Monitor_Storage import StorageWriter
+from Northcliff_Enviro_Monitor_Climate import BurstBME280
+from Northcliff_Enviro_Monitor_PMS5003 import (PMS5003Reader, AveragedPMValues, StreamingPMS5003, PMS5003DutyCycle,
+                                                PMS5003FrameStore)
+from Northcliff_Enviro_Monitor_I2C import I2CBusService, PolledProximity
+from Northcliff_Enviro_Monitor_Aggregation import IntervalAggregator
+from Northcliff_Enviro_Monitor_Gas import GasWarmUpDetector, GasBaselineTracker
+from Northcliff_Enviro_Monitor_Compensation import CompensationModels
 
 monitor_version = "7.2 - Gen"
 
@@ -57,31 +48,101 @@ logging.info("""Northcliff_Environment_Monitor.py - Pimoroni Enviro+ with noise
 #""")
 print(monitor_version)
 
-bus = SMBus(1)
-
-# Create a BME280 instance
-bme280 = BME280(i2c_dev=bus)
-
-# Create an LCD instance
-disp = ST7735.ST7735(
-    port=0,
-    cs=1,
-    dc=9,
-    backlight=12,
-    rotation=270,
-    spi_speed_hz=10000000
-)
-
-# Initialize display
-disp.begin()
-
-def retrieve_config():
+class StartupTimeline(object): # Records when each startup phase completes, so that the time to the first readings
+    # after a watchdog reboot or software update restart can be tracked. Uses the system's monotonic clock, even with
+    # a simulated clock, because it's measuring the real time that startup takes
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.phases = {} # Seconds from the start of the script until each phase completed
+
+    def mark(self, phase): # Only the first completion of a phase is recorded
+        if phase not in self.phases:
+            self.phases[phase] = round(time.monotonic() - self.start_time, 3)
+            print('Startup Timeline.', phase, 'after', self.phases[phase], 'seconds')
+
+startup_timeline = StartupTimeline(startup_start_time)
+startup_timeline.mark('Imports')
+
+class WallClock(object): # The clock used in normal operation
+    simulated = False
+    run_duration = None # Runs until stopped
+    def time(self):
+        return time.time()
+    def monotonic(self):
+        return time.monotonic()
+    def now(self, tz=None):
+        return datetime.now(tz=tz)
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class SimulatedClock(object): # Virtual clock that only moves forward when the monitor sleeps or waits for a
+    # scheduled duty, so that days of scheduling, calibration and forecast logic can be run in seconds
+    simulated = True
+    def __init__(self, start_time, run_duration):
+        self.start_time = start_time
+        self.elapsed_time = 0 # Kept separately from start_time so that small advances aren't lost to rounding
+        self.run_duration = run_duration
+    def time(self):
+        return self.start_time + self.elapsed_time
+    def monotonic(self):
+        return self.elapsed_time
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self.time(), tz=tz)
+    def sleep(self, seconds):
+        self.advance(seconds)
+    def advance(self, seconds):
+        if seconds > 0:
+            self.elapsed_time += seconds
+    def run_concurrently(self, function, *args): # Runs a blocking call and then winds the clock back, so that the
+        # caller can wait for the call's simulated duration without holding up other duties
+        call_start_time = self.elapsed_time
+        try:
+            result = function(*args)
+        finally:
+            call_duration = self.elapsed_time - call_start_time
+            self.elapsed_time = call_start_time
+        return result, call_duration
+
+class SimulatedSelector(selectors.DefaultSelector): # Jumps the simulated clock to the next scheduled duty instead
+    # of blocking until it's due
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+    def select(self, timeout=None):
+        if timeout is None or timeout <= 0:
+            return super().select(timeout)
+        ready = super().select(0) # Still handle any I/O or thread wake ups that are already waiting
+        if ready == []:
+            self.clock.advance(timeout)
+        return ready
+
+class SimulatedEventLoop(asyncio.SelectorEventLoop): # Event loop that schedules duties on the simulated clock
+    def __init__(self, clock):
+        super().__init__(SimulatedSelector(clock))
+        self.clock = clock
+    def time(self):
+        return self.clock.monotonic()
+
+class SimulatedEventLoopPolicy(asyncio.DefaultEventLoopPolicy): # Makes asyncio.run use the simulated event loop
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+    def new_event_loop(self):
+        return SimulatedEventLoop(self.clock)
+
+config_file = '<Your config.json file location>'
+
+def read_config_file():
     try:
-        with open('<Your config.json file location>', 'r') as f:
+        with open(config_file, 'r') as f:
             parsed_config_parameters = json.loads(f.read())
             print('Retrieved Config', parsed_config_parameters)
     except IOError:
         print('Config Retrieval Failed')
+        raise
+    return parsed_config_parameters
+
+def retrieve_config(parsed_config_parameters): # Validates the parsed config and applies the defaults of optional keys
     temp_offset = parsed_config_parameters['temp_offset']
     altitude = parsed_config_parameters['altitude']
     enable_display = parsed_config_parameters['enable_display'] # Enables the display and flags that the
@@ -170,6 +231,77 @@ def retrieve_config():
     time_zone = parsed_config_parameters['time_zone']
     custom_locations = parsed_config_parameters['custom_locations']
     serial_port = parsed_config_parameters['serial_port']
+    if 'simulated_clock' in parsed_config_parameters: # Runs the monitor on a simulated clock, with the format:
+        # {"Start": "YYYY-MM-DD HH:MM:SS", "Duration": seconds, "Display Interval": seconds}. All three are optional.
+        # Set to {} to use the normal clock
+        simulated_clock = parsed_config_parameters['simulated_clock']
+    else:
+        simulated_clock = {}
+    if 'hardware_backend' in parsed_config_parameters: # Can be "Enviro" or "Simulated"
+        hardware_backend = parsed_config_parameters['hardware_backend']
+    else:
+        hardware_backend = 'Enviro'
+    if 'simulated_hardware' in parsed_config_parameters: # Simulated hardware settings, with the format:
+        # {"Seed": number, "Latencies": {"BME280": seconds, ...}, "PMS5003 Error Rate": proportion}
+        simulated_hardware = parsed_config_parameters['simulated_hardware']
+    else:
+        simulated_hardware = {}
+    if 'sensor_trace' in parsed_config_parameters: # Records or replays the raw sensor readings, with the format:
+        # {"Mode": "Record", "File": path, "Audio": true/false} or {"Mode": "Replay", "File": path, "Speed": "1x"/"Max"}
+        # Set to {} to read the sensors normally
+        sensor_trace = parsed_config_parameters['sensor_trace']
+    else:
+        sensor_trace = {}
+    if 'enable_multi_process' in parsed_config_parameters: # Runs noise DSP and display rendering in their own
+        # processes
+        enable_multi_process = parsed_config_parameters['enable_multi_process']
+    else:
+        enable_multi_process = False
+    if 'adaptive_sampling' in parsed_config_parameters: # Stretches an outdoor unit's PM and climate read intervals
+        # while its readings are stable, with the format: {"Max PM Interval": seconds, "Max Climate Interval": seconds,
+        # "Window": readings, "Thresholds": {"P2.5": ug/m3, "Temp": degrees, "Bar": hPa}}. Set to {} to always read at
+        # full rate
+        adaptive_sampling = parsed_config_parameters['adaptive_sampling']
+    else:
+        adaptive_sampling = {}
+    if 'handover_socket' in parsed_config_parameters: # Unix socket path that's used to hand over the live state to a
+        # new software version without restarting. Set to "" to restart with systemctl instead
+        handover_socket = parsed_config_parameters['handover_socket']
+    else:
+        handover_socket = ''
+    if 'storage_staging' in parsed_config_parameters: # Stages the log file writes in tmpfs and flushes them
+        # together, with the format: {"Directory": tmpfs path, "Flush Interval": seconds}. A "Flush Interval" of 0,
+        # the default, writes straight through
+        storage_staging = parsed_config_parameters['storage_staging']
+    else:
+        storage_staging = {}
+    if 'pm_duty_cycle' in parsed_config_parameters: # Puts the PMS5003 to sleep between uploads and wakes it for a
+        # burst of passive mode reads ahead of each one, with the format: {"Spin Up": seconds, "Burst": frames}. Set
+        # to {} to run it continuously
+        pm_duty_cycle = parsed_config_parameters['pm_duty_cycle']
+    else:
+        pm_duty_cycle = {}
+    if 'i2c_poll_intervals' in parsed_config_parameters: # Seconds between the I2C bus service's polls, with the
+        # format: {"Proximity": seconds, "SGP30": seconds}. Both are optional
+        i2c_poll_intervals = parsed_config_parameters['i2c_poll_intervals']
+    else:
+        i2c_poll_intervals = {}
+    if 'gas_warm_up' in parsed_config_parameters: # Declares the gas sensors warm once their raw Rs drift has settled,
+        # with the format: {"Drift Threshold": percent per minute, "Window": seconds}. Both are optional
+        gas_warm_up = parsed_config_parameters['gas_warm_up']
+    else:
+        gas_warm_up = {}
+    if 'gas_baseline' in parsed_config_parameters: # Tracks each gas sensor's clean air Rs over a sliding window of
+        # days, with the format: {"Days": days, "Percentiles": {"Red": percentile, "Oxi": percentile, "NH3":
+        # percentile}, "Min Readings": readings}. All are optional
+        gas_baseline = parsed_config_parameters['gas_baseline']
+    else:
+        gas_baseline = {}
+    if 'compensation_models' in parsed_config_parameters: # Selects the temperature, humidity and gas compensation
+        # models, with the format: {"Variant": variant name, "File": coefficients file location}. Both are optional
+        compensation_models = parsed_config_parameters['compensation_models']
+    else:
+        compensation_models = {}
     return (temp_offset, altitude, enable_display, enable_adafruit_io, aio_user_name, aio_key, aio_feed_window,
             aio_feed_sequence, aio_household_prefix, aio_location_prefix, aio_package, enable_send_data_to_homemanager,
             enable_receive_data_from_homemanager, enable_indoor_outdoor_functionality,
@@ -178,9 +310,29 @@ def retrieve_config():
             enable_eco2_tvoc, gas_daily_r0_calibration_hour, reset_gas_sensor_calibration, incoming_temp_hum_mqtt_topic,
             incoming_temp_hum_mqtt_sensor_name, incoming_barometer_mqtt_topic, incoming_barometer_sensor_id,
             indoor_outdoor_function, mqtt_client_name, outdoor_mqtt_topic, indoor_mqtt_topic, city_name, time_zone,
-            custom_locations, serial_port)
+            custom_locations, serial_port, simulated_clock, hardware_backend, simulated_hardware, sensor_trace,
+            enable_multi_process, adaptive_sampling, handover_socket, storage_staging, pm_duty_cycle,
+            i2c_poll_intervals, gas_warm_up, gas_baseline, compensation_models)
+
+# The names of the config variables, in the order that retrieve_config returns them
+config_variable_names = ('temp_offset', 'altitude', 'enable_display', 'enable_adafruit_io', 'aio_user_name', 'aio_key',
+                         'aio_feed_window', 'aio_feed_sequence', 'aio_household_prefix', 'aio_location_prefix',
+                         'aio_package', 'enable_send_data_to_homemanager', 'enable_receive_data_from_homemanager',
+                         'enable_indoor_outdoor_functionality', 'mqtt_broker_name', 'mqtt_username', 'mqtt_password',
+                         'outdoor_source_type', 'outdoor_source_id', 'enable_noise', 'enable_luftdaten',
+                         'enable_luftdaten_noise', 'disable_luftdaten_sensor_upload', 'enable_climate_and_gas_logging',
+                         'enable_particle_sensor', 'enable_eco2_tvoc', 'gas_daily_r0_calibration_hour',
+                         'reset_gas_sensor_calibration', 'incoming_temp_hum_mqtt_topic',
+                         'incoming_temp_hum_mqtt_sensor_name', 'incoming_barometer_mqtt_topic',
+                         'incoming_barometer_sensor_id', 'indoor_outdoor_function', 'mqtt_client_name',
+                         'outdoor_mqtt_topic', 'indoor_mqtt_topic', 'city_name', 'time_zone', 'custom_locations',
+                         'serial_port', 'simulated_clock', 'hardware_backend', 'simulated_hardware', 'sensor_trace',
+                         'enable_multi_process', 'adaptive_sampling', 'handover_socket', 'storage_staging',
+                         'pm_duty_cycle', 'i2c_poll_intervals', 'gas_warm_up', 'gas_baseline',
+                         'compensation_models')
 
 # Config Setup
+parsed_config_values = retrieve_config(read_config_file())
 (temp_offset, altitude, enable_display, enable_adafruit_io, aio_user_name, aio_key, aio_feed_window, aio_feed_sequence,
   aio_household_prefix, aio_location_prefix, aio_package, enable_send_data_to_homemanager,
   enable_receive_data_from_homemanager, enable_indoor_outdoor_functionality, mqtt_broker_name,
@@ -188,184 +340,408 @@ def retrieve_config():
   enable_luftdaten_noise, disable_luftdaten_sensor_upload, enable_climate_and_gas_logging,  enable_particle_sensor, enable_eco2_tvoc,
   gas_daily_r0_calibration_hour, reset_gas_sensor_calibration, incoming_temp_hum_mqtt_topic, incoming_temp_hum_mqtt_sensor_name,
   incoming_barometer_mqtt_topic, incoming_barometer_sensor_id, indoor_outdoor_function, mqtt_client_name,
-  outdoor_mqtt_topic, indoor_mqtt_topic, city_name, time_zone, custom_locations, serial_port) = retrieve_config()
-
-# Add to city database
-db = database()
-add_locations(custom_locations, db)
-
-if enable_particle_sensor:
-    # Create a PMS5003 instance
-    pms5003 = PMS5003(device = serial_port)
-    time.sleep(1)
+  outdoor_mqtt_topic, indoor_mqtt_topic, city_name, time_zone, custom_locations, serial_port,
+  simulated_clock, hardware_backend, simulated_hardware, sensor_trace, enable_multi_process,
+  adaptive_sampling, handover_socket, storage_staging, pm_duty_cycle,
+  i2c_poll_intervals, gas_warm_up, gas_baseline, compensation_models) = parsed_config_values
+# The config as last parsed. Config reloads are compared with it rather than with the globals, because startup
+# overrides some of them, such as handover_socket with a simulated clock
+parsed_config = dict(zip(config_variable_names, parsed_config_values))
+startup_timeline.mark('Config')
+
+# Clock Setup
+if sensor_trace.get("Mode") == 'Replay' and sensor_trace.get("Speed") == 'Max':
+    # Replay as fast as possible by running the simulated clock from the trace's start time until it's exhausted.
+    # The "Start" and "Duration" of any simulated_clock setting are ignored
+    from Northcliff_Enviro_Monitor_Trace import read_trace_start_time
+    clock = SimulatedClock(read_trace_start_time(sensor_trace["File"]), None)
+    print('Replaying Sensor Trace at Maximum Speed. Start:', clock.now())
+    asyncio.set_event_loop_policy(SimulatedEventLoopPolicy(clock))
+elif simulated_clock != {}:
+    if "Start" in simulated_clock:
+        simulated_clock_start = datetime.strptime(simulated_clock["Start"], "%Y-%m-%d %H:%M:%S").timestamp()
+    else:
+        simulated_clock_start = time.time()
+    if "Duration" in simulated_clock:
+        simulated_clock_duration = simulated_clock["Duration"]
+    else:
+        simulated_clock_duration = 86400 # Default to simulating one day
+    print('Using Simulated Clock. Start:', datetime.fromtimestamp(simulated_clock_start),
+          'Duration:', simulated_clock_duration, 'seconds')
+    clock = SimulatedClock(simulated_clock_start, simulated_clock_duration)
+    asyncio.set_event_loop_policy(SimulatedEventLoopPolicy(clock))
+else:
+    clock = WallClock()
+
+# Feature Imports. Modules that are only needed by some features are only imported when those features are enabled
+requests_required = enable_luftdaten or enable_adafruit_io or (enable_indoor_outdoor_functionality and
+                                                              indoor_outdoor_function == 'Indoor' and
+                                                              (outdoor_source_type == 'Luftdaten' or
+                                                               outdoor_source_type == 'Adafruit IO'))
+if requests_required:
+    import requests
+if enable_send_data_to_homemanager or enable_receive_data_from_homemanager or (enable_indoor_outdoor_functionality and
+        outdoor_source_type == 'Enviro'):
+    import paho.mqtt.client as mqtt
+if enable_display: # The sun and moon positions are only needed for the icon weather display
+    import pytz
+    from astral.geocoder import database, lookup, add_locations
+    from astral.sun import sun
+    # Add to city database
+    db = database()
+    add_locations(custom_locations, db)
+startup_timeline.mark('Feature Imports')
 
 if enable_noise:
-    import sounddevice as sd
-    import numpy as np
+    if hardware_backend != 'Simulated' and sensor_trace.get("Mode") != 'Replay':
+        import sounddevice as sd
     from numpy import pi, log10
     from scipy.signal import zpk2tf, zpk2sos, freqs, sosfilt
     from waveform_analysis.weighting_filters._filter_design import _zpkbilinear
-               
-def read_pm_values(luft_values, mqtt_values, own_data, own_disp_values):
+    startup_timeline.mark('Noise Imports')
+
+# Process Handover. Takes over from a running monitor that's waiting to hand over to this software version. All the
+# slow imports have been done by now, so the running monitor only stops sampling while the hardware is set up again
+if handover_socket != '' and clock.simulated:
+    print('Process Handover is not available with a simulated clock')
+    handover_socket = ''
+systemd_notifier = SystemdNotifier()
+heartbeats = Heartbeats(clock) # Sensor, audio and upload heartbeats. The systemd watchdog is only kicked while they're
+# all alive
+handover_payload = None # The outgoing monitor's pickled live state. Unpickled once its classes have been defined
+handover_server = None # Listens for the incoming monitor when this monitor is handing over
+handover_start_time = 0
+handover_done = None
+if handover_socket != '':
+    import sys
+    import subprocess
+    import pickle
+    from Northcliff_Enviro_Monitor_Handover import request_handover, read_message, write_message, same_user
+    handover_payload = request_handover(handover_socket, monitor_version.encode())
+    if handover_payload is not None:
+        systemd_notifier.notify('MAINPID=' + str(os.getpid())) # systemd now supervises this process instead of the
+        # outgoing one
+        print('Taking Over From the Running Monitor.', len(handover_payload), 'bytes of live state received')
+        startup_timeline.mark('Handover')
+
+# Hardware Setup
+streaming_pms5003 = None # Only used with the Enviro+ board's PMS5003
+if hardware_backend == 'Simulated': # Use synthetic sensor models when there's no Enviro+ board
+    print('Using Simulated Hardware')
+    from Northcliff_Enviro_Monitor_Simulation import (SimulatedEnvironment, SimulatedBME280, SimulatedLTR559,
+                                                      SimulatedGas, SimulatedPMS5003, SimulatedST7735,
+                                                      ReadTimeoutError, ChecksumMismatchError)
+    simulated_environment = SimulatedEnvironment(clock, simulated_hardware)
+    bme280 = SimulatedBME280(simulated_environment)
+    ltr559 = SimulatedLTR559(simulated_environment)
+    gas = SimulatedGas(simulated_environment)
+    disp = SimulatedST7735(simulated_environment)
     if enable_particle_sensor:
-        try:
-            pm_values = pms5003.read()
-            #print('PM Values:', pm_values)
-            own_data["P2.5"][1] = pm_values.pm_ug_per_m3(2.5)
-            mqtt_values["P2.5"] = own_data["P2.5"][1]
-            own_disp_values["P2.5"] = own_disp_values["P2.5"][1:] + [[own_data["P2.5"][1], 1]]
-            luft_values["P2"] = str(mqtt_values["P2.5"])
-            own_data["P10"][1] = pm_values.pm_ug_per_m3(10)
-            mqtt_values["P10"] = own_data["P10"][1]
-            own_disp_values["P10"] = own_disp_values["P10"][1:] + [[own_data["P10"][1], 1]]
-            luft_values["P1"] = str(own_data["P10"][1])
-            own_data["P1"][1] = pm_values.pm_ug_per_m3(1.0)
-            mqtt_values["P1"] = own_data["P1"][1]
-            own_disp_values["P1"] = own_disp_values["P1"][1:] + [[own_data["P1"][1], 1]]
-        except (ReadTimeoutError, ChecksumMismatchError):
-            logging.info("Failed to read PMS5003")
-            display_error('Particle Sensor Error')
-            pms5003.reset()
-            pm_values = pms5003.read()
-            own_data["P2.5"][1] = pm_values.pm_ug_per_m3(2.5)
-            mqtt_values["P2.5"] = own_data["P2.5"][1]
-            own_disp_values["P2.5"] = own_disp_values["P2.5"][1:] + [[own_data["P2.5"][1], 1]]
-            luft_values["P2"] = str(mqtt_values["P2.5"])
-            own_data["P10"][1] = pm_values.pm_ug_per_m3(10)
-            mqtt_values["P10"] = own_data["P10"][1]
-            own_disp_values["P10"] = own_disp_values["P10"][1:] + [[own_data["P10"][1], 1]]
-            luft_values["P1"] = str(own_data["P10"][1])
-            own_data["P1"][1] = pm_values.pm_ug_per_m3(1.0)
-            mqtt_values["P1"] = own_data["P1"][1]
-            own_disp_values["P1"] = own_disp_values["P1"][1:] + [[own_data["P1"][1], 1]]
-    return(luft_values, mqtt_values, own_data, own_disp_values)
-
-def read_eco2_tvoc_values(mqtt_values, own_data, own_disp_values):
-    eco2, tvoc = sgp30.command('measure_air_quality')
+        pms5003 = SimulatedPMS5003(simulated_environment)
+else:
+    try:
+        from smbus2 import SMBus
+    except ImportError:
+        from smbus import SMBus
+    try:
+        # Transitional fix for breaking change in LTR559
+        from ltr559 import LTR559
+        ltr559 = LTR559()
+    except ImportError:
+        import ltr559
+    from enviroplus import gas
+    from bme280 import BME280
+    from pms5003 import PMS5003, PMS5003Data, ReadTimeoutError, ChecksumMismatchError
+    import st7735 as ST7735
+    bus = SMBus(1)
+    # Create a BME280 instance that reads all of its readings in one burst
+    bme280 = BurstBME280(BME280(i2c_dev=bus), clock)
+    # Create an LCD instance
+    disp = ST7735.ST7735(
+        port=0,
+        cs=1,
+        dc=9,
+        backlight=12,
+        rotation=270,
+        spi_speed_hz=10000000
+    )
+    if enable_particle_sensor:
+        # Create a PMS5003 instance. Its frames are parsed from bulk serial reads, so that a corrupted frame is
+        # skipped without resetting the sensor
+        streaming_pms5003 = StreamingPMS5003(PMS5003(device = serial_port), PMS5003Data, ReadTimeoutError)
+        pms5003 = streaming_pms5003
+
+# Sensor Trace Setup
+if sensor_trace.get("Mode") == 'Replay': # Replace the sensors with the readings from a recorded trace
+    from Northcliff_Enviro_Monitor_Trace import (TraceReader, ReplayBME280, ReplayLTR559, ReplayGas,
+                                                 ReplayPMS5003)
+    print('Replaying Sensor Trace', sensor_trace["File"])
+    trace_reader = TraceReader(sensor_trace["File"], clock)
+    bme280 = ReplayBME280(trace_reader)
+    ltr559 = ReplayLTR559(trace_reader)
+    gas = ReplayGas(trace_reader)
+    if enable_particle_sensor:
+        pms5003 = ReplayPMS5003(trace_reader, (ReadTimeoutError, ChecksumMismatchError))
+elif sensor_trace.get("Mode") == 'Record': # Record every raw sensor reading as it's taken
+    from Northcliff_Enviro_Monitor_Trace import (TraceWriter, RecordingBME280, RecordingLTR559, RecordingGas,
+                                                 RecordingPMS5003)
+    print('Recording Sensor Trace', sensor_trace["File"])
+    trace_writer = TraceWriter(sensor_trace["File"], clock, sensor_trace.get("Audio", False))
+    bme280 = RecordingBME280(bme280, trace_writer)
+    ltr559 = RecordingLTR559(ltr559, trace_writer)
+    gas = RecordingGas(gas, trace_writer)
+    if enable_particle_sensor:
+        pms5003 = RecordingPMS5003(pms5003, trace_writer, (ReadTimeoutError, ChecksumMismatchError))
+
+# The I2C bus service runs every BME280, LTR559, gas sensor ADC and SGP30 transaction on its own thread once the event
+# loop has started. Until then, and with a simulated clock, its transactions are run inline
+i2c_bus = I2CBusService(clock)
+if enable_display: # Proximity taps change the display mode
+    i2c_bus.add_poll('Proximity', 'LTR559', i2c_poll_intervals.get('Proximity', 0.5), ltr559.get_proximity)
+proximity_sensor = PolledProximity(i2c_bus) # Replaced by the shared proximity readings in the display process
+
+# Initialize display
+disp.begin()
+startup_timeline.mark('Hardware')
+
+# A dedicated thread reads the PMS5003's frames as they arrive, so that the sensor's timing never holds up the event
+# loop. The simulated clock can't be shared with another thread, so simulated runs read the PMS5003 inline instead.
+# When the PMS5003 is duty-cycled, its bursts of passive mode reads are requested from the event loop instead
+pms5003_reader = None
+pms5003_duty_cycle = None
+if enable_particle_sensor and pm_duty_cycle != {}:
+    if streaming_pms5003 is not None:
+        pms5003_duty_cycle = PMS5003DutyCycle(pm_duty_cycle)
+    else:
+        print('PM Duty Cycling Needs the Enviro+ PMS5003. Reading Continuously.')
+if enable_particle_sensor and pms5003_duty_cycle is None and not clock.simulated:
+    pms5003_reader = PMS5003Reader(pms5003, (ReadTimeoutError, ChecksumMismatchError))
+pm_frame_store = PMS5003FrameStore(clock) # Every frame's full data, including the particle count bins
+pm_size_distribution = None # The frame store's latest summary
+
+def read_pms5003(discard_buffered=False): # Blocks until the PMS5003 sends its next frame. Only used on a simulated
+    # clock
+    if discard_buffered and hasattr(pms5003, '_serial'): # Frames that were sent while PM sampling was paused are stale
+        pms5003._serial.reset_input_buffer()
+    try:
+        pm_values = pms5003.read()
+        pm_read_error = False
+    except (ReadTimeoutError, ChecksumMismatchError):
+        logging.info("Failed to read PMS5003")
+        pms5003.reset()
+        pm_values = pms5003.read()
+        pm_read_error = True
+    return pm_values, pm_read_error
+
+def read_pm_values(pm_values):
+    #print('PM Values:', pm_values)
+    readings_bus.publish("P2.5", pm_values.pm_ug_per_m3(2.5))
+    readings_bus.publish("P10", pm_values.pm_ug_per_m3(10))
+    readings_bus.publish("P1", pm_values.pm_ug_per_m3(1.0))
+
+def record_pm_frames(frames): # Stores each frame's full data and updates the size distribution that's displayed,
+    # logged and sent by mqtt
+    global pm_size_distribution
+    for frame in frames:
+        pm_frame_store.add(frame)
+    pm_size_distribution = pm_frame_store.summary()
+    mqtt_values["PM Size Distribution"] = pm_size_distribution
+
+def send_humidity_to_sgp30(raw_temp, raw_hum): # Calculate and send the absolute humidity reading to the SGP30 for
+    # humidity compensation
+    absolute_hum = int(1000 * 216.7 * (raw_hum/100 * 6.112 * math.exp(17.62 * raw_temp / (243.12 + raw_temp)))
+                       /(273.15 + raw_temp))
+    i2c_bus.submit('SGP30', sgp30.command, 'set_humidity', [absolute_hum]) # Doesn't wait for the bus
+
+def read_eco2_tvoc_values(): # Publishes the SGP30's latest polled reading, if it hasn't already been published
+    global last_eco2_tvoc_time
+    air_quality = i2c_bus.result('Air Quality')
+    if air_quality is None or air_quality[1] == last_eco2_tvoc_time:
+        return
+    (eco2, tvoc), last_eco2_tvoc_time = air_quality
     #print(eco2, tvoc)
-    own_data["CO2"][1] = eco2
-    mqtt_values["CO2"] = eco2
-    own_disp_values["CO2"] = own_disp_values["CO2"][1:] + [[own_data["CO2"][1], 1]]
-    own_data["VOC"][1] = tvoc
-    mqtt_values["VOC"] = tvoc
-    own_disp_values["VOC"] = own_disp_values["VOC"][1:] + [[own_data["VOC"][1], 1]]
-    return mqtt_values, own_data, own_disp_values
+    readings_bus.publish("CO2", eco2)
+    readings_bus.publish("VOC", tvoc)
+
+def read_lux(): # One LTR559 transaction. The light sensor is covered when the proximity is high
+    if ltr559.get_proximity() < 500:
+        return ltr559.get_lux()
+    return 1
+
+async def on_i2c_bus(device, function, *args): # Awaits a transaction on the I2C bus service's thread. With a
+    # simulated clock, it's run inline through run_blocking
+    if i2c_bus.running():
+        return await asyncio.wrap_future(i2c_bus.submit(device, function, *args))
+    return await run_blocking(i2c_bus.call, device, function, *args)
+
+async def read_climate_gas_sensors(): # Reads each device once for a climate and gas update
+    climate_sample = await on_i2c_bus('BME280', bme280.read_sample) # Temperature, humidity and pressure from the
+    # same conversion
+    gas_data = await on_i2c_bus('ADS1015', gas.read_all)
+    lux = await on_i2c_bus('LTR559', read_lux)
+    return climate_sample, gas_data, lux
 
 # Read gas and climate values from Home Manager and /or BME280 
-def read_climate_gas_values(luft_values, mqtt_values, own_data, maxi_temp, mini_temp, own_disp_values, gas_sensors_warm,
-                            gas_calib_temp, gas_calib_hum, gas_calib_bar, altitude, enable_eco2_tvoc):
-    raw_temp, comp_temp = adjusted_temperature()
-    raw_hum, comp_hum = adjusted_humidity()
-    current_time = time.time()
+def read_climate_gas_values(climate_sample, gas_data, lux):
+    global maxi_temp, mini_temp
+    raw_temp, comp_temp = adjusted_temperature(climate_sample.temperature)
+    raw_hum, comp_hum = adjusted_humidity(climate_sample.humidity)
+    current_time = climate_sample.time
     use_external_temp_hum = False
     use_external_barometer = False
     if enable_receive_data_from_homemanager:
         use_external_temp_hum, use_external_barometer = es.check_valid_readings(current_time)
     if use_external_temp_hum == False:
         print("Internal Temp/Hum Sensor")
-        luft_values["temperature"] = "{:.2f}".format(comp_temp)
-        own_data["Temp"][1] = round(comp_temp, 1)
-        luft_values["humidity"] = "{:.2f}".format(comp_hum)
-        own_data["Hum"][1] = round(comp_hum, 1)
+        temperature = comp_temp
+        humidity = comp_hum
     else: # Use external temp/hum sensor but still capture raw temp and raw hum for gas compensation and logging
         print("External Temp/Hum Sensor")
-        luft_values["temperature"] = es.temperature
-        own_data["Temp"][1] = float(luft_values["temperature"])
-        luft_values["humidity"] = es.humidity
-        own_data["Hum"][1] = float(luft_values["humidity"])
-    own_data["Dew"][1] = round(calculate_dewpoint(own_data["Temp"][1], own_data["Hum"][1]),1)
-    own_disp_values["Dew"] = own_disp_values["Dew"][1:] + [[own_data["Dew"][1], 1]]
-    mqtt_values["Dew"]  = own_data["Dew"][1]
-    own_disp_values["Temp"] = own_disp_values["Temp"][1:] + [[own_data["Temp"][1], 1]]
-    mqtt_values["Temp"] = own_data["Temp"][1]
-    own_disp_values["Hum"] = own_disp_values["Hum"][1:] + [[own_data["Hum"][1], 1]]
-    mqtt_values["Hum"][0] = own_data["Hum"][1]
-    mqtt_values["Hum"][1] = domoticz_hum_map[describe_humidity(own_data["Hum"][1])]
-    if enable_eco2_tvoc: # Calculate and send the absolute humidity reading to the SGP30 for humidity compensation
-        absolute_hum = int(1000 * 216.7 * (raw_hum/100 * 6.112 * math.exp(17.62 * raw_temp / (243.12 + raw_temp)))
-                           /(273.15 + raw_temp))
-        sgp30.command('set_humidity', [absolute_hum])
-    else:
-        absolute_hum = None
+        temperature = float(es.temperature)
+        humidity = float(es.humidity)
+    readings_bus.publish("Temp", temperature)
+    readings_bus.publish("Hum", humidity)
+    readings_bus.publish("Dew", calculate_dewpoint(temperature, humidity))
+    if enable_eco2_tvoc and sgp30_ready:
+        send_humidity_to_sgp30(raw_temp, raw_hum)
     # Determine max and min temps
     if first_climate_reading_done :
         if maxi_temp is None:
-            maxi_temp = own_data["Temp"][1]
-        elif own_data["Temp"][1] > maxi_temp:
-            maxi_temp = own_data["Temp"][1]
+            maxi_temp = own_data.value("Temp")
+        elif own_data.value("Temp") > maxi_temp:
+            maxi_temp = own_data.value("Temp")
         else:
             pass
         if mini_temp is None:
-            mini_temp = own_data["Temp"][1]
-        elif own_data["Temp"][1] < mini_temp:
-            mini_temp = own_data["Temp"][1]
+            mini_temp = own_data.value("Temp")
+        elif own_data.value("Temp") < mini_temp:
+            mini_temp = own_data.value("Temp")
         else:
             pass
-    mqtt_values["Min Temp"] = mini_temp
-    mqtt_values["Max Temp"] = maxi_temp
-    raw_barometer = bme280.get_pressure()
+    readings_bus.publish("Min Temp", mini_temp)
+    readings_bus.publish("Max Temp", maxi_temp)
+    raw_barometer = climate_sample.pressure
     if use_external_barometer == False:
         print("Internal Barometer")
-        own_data["Bar"][1] = round(raw_barometer * barometer_altitude_comp_factor(altitude, own_data["Temp"][1]), 2)
-        own_disp_values["Bar"] = own_disp_values["Bar"][1:] + [[own_data["Bar"][1], 1]]
-        mqtt_values["Bar"][0] = own_data["Bar"][1]
-        luft_values["pressure"] = "{:.2f}".format(raw_barometer * 100) # Send raw air pressure to Lufdaten,
+        readings_bus.publish("Bar", raw_barometer * barometer_altitude_comp_factor(altitude, own_data.value("Temp")))
+        readings_bus.publish("Station Bar", raw_barometer) # Send raw air pressure to Lufdaten,
         # since it does its own altitude air pressure compensation
-        print("Raw Bar:", round(raw_barometer, 2), "Comp Bar:", own_data["Bar"][1])
+        print("Raw Bar:", round(raw_barometer, 2), "Comp Bar:", own_data.value("Bar"))
     else:
         print("External Barometer")
-        own_data["Bar"][1] = round(float(es.barometer), 2)
-        own_disp_values["Bar"] = own_disp_values["Bar"][1:] + [[own_data["Bar"][1], 1]]
-        mqtt_values["Bar"][0] = own_data["Bar"][1]
+        readings_bus.publish("Bar", float(es.barometer))
         # Remove altitude compensation from external barometer because Lufdaten does its own altitude air pressure
         # compensation
-        luft_values["pressure"] = "{:.2f}".format(float(es.barometer) / barometer_altitude_comp_factor (
-            altitude, own_data["Temp"][1]) * 100)
-        print("Luft Bar:", luft_values["pressure"], "Comp Bar:", own_data["Bar"][1])
+        readings_bus.publish("Station Bar", float(es.barometer) / barometer_altitude_comp_factor (
+            altitude, own_data.value("Temp")))
+        print("Luft Bar:", luft_values["pressure"], "Comp Bar:", own_data.value("Bar"))
     red_in_ppm, oxi_in_ppm, nh3_in_ppm, comp_red_rs, comp_oxi_rs, comp_nh3_rs, raw_red_rs, raw_oxi_rs, raw_nh3_rs =\
-        read_gas_in_ppm(gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer, gas_sensors_warm)
-    own_data["Red"][1] = round(red_in_ppm, 2)
-    own_disp_values["Red"] = own_disp_values["Red"][1:] + [[own_data["Red"][1], 1]]
-    mqtt_values["Red"] = own_data["Red"][1]
-    own_data["Oxi"][1] = round(oxi_in_ppm, 2)
-    own_disp_values["Oxi"] = own_disp_values["Oxi"][1:] + [[own_data["Oxi"][1], 1]]
-    mqtt_values["Oxi"] = own_data["Oxi"][1]
-    own_data["NH3"][1] = round(nh3_in_ppm, 2)
-    own_disp_values["NH3"] = own_disp_values["NH3"][1:] + [[own_data["NH3"][1], 1]]
-    mqtt_values["NH3"] = own_data["NH3"][1]
-    mqtt_values["Gas Calibrated"] = gas_sensors_warm
-    proximity = ltr559.get_proximity()
-    if proximity < 500:
-        own_data["Lux"][1] = round(ltr559.get_lux(), 1)
-    else:
-        own_data["Lux"][1] = 1
-    own_disp_values["Lux"] = own_disp_values["Lux"][1:] + [[own_data["Lux"][1], 1]]
-    mqtt_values["Lux"] = own_data["Lux"][1]
-    return luft_values, mqtt_values, own_data, maxi_temp, mini_temp, own_disp_values, raw_red_rs, raw_oxi_rs,\
-           raw_nh3_rs, raw_temp, comp_temp, comp_hum, raw_hum, use_external_temp_hum, use_external_barometer,\
-           raw_barometer, absolute_hum
+        read_gas_in_ppm(gas_data, gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer,
+                        gas_sensors_warm)
+    if gas_sensors_warm: # Track the clean air baseline once the gas sensors have warmed up
+        if gas_baseline_tracker.reference is None: # Track the Rs at the calibration conditions in use when tracking
+            # starts
+            gas_baseline_tracker.reference = [gas_calib_temp, gas_calib_hum, gas_calib_bar]
+        reference_temp, reference_hum, reference_bar = gas_baseline_tracker.reference
+        gas_baseline_tracker.add(clock.now().date().toordinal(),
+                                 [compensation.gas_rs(name, rs, raw_temp - reference_temp, raw_hum - reference_hum,
+                                                      raw_barometer - reference_bar)
+                                  for name, rs in zip(("Red", "Oxi", "NH3"), (raw_red_rs, raw_oxi_rs, raw_nh3_rs))])
+    else: # Track the raw Rs drift until the gas sensors have warmed up
+        gas_warm_up_detector.add(current_time, (raw_red_rs, raw_oxi_rs, raw_nh3_rs))
+        print("Gas Sensor Warm Up Drift.", gas_warm_up_detector.summary())
+    readings_bus.publish("Red", red_in_ppm)
+    readings_bus.publish("Oxi", oxi_in_ppm)
+    readings_bus.publish("NH3", nh3_in_ppm)
+    readings_bus.publish("Gas Calibrated", gas_sensors_warm)
+    readings_bus.publish("Lux", lux)
+    # Raw readings for gas sensor calibration and the climate and gas log
+    readings_bus.publish("Raw Temp", raw_temp)
+    readings_bus.publish("Comp Temp", comp_temp)
+    readings_bus.publish("Raw Hum", raw_hum)
+    readings_bus.publish("Comp Hum", comp_hum)
+    readings_bus.publish("Raw Bar", raw_barometer)
+    readings_bus.publish("Red Rs", raw_red_rs)
+    readings_bus.publish("Oxi Rs", raw_oxi_rs)
+    readings_bus.publish("NH3 Rs", raw_nh3_rs)
+    readings_bus.publish("External Temp Hum", use_external_temp_hum)
+    readings_bus.publish("External Bar", use_external_barometer)
+
+# Readings bus subscribers that keep the own data, mqtt and Luftdaten values up to date
+reading_precision = {"Temp": 1, "Hum": 1, "Dew": 1, "Bar": 2, "Oxi": 2, "Red": 2, "NH3": 2, "Lux": 1} # Decimal
+# places kept for display and mqtt
+
+def record_own_reading(reading):
+    if reading.name in reading_precision:
+        value = round(reading.value, reading_precision[reading.name])
+    else:
+        value = reading.value
+    own_data.set_value(reading.name, value)
+    own_disp_values[reading.name] = own_disp_values[reading.name][1:] + [[value, 1]]
+
+def record_mqtt_reading(reading):
+    if reading.name in reading_precision:
+        value = round(reading.value, reading_precision[reading.name])
+    else:
+        value = reading.value
+    if reading.name == "Hum": # Humidity and barometer mqtt readings have their data in lists
+        mqtt_values["Hum"] = [value, domoticz_hum_map[describe_humidity(value)]]
+    elif reading.name == "Bar":
+        mqtt_values["Bar"][0] = value
+    else:
+        mqtt_values[reading.name] = value
+
+luftdaten_readings = ["Temp", "Hum", "Station Bar", "P2.5", "P10"]
+
+def record_luftdaten_reading(reading):
+    if reading.name == "Temp":
+        luft_values["temperature"] = "{:.2f}".format(reading.value)
+    elif reading.name == "Hum":
+        luft_values["humidity"] = "{:.2f}".format(reading.value)
+    elif reading.name == "Station Bar":
+        luft_values["pressure"] = "{:.2f}".format(reading.value * 100)
+    elif reading.name == "P2.5":
+        luft_values["P2"] = str(reading.value)
+    elif reading.name == "P10":
+        luft_values["P1"] = str(reading.value)
+
+aggregated_readings = {"P1": 1, "P2.5": 1, "P10": 1, "Red": 2, "Oxi": 2, "NH3": 2} # Readings that are sent as the
+# statistics of each sink's reporting interval, with their decimal places
+
+def interval_means(interval_statistics): # The mean of each aggregated reading over a sink's reporting interval
+    return {name: statistics["Mean"] for name, statistics in interval_statistics.items()}
+
+def mqtt_report(): # The mqtt values, with the PM and gas readings' means and statistics since the last mqtt update
+    interval_statistics = mqtt_aggregator.take()
+    report = dict(mqtt_values)
+    report.update(interval_means(interval_statistics))
+    report["Interval Statistics"] = interval_statistics
+    return report
+
+climate_log_readings = ["Temp", "Hum", "Bar", "Oxi", "Red", "NH3", "Raw Temp", "Comp Temp", "Raw Hum", "Comp Hum",
+                        "Raw Bar", "Red Rs", "Oxi Rs", "NH3 Rs"]
     
 def barometer_altitude_comp_factor(alt, temp):
     comp_factor = math.pow(1 - (0.0065 * altitude/(temp + 0.0065 * alt + 273.15)), -5.257)
     return comp_factor
     
-def read_raw_gas():
-    gas_data = gas.read_all()
+def read_raw_gas(gas_data):
     raw_red_rs = round(gas_data.reducing, 0)
     raw_oxi_rs = round(gas_data.oxidising, 0)
     raw_nh3_rs = round(gas_data.nh3, 0)
     return raw_red_rs, raw_oxi_rs, raw_nh3_rs
     
-def read_gas_in_ppm(gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer, gas_sensors_warm):
+def read_gas_in_ppm(gas_data, gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer,
+                    gas_sensors_warm):
     if gas_sensors_warm:
-        comp_red_rs, comp_oxi_rs, comp_nh3_rs, raw_red_rs, raw_oxi_rs, raw_nh3_rs = comp_gas(gas_calib_temp,
+        comp_red_rs, comp_oxi_rs, comp_nh3_rs, raw_red_rs, raw_oxi_rs, raw_nh3_rs = comp_gas(gas_data, gas_calib_temp,
                                                                                              gas_calib_hum,
                                                                                              gas_calib_bar,
                                                                                              raw_temp,
                                                                                              raw_hum, raw_barometer)
         print("Reading Compensated Gas sensors after warmup completed")
     else:
-        raw_red_rs, raw_oxi_rs, raw_nh3_rs = read_raw_gas()
+        raw_red_rs, raw_oxi_rs, raw_nh3_rs = read_raw_gas(gas_data)
         comp_red_rs = raw_red_rs
         comp_oxi_rs = raw_oxi_rs
         comp_nh3_rs = raw_nh3_rs
@@ -388,109 +764,87 @@ def read_gas_in_ppm(gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_
     nh3_in_ppm = math.pow(10, -1.8 * math.log10(nh3_ratio) - 0.163)
     return red_in_ppm, oxi_in_ppm, nh3_in_ppm, comp_red_rs, comp_oxi_rs, comp_nh3_rs, raw_red_rs, raw_oxi_rs, raw_nh3_rs
 
-def comp_gas(gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer):
-    gas_data = gas.read_all()
+def comp_gas(gas_data, gas_calib_temp, gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer):
     gas_temp_diff = raw_temp - gas_calib_temp
     gas_hum_diff = raw_hum - gas_calib_hum
     gas_bar_diff = raw_barometer - gas_calib_bar
     raw_red_rs = round(gas_data.reducing, 0)
-    comp_red_rs = round(raw_red_rs - (red_temp_comp_factor * raw_red_rs * gas_temp_diff +
-                                      red_hum_comp_factor * raw_red_rs * gas_hum_diff +
-                                      red_bar_comp_factor * raw_red_rs * gas_bar_diff), 0)
+    comp_red_rs = round(compensation.gas_rs("Red", raw_red_rs, gas_temp_diff, gas_hum_diff, gas_bar_diff), 0)
     raw_oxi_rs = round(gas_data.oxidising, 0)
-    comp_oxi_rs = round(raw_oxi_rs - (oxi_temp_comp_factor * raw_oxi_rs * gas_temp_diff +
-                                      oxi_hum_comp_factor * raw_oxi_rs * gas_hum_diff +
-                                      oxi_bar_comp_factor * raw_oxi_rs * gas_bar_diff), 0)
+    comp_oxi_rs = round(compensation.gas_rs("Oxi", raw_oxi_rs, gas_temp_diff, gas_hum_diff, gas_bar_diff), 0)
     raw_nh3_rs = round(gas_data.nh3, 0)
-    comp_nh3_rs = round(raw_nh3_rs - (nh3_temp_comp_factor * raw_nh3_rs * gas_temp_diff +
-                                      nh3_hum_comp_factor * raw_nh3_rs * gas_hum_diff +
-                                      nh3_bar_comp_factor * raw_nh3_rs * gas_bar_diff), 0)
+    comp_nh3_rs = round(compensation.gas_rs("NH3", raw_nh3_rs, gas_temp_diff, gas_hum_diff, gas_bar_diff), 0)
     print("Gas Compensation. Raw Red Rs:", raw_red_rs, "Comp Red Rs:", comp_red_rs, "Raw Oxi Rs:",
           raw_oxi_rs, "Comp Oxi Rs:", comp_oxi_rs,
           "Raw NH3 Rs:", raw_nh3_rs, "Comp NH3 Rs:", comp_nh3_rs)
     return comp_red_rs, comp_oxi_rs, comp_nh3_rs, raw_red_rs, raw_oxi_rs, raw_nh3_rs   
     
-def adjusted_temperature():
-    raw_temp = bme280.get_temperature()
-    #comp_temp = comp_temp_slope * raw_temp + comp_temp_intercept
-    comp_temp = (comp_temp_cub_a * math.pow(raw_temp, 3) + comp_temp_cub_b * math.pow(raw_temp, 2) +
-                 comp_temp_cub_c * raw_temp + comp_temp_cub_d)
+def adjusted_temperature(raw_temp):
+    comp_temp = compensation.temperature(raw_temp) + temp_offset
     return raw_temp, comp_temp
 
-def adjusted_humidity():
-    raw_hum = bme280.get_humidity()
-    #comp_hum = comp_hum_slope * raw_hum + comp_hum_intercept
-    comp_hum = comp_hum_quad_a * math.pow(raw_hum, 2) + comp_hum_quad_b * raw_hum + comp_hum_quad_c
-    return raw_hum, min(100, comp_hum)
+def adjusted_humidity(raw_hum):
+    comp_hum = compensation.humidity(raw_hum) # The models limit it to 100%
+    return raw_hum, comp_hum
 
 def calculate_dewpoint(dew_temp, dew_hum):
     dewpoint = (237.7 * (math.log(dew_hum/100)+17.271*dew_temp/(237.7+dew_temp))/(17.271 - math.log(dew_hum/100) - 17.271*dew_temp/(237.7 + dew_temp)))
     return dewpoint
 
-def log_climate_and_gas(run_time, own_data, raw_red_rs, raw_oxi_rs, raw_nh3_rs, raw_temp, comp_temp, comp_hum,
-                        raw_hum, use_external_temp_hum, use_external_barometer, raw_barometer):
+def log_climate_and_gas(run_time):
     # Used to log climate and gas data to create compensation algorithms
-    raw_temp = round(raw_temp, 2)
-    raw_hum = round(raw_hum, 2)
-    comp_temp = round(comp_temp, 2)
-    comp_hum = round(comp_hum, 2)
-    raw_barometer = round(raw_barometer, 1)
-    raw_red_rs = round(raw_red_rs, 0)
-    raw_oxi_rs = round(raw_oxi_rs, 0)
-    raw_nh3_rs = round(raw_nh3_rs, 0)
-    today = datetime.now()
+    raw_temp = round(readings_bus.value("Raw Temp"), 2)
+    raw_hum = round(readings_bus.value("Raw Hum"), 2)
+    comp_temp = round(readings_bus.value("Comp Temp"), 2)
+    comp_hum = round(readings_bus.value("Comp Hum"), 2)
+    raw_barometer = round(readings_bus.value("Raw Bar"), 1)
+    raw_red_rs = round(readings_bus.value("Red Rs"), 0)
+    raw_oxi_rs = round(readings_bus.value("Oxi Rs"), 0)
+    raw_nh3_rs = round(readings_bus.value("NH3 Rs"), 0)
+    use_external_temp_hum = readings_bus.value("External Temp Hum")
+    use_external_barometer = readings_bus.value("External Bar")
+    today = clock.now()
     time_stamp = today.strftime('%A %d %B %Y @ %H:%M:%S')
     if use_external_temp_hum and use_external_barometer:
         environment_log_data = {'Time': time_stamp, 'Run Time': run_time, 'Raw Temperature': raw_temp,
-                                'Output Temp': comp_temp, 'Real Temperature': own_data["Temp"][1],
+                                'Output Temp': comp_temp, 'Real Temperature': own_data.value("Temp"),
                                 'Raw Humidity': raw_hum, 'Output Humidity': comp_hum,
-                                'Real Humidity': own_data["Hum"][1], 'Real Bar': own_data["Bar"][1],
-                                'Raw Bar': raw_barometer, 'Oxi': own_data["Oxi"][1], 'Red': own_data["Red"][1],
-                                'NH3': own_data["NH3"][1], 'Raw OxiRS': raw_oxi_rs, 'Raw RedRS': raw_red_rs,
+                                'Real Humidity': own_data.value("Hum"), 'Real Bar': own_data.value("Bar"),
+                                'Raw Bar': raw_barometer, 'Oxi': own_data.value("Oxi"), 'Red': own_data.value("Red"),
+                                'NH3': own_data.value("NH3"), 'Raw OxiRS': raw_oxi_rs, 'Raw RedRS': raw_red_rs,
                                 'Raw NH3RS': raw_nh3_rs}
     elif use_external_temp_hum and not(use_external_barometer):
         environment_log_data = {'Time': time_stamp, 'Run Time': run_time, 'Raw Temperature': raw_temp,
-                                'Output Temp': comp_temp, 'Real Temperature': own_data["Temp"][1],
+                                'Output Temp': comp_temp, 'Real Temperature': own_data.value("Temp"),
                                 'Raw Humidity': raw_hum, 'Output Humidity': comp_hum,
-                                'Real Humidity': own_data["Hum"][1], 'Output Bar': own_data["Bar"][1],
-                                'Raw Bar': raw_barometer, 'Oxi': own_data["Oxi"][1], 'Red': own_data["Red"][1],
-                                'NH3': own_data["NH3"][1], 'Raw OxiRS': raw_oxi_rs, 'Raw RedRS': raw_red_rs,
+                                'Real Humidity': own_data.value("Hum"), 'Output Bar': own_data.value("Bar"),
+                                'Raw Bar': raw_barometer, 'Oxi': own_data.value("Oxi"), 'Red': own_data.value("Red"),
+                                'NH3': own_data.value("NH3"), 'Raw OxiRS': raw_oxi_rs, 'Raw RedRS': raw_red_rs,
                                 'Raw NH3RS': raw_nh3_rs}
     elif not(use_external_temp_hum) and use_external_barometer:
         environment_log_data = {'Time': time_stamp, 'Run Time': run_time, 'Raw Temperature': raw_temp,
                                 'Output Temp': comp_temp, 'Raw Humidity': raw_hum, 'Output Humidity': comp_hum,
-                                'Real Bar': own_data["Bar"][1], 'Raw Bar': raw_barometer, 'Oxi': own_data["Oxi"][1],
-                                'Red': own_data["Red"][1], 'NH3': own_data["NH3"][1], 'Raw OxiRS': raw_oxi_rs,
+                                'Real Bar': own_data.value("Bar"), 'Raw Bar': raw_barometer, 'Oxi': own_data.value("Oxi"),
+                                'Red': own_data.value("Red"), 'NH3': own_data.value("NH3"), 'Raw OxiRS': raw_oxi_rs,
                                 'Raw RedRS': raw_red_rs, 'Raw NH3RS': raw_nh3_rs}
     else:
         environment_log_data = {'Time': time_stamp, 'Run Time': run_time, 'Raw Temperature': raw_temp,
                                 'Output Temp': comp_temp,  'Raw Humidity': raw_hum, 'Output Humidity': comp_hum,
-                                'Output Bar': own_data["Bar"][1], 'Raw Bar': raw_barometer, 'Oxi': own_data["Oxi"][1],
-                                'Red': own_data["Red"][1], 'NH3': own_data["NH3"][1], 'Raw OxiRS': raw_oxi_rs,
+                                'Output Bar': own_data.value("Bar"), 'Raw Bar': raw_barometer, 'Oxi': own_data.value("Oxi"),
+                                'Red': own_data.value("Red"), 'NH3': own_data.value("NH3"), 'Raw OxiRS': raw_oxi_rs,
                                 'Raw RedRS': raw_red_rs, 'Raw NH3RS': raw_nh3_rs}
+    if pm_size_distribution is not None:
+        environment_log_data['PM Size Distribution'] = pm_size_distribution
     print('Logging Environment Data.', environment_log_data)
-    with open('<Your Environment Log File Location Here>', 'a') as f:
-        f.write(',\n' + json.dumps(environment_log_data))
+    storage_writer.append('<Your Environment Log File Location Here>', ',\n' + json.dumps(environment_log_data))
     
 # Calculate Air Quality Level
 def max_aqi_level_factor(gas_sensors_warm, air_quality_data, air_quality_data_no_gas, data):
-    max_aqi_level = 0
-    max_aqi_factor = 'All'
-    max_aqi = [max_aqi_factor, max_aqi_level]
     if gas_sensors_warm:
         aqi_data = air_quality_data
     else:
         aqi_data = air_quality_data_no_gas
-    for aqi_factor in aqi_data:
-        aqi_factor_level = 0
-        thresholds = data[aqi_factor][2]
-        for level in range(len(thresholds)):
-            if data[aqi_factor][1] != None:
-                if data[aqi_factor][1] > thresholds[level]:
-                    aqi_factor_level = level + 1
-        if aqi_factor_level > max_aqi[1]:
-            max_aqi = [aqi_factor, aqi_factor_level]
-    return max_aqi
+    return data.max_level(aqi_data)
         
 # Get Raspberry Pi serial number to use as ID
 def get_serial_number():
@@ -498,6 +852,7 @@ def get_serial_number():
         for line in f:
             if line[0:6] == 'Serial':
                 return line.split(":")[1].strip()
+    return 'Unknown' # Not running on a Raspberry Pi
 
 # Check for Wi-Fi connection
 def check_wifi():
@@ -513,11 +868,11 @@ def display_startup(message):
     error_message = "{}".format(message)
     img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
     draw = ImageDraw.Draw(img)
-    _, _, size_x, size_y = draw.textbbox((0,0), message, mediumfont)
+    _, _, size_x, size_y = draw.textbbox((0,0), message, get_font(font_size_medium))
     x = (WIDTH - size_x) / 2
     y = (HEIGHT / 2) - (size_y / 2)
     draw.rectangle((0, 0, 160, 80), back_colour)
-    draw.text((x, y), error_message, font=mediumfont, fill=text_colour)
+    draw.text((x, y), error_message, font=get_font(font_size_medium), fill=text_colour)
     disp.display(img)
 
 # Display Error Message on LCD
@@ -527,11 +882,11 @@ def display_error(message):
     error_message = "System Error\n{}".format(message)
     img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
     draw = ImageDraw.Draw(img)
-    _, _, size_x, size_y = draw.textbbox((0,0), message, mediumfont)
+    _, _, size_x, size_y = draw.textbbox((0,0), message, get_font(font_size_medium))
     x = (WIDTH - size_x) / 2
     y = (HEIGHT / 2) - (size_y / 2)
     draw.rectangle((0, 0, 160, 80), back_colour)
-    draw.text((x, y), error_message, font=mediumfont, fill=text_colour)
+    draw.text((x, y), error_message, font=get_font(font_size_medium), fill=text_colour)
     disp.display(img)
 
 # Display the Raspberry Pi serial number and Adafruit IO Dashboard URL (if enabled) on a background colour
@@ -548,11 +903,11 @@ def disabled_display(gas_sensors_warm, air_quality_data, air_quality_data_no_gas
         message = "{}".format(id)
     img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
     draw = ImageDraw.Draw(img)
-    _, _, size_x, size_y = draw.textbbox((0,0), message, font_smm)
+    _, _, size_x, size_y = draw.textbbox((0,0), message, get_font(font_size_smm))
     x = (WIDTH - size_x) / 2
     y = (HEIGHT / 2) - (size_y / 2)
     draw.rectangle((0, 0, 160, 80), back_colour)
-    draw.text((x, y), message, font=font_smm, fill=text_colour)
+    draw.text((x, y), message, font=get_font(font_size_smm), fill=text_colour)
     disp.display(img)
     
 # Display Raspberry Pi serial and Adafruit IO Dashboard URL (if enabled)
@@ -567,11 +922,11 @@ def display_status(enable_adafruit_io, aio_user_name, aio_household_prefix):
         message = "Northcliff\nEnviro Monitor\n{}\nwifi: {}".format(id, wifi_status)
     img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
     draw = ImageDraw.Draw(img)
-    _, _, size_x, size_y = draw.textbbox((0,0), message, font_smm)
+    _, _, size_x, size_y = draw.textbbox((0,0), message, get_font(font_size_smm))
     x = (WIDTH - size_x) / 2
     y = (HEIGHT / 2) - (size_y / 2)
     draw.rectangle((0, 0, 160, 80), back_colour)
-    draw.text((x, y), message, font=font_smm, fill=text_colour)
+    draw.text((x, y), message, font=get_font(font_size_smm), fill=text_colour)
     disp.display(img)
     
 def send_data_to_aio(feed_key, data):
@@ -746,9 +1101,12 @@ def on_message(client, userdata, msg):
 def capture_outdoor_data(parsed_json):
     global captured_outdoor_data
     captured_outdoor_data = parsed_json
+    notify_main_loop(outdoor_data_event)
     
 # Displays graphed data and text on the 0.96" LCD
 def display_graphed_data(location, disp_values, variable, data, WIDTH):
+    value = data.value(variable)
+    unit = data.unit(variable)
     # Scale the received disp_values for the variable between 0 and 1
     #print ("Display Values", disp_values)
     received_disp_values = [disp_values[variable][v][0]*disp_values[variable][v][1]
@@ -758,24 +1116,21 @@ def display_graphed_data(location, disp_values, variable, data, WIDTH):
                    else 0 for v in received_disp_values]           
     # Format the variable name and value
     if variable == "Oxi":
-        message = "{} {}: {:.2f} {}".format(location, variable[:4], data[1], data[0])
+        message = "{} {}: {:.2f} {}".format(location, variable[:4], value, unit)
     elif variable == "Bar":
-        message = "{}: {:.1f} {}".format(variable[:4], data[1], data[0])
+        message = "{}: {:.1f} {}".format(variable[:4], value, unit)
     elif (variable[:1] == "P" or variable == "Red" or variable == "NH3" or variable == "CO2" or variable == "VOC" or
           variable == "Hum" or variable == "Lux"):
-        message = "{} {}: {:.0f} {}".format(location, variable[:4], round(data[1], 0), data[0])
+        message = "{} {}: {:.0f} {}".format(location, variable[:4], round(value, 0), unit)
     else:
-        message = "{} {}: {:.1f} {}".format(location, variable[:4], data[1], data[0])
+        message = "{} {}: {:.1f} {}".format(location, variable[:4], value, unit)
     #logging.info(message)
     draw.rectangle((0, 0, WIDTH, HEIGHT), (255, 255, 255))
     # Determine the backgound colour for received data, based on level thresholds. Black for data not received.
+    graph_levels = data.levels_of(variable, [disp_value[0] for disp_value in disp_values[variable]])
     for i in range(len(disp_values[variable])):
         if disp_values[variable][i][1] == 1:
-            lim = data[2]
-            rgb = palette[0]
-            for j in range(len(lim)):
-                if disp_values[variable][i][0] > lim[j]:
-                    rgb = palette[j+1]
+            rgb = palette[graph_levels[i]]
         else:
             rgb = (0,0,0)
         # Draw a 2-pixel wide rectangle of colour based on reading levels relative to level thresholds
@@ -784,7 +1139,7 @@ def display_graphed_data(location, disp_values, variable, data, WIDTH):
         line_y = (HEIGHT-2) - ((top_pos + 1) + (graph_range[i] * ((HEIGHT-2) - (top_pos + 1)))) + (top_pos + 1)
         draw.rectangle((i*2, line_y, i*2+2, line_y+2), (0, 0, 0))
     # Write the text at the top in black
-    draw.text((0, 0), message, font=font_ml, fill=(0, 0, 0))
+    draw.text((0, 0), message, font=get_font(font_size_ml), fill=(0, 0, 0))
     disp.display(img)
 
 # Displays the weather forecast on the 0.96" LCD
@@ -795,7 +1150,7 @@ def display_forecast(valid_barometer_history, forecast, barometer_available_time
         message = "Barometer {:.0f} hPa\n3Hr Change {:.0f} hPa\n{}".format(round(barometer, 0),
                                                                            round(barometer_change, 0), forecast)
     else:
-        minutes_to_forecast = (barometer_available_time - time.time()) / 60
+        minutes_to_forecast = (barometer_available_time - clock.time()) / 60
         if minutes_to_forecast >= 2:
             message = "WEATHER FORECAST\nReady in {:.0f} minutes".format(minutes_to_forecast)
         elif minutes_to_forecast > 0 and minutes_to_forecast < 2:
@@ -804,11 +1159,11 @@ def display_forecast(valid_barometer_history, forecast, barometer_available_time
             message = "WEATHER FORECAST\nPreparing Summary\nPlease Wait..."
     img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
     draw = ImageDraw.Draw(img)
-    _, _, size_x, size_y = draw.textbbox((0,0), message, mediumfont)
+    _, _, size_x, size_y = draw.textbbox((0,0), message, get_font(font_size_medium))
     x = (WIDTH - size_x) / 2
     y = (HEIGHT / 2) - (size_y / 2)
     draw.rectangle((0, 0, 160, 80), back_colour)
-    draw.text((x, y), message, font=mediumfont, fill=text_colour)
+    draw.text((x, y), message, font=get_font(font_size_medium), fill=text_colour)
     disp.display(img)
     
 # Displays all the air quality text on the 0.96" LCD
@@ -816,16 +1171,17 @@ def display_all_aq(location, data, data_in_display_all_aq, enable_eco2_tvoc):
     draw.rectangle((0, 0, WIDTH, HEIGHT), (0, 0, 0))
     column_count = 2
     if enable_eco2_tvoc:
-        font=font_smm
+        font=get_font(font_size_smm)
     else:
-        font=font_ml
+        font=get_font(font_size_ml)
     draw.text((2, 2), location + ' AIR QUALITY', font=font, fill=(255, 255, 255))
     row_count = round((len(data_in_display_all_aq) / column_count), 0)
+    levels = data.levels()
     for i in data_in_display_all_aq:
-        data_value = data[i][1]
-        unit = data[i][0]
-        column = int(data[i][3] / row_count)
-        row = data[i][3] % row_count
+        data_value = data.value(i)
+        index = data.metrics[i].index # The air quality readings come first, so their indices are their positions
+        column = int(index / row_count)
+        row = index % row_count
         x = x_offset + ((WIDTH/column_count) * column)
         y = y_offset + ((HEIGHT/(row_count + 1) * (row +1)))
         if (i == "CO2" or i == "VOC") and location == "OUT" or data_value == None:
@@ -836,15 +1192,27 @@ def display_all_aq(location, data, data_in_display_all_aq, enable_eco2_tvoc):
             message = "{}: {:.2f}".format(i, data_value)
         else:
             message = "{}: {:.0f}".format(i, round(data_value, 0))
-        lim = data[i][2]
-        rgb = palette[0]
-        if data_value != None:
-            for j in range(len(lim)):
-                if data_value > lim[j]:
-                    rgb = palette[j+1]
+        rgb = palette[levels[index]]
         draw.text((x, y), message, font=font, fill=rgb)
     disp.display(img)
         
+def display_pm_sizes(location, size_distribution): # Bar graph of the mean particle counts, on a log scale
+    draw.rectangle((0, 0, WIDTH, HEIGHT), (0, 0, 0))
+    draw.text((2, 0), location + " PM Sizes /0.1L", font=get_font(font_size_smm), fill=(255, 255, 255))
+    if size_distribution is None:
+        draw.text((2, 30), "Waiting for Data", font=get_font(font_size_smm), fill=(255, 255, 255))
+        disp.display(img)
+        return
+    bar_width = WIDTH / len(size_distribution["Counts"])
+    graph_height = HEIGHT - 32 # Leaves room for the title and the size labels
+    for i, size in enumerate(size_distribution["Counts"]):
+        count = size_distribution["Counts"][size]
+        bar_height = min(graph_height, graph_height * math.log10(count + 1) / 4) # Up to 10,000 particles
+        x = i * bar_width
+        draw.rectangle((x + 2, HEIGHT - 12 - bar_height, x + bar_width - 2, HEIGHT - 12), (0, 170, 170))
+        draw.text((x + 2, HEIGHT - 11), size[1:-2], font=get_font(font_size_small), fill=(255, 255, 255))
+    disp.display(img)
+
 def display_noise(location, selected_display_mode, noise_level, noise_max, noise_max_datetime, display_changed, last_page, noise_values, freq_values):
     draw.rectangle((0, 0, WIDTH, HEIGHT), noise_back_colour)
     if noise_level<=noise_thresholds[0]:
@@ -854,8 +1222,8 @@ def display_noise(location, selected_display_mode, noise_level, noise_max, noise
     else:
         message_colour = (255, 0, 0)
     if selected_display_mode == "Noise Reading":
-        draw.text((5,0), location + " Noise Level", font=noise_smallfont, fill=message_colour)
-        draw.text((5, 32), f"{noise_level:.1f} dB(A)", font=noise_largefont, fill=message_colour)
+        draw.text((5,0), location + " Noise Level", font=get_font(noise_font_size_small), fill=message_colour)
+        draw.text((5, 32), f"{noise_level:.1f} dB(A)", font=get_font(noise_font_size_large), fill=message_colour)
         disp.display(img)
     elif selected_display_mode == "Noise Level":
         if noise_max<=noise_thresholds[0]:
@@ -873,14 +1241,14 @@ def display_noise(location, selected_display_mode, noise_level, noise_max, noise
                 else:
                     graph_colour = (255, 0, 0)
                 draw.line((5+i*6, HEIGHT, 5+i*6, HEIGHT - (noise_values[i][0]-35)), fill=graph_colour, width=5)   
-        draw.text((5,0), location + " Noise Level", font=noise_smallfont, fill=message_colour)
-        if noise_max != 0 and (time.time() - last_page) > 2:
+        draw.text((5,0), location + " Noise Level", font=get_font(noise_font_size_small), fill=message_colour)
+        if noise_max != 0 and (clock.time() - last_page) > 2:
             draw.line((0, HEIGHT - (noise_max-35), WIDTH, HEIGHT - (noise_max-35)), fill=max_graph_colour, width=1) #Display Max Line
             if noise_max > 85:
                 text_height = HEIGHT - (noise_max-37)
             else:
                 text_height = HEIGHT - (noise_max-20)
-            draw.text((0, text_height), f"Max {noise_max:.1f} dB {noise_max_datetime['Time']} {noise_max_datetime['Date']}", font=noise_vsmallfont, fill=max_graph_colour)
+            draw.text((0, text_height), f"Max {noise_max:.1f} dB {noise_max_datetime['Time']} {noise_max_datetime['Date']}", font=get_font(noise_font_size_vsmall), fill=max_graph_colour)
         disp.display(img)
     else:
         for i in range(len(freq_values)):
@@ -888,47 +1256,47 @@ def display_noise(location, selected_display_mode, noise_level, noise_max, noise
                 draw.line((15+i*20, HEIGHT, 15+i*20, HEIGHT - (freq_values[i][2]*0.747-45)), fill=(0, 0, 255), width=5)
                 draw.line((10+i*20, HEIGHT, 10+i*20, HEIGHT - (freq_values[i][1]*0.844-59)), fill=(0, 255, 0), width=5)
                 draw.line((5+i*20, HEIGHT, 5+i*20, HEIGHT - (freq_values[i][0]*1.14-103)), fill=(255, 0, 0), width=5)
-        draw.text((0,0), location + " Noise Bands", font=noise_smallfont, fill=message_colour)
+        draw.text((0,0), location + " Noise Bands", font=get_font(noise_font_size_small), fill=message_colour)
         disp.display(img) 
 
-def display_results(start_current_display, current_display_is_own, display_modes,
-                                indoor_outdoor_display_duration, own_data, data_in_display_all_aq, outdoor_data,
-                                outdoor_reading_captured, own_disp_values, outdoor_disp_values, delay, last_page, mode,
-                                WIDTH, valid_barometer_history, forecast, barometer_available_time, barometer_change,
-                                barometer_trend, icon_forecast, maxi_temp, mini_temp, air_quality_data,
-                                air_quality_data_no_gas, gas_sensors_warm, outdoor_gas_sensors_warm, enable_display,
-                                palette, enable_adafruit_io, aio_user_name, aio_household_prefix, enable_eco2_tvoc,
-                                outdoor_source_type, own_noise_level, own_noise_max, own_noise_max_datetime,
-                                own_noise_values, own_noise_freq_values, outdoor_noise_level, outdoor_noise_max,
-                                outdoor_noise_max_datetime, outdoor_noise_values, outdoor_noise_freq_values):
+def display_results(): # Only redraws graphs and the air quality summary when their readings have changed, the
+    # display mode has changed or the display has switched between indoor and outdoor readings
+    global last_page, mode, start_current_display, current_display_is_own, own_noise_max
     # Allow for display selection if display is enabled,
     # else only display the serial number on a background colour based on max_aqi
     if enable_display:
-        proximity = ltr559.get_proximity()
+        proximity = proximity_sensor.get_proximity()
         # If the proximity crosses the threshold, toggle the mode
-        if proximity > 1500 and time.time() - last_page > delay:
+        if proximity > 1500 and clock.time() - last_page > delay:
             mode += 1
             mode %= len(display_modes)
             print('Mode', mode)
-            last_page = time.time()
+            last_page = clock.time()
             display_changed = True
+            display_subscriber.mark_all_dirty()
         else:
             display_changed = False
         selected_display_mode = display_modes[mode]
         if enable_indoor_outdoor_functionality and indoor_outdoor_function == 'Indoor':
             if outdoor_reading_captured:
-                if ((time.time() -  start_current_display) > indoor_outdoor_display_duration):
+                if ((clock.time() -  start_current_display) > indoor_outdoor_display_duration):
                     current_display_is_own = not current_display_is_own
-                    start_current_display = time.time()
-            else:
+                    start_current_display = clock.time()
+                    display_subscriber.mark_all_dirty()
+            elif not current_display_is_own:
                 current_display_is_own = True
-        if selected_display_mode in own_data:
+                display_subscriber.mark_all_dirty()
+        if not display_changed and scheduler.shed('Display Frames'):
+            return # Drop this frame. The display subscriber keeps its dirty readings for the next frame
+        if selected_display_mode in own_data and not display_subscriber.changed([selected_display_mode]):
+            pass # The graph hasn't changed since it was last drawn
+        elif selected_display_mode == "All Air" and not display_subscriber.changed(data_in_display_all_aq):
+            pass
+        elif selected_display_mode in own_data:
             if current_display_is_own and indoor_outdoor_function == 'Indoor' or selected_display_mode == "Bar":
-                display_graphed_data('IN', own_disp_values, selected_display_mode, own_data[selected_display_mode],
-                                     WIDTH)
+                display_graphed_data('IN', own_disp_values, selected_display_mode, own_data, WIDTH)
             elif current_display_is_own and indoor_outdoor_function == 'Outdoor':
-                display_graphed_data('OUT', own_disp_values, selected_display_mode, own_data[selected_display_mode],
-                                     WIDTH)
+                display_graphed_data('OUT', own_disp_values, selected_display_mode, own_data, WIDTH)
             elif not current_display_is_own and (indoor_outdoor_function == 'Indoor'
                                                  and (selected_display_mode == "CO2"
                                                       or selected_display_mode == "VOC"
@@ -944,13 +1312,14 @@ def display_results(start_current_display, current_display_is_own, display_modes
                 # No outdoor Lux graphs when the outdoor source is Adafruit IO
                 # and no outdoor CO2 or TVOC graphs,
                 # so always display indoor graph
-                display_graphed_data('IN', own_disp_values, selected_display_mode, own_data[selected_display_mode],
-                                     WIDTH)
+                display_graphed_data('IN', own_disp_values, selected_display_mode, own_data, WIDTH)
             else:
-                display_graphed_data('OUT', outdoor_disp_values, selected_display_mode,
-                                     outdoor_data[selected_display_mode], WIDTH)
+                display_graphed_data('OUT', outdoor_disp_values, selected_display_mode, outdoor_data, WIDTH)
+        elif selected_display_mode == "PM Sizes":
+            if display_changed or display_subscriber.changed(["P2.5"]): # Updated with each PM reading
+                display_pm_sizes(indoor_outdoor_function, pm_size_distribution)
         elif selected_display_mode == "Forecast":
-            display_forecast(valid_barometer_history, forecast, barometer_available_time, own_data["Bar"][1],
+            display_forecast(valid_barometer_history, forecast, barometer_available_time, own_data.value("Bar"),
                              barometer_change)
         elif selected_display_mode == "Status":
             display_status(enable_adafruit_io, aio_user_name, aio_household_prefix)
@@ -988,10 +1357,10 @@ def display_results(start_current_display, current_display_is_own, display_modes
                 display_noise("Outdoor", selected_display_mode, outdoor_noise_level, outdoor_noise_max, outdoor_noise_max_datetime, display_changed, last_page, outdoor_noise_values, outdoor_noise_freq_values)
         else:
             pass
-    else:
+    elif display_subscriber.changed():
         disabled_display(gas_sensors_warm, air_quality_data, air_quality_data_no_gas, own_data, palette,
                          enable_adafruit_io, aio_user_name, aio_household_prefix)
-    return last_page, mode, start_current_display, current_display_is_own, own_noise_max
+    display_subscriber.clear()
 
 class ExternalSensors(object): # Handles the external temp/hum/bar sensors
     def __init__(self):
@@ -1001,7 +1370,7 @@ class ExternalSensors(object): # Handles the external temp/hum/bar sensors
         
     def capture_barometer(self, value):
         self.barometer = value[:-2] # Remove forecast data
-        self.barometer_update_time = time.time()
+        self.barometer_update_time = clock.time()
         #self.print_update('External Barometer ' + self.barometer + ' Pa')
 
     def capture_temp_humidity(self, parsed_json):
@@ -1009,7 +1378,7 @@ class ExternalSensors(object): # Handles the external temp/hum/bar sensors
         #self.print_update('External Temperature ' + self.temperature + ' degrees C')
         self.humidity = parsed_json['svalue2']+'.00'
         #self.print_update('External Humidity ' + self.humidity + '%')
-        self.temp_humidity_update_time = time.time()
+        self.temp_humidity_update_time = clock.time()
         
     def check_valid_readings(self, check_time):
         if check_time - self.barometer_update_time < 500:
@@ -1023,12 +1392,12 @@ class ExternalSensors(object): # Handles the external temp/hum/bar sensors
         return valid_temp_humidity_reading, valid_barometer_reading
 
     def print_update(self, message):
-        today = datetime.now()
+        today = clock.now()
         print('')
         print(message + ' on ' + today.strftime('%A %d %B %Y @ %H:%M:%S'))
         
 def log_barometer(barometer, barometer_history): # Logs 3 hours of barometer readings, taken every 20 minutes
-    barometer_log_time = time.time()
+    barometer_log_time = clock.time()
     three_hour_barometer=barometer_history[8] # Capture barometer reading from 3 hours ago
     for pointer in range (8, 0, -1): # Move previous temperatures one position in the list to prepare
         # for new temperature to be recorded
@@ -1245,7 +1614,7 @@ def sun_moon_time(city_name, time_zone):
     city = lookup(city_name, db)
     # Datetime objects for yesterday, today, tomorrow
     utc = pytz.utc
-    utc_dt = datetime.now(tz=utc)
+    utc_dt = clock.now(tz=utc)
     local_dt = utc_dt.astimezone(pytz.timezone(time_zone))
     today = local_dt.date()
     yesterday = today - timedelta(1)
@@ -1360,11 +1729,11 @@ def display_icon_weather_aqi(location, data, barometer_trend, icon_forecast, max
     # Time.
     date_string = local_dt.strftime("%d %b %y").lstrip('0')
     time_string = local_dt.strftime("%H:%M") + '  ' + location
-    img = overlay_text(background, (0 + margin, 0 + margin), time_string, font_smm)
-    img = overlay_text(img, (WIDTH - margin, 0 + margin), date_string, font_smm, align_right=True)
-    temp_string = f"{data['Temp'][1]:.1f}°C"
-    img = overlay_text(img, (78, 18), temp_string, font_smm, align_right=True)
-    spacing = font_smm.getbbox(temp_string)[3] + 1
+    img = overlay_text(background, (0 + margin, 0 + margin), time_string, get_font(font_size_smm))
+    img = overlay_text(img, (WIDTH - margin, 0 + margin), date_string, get_font(font_size_smm), align_right=True)
+    temp_string = f"{data.value('Temp'):.1f}°C"
+    img = overlay_text(img, (78, 18), temp_string, get_font(font_size_smm), align_right=True)
+    spacing = get_font(font_size_smm).getbbox(temp_string)[3] + 1
     if mini_temp is not None and maxi_temp is not None:
         if maxi_temp >= 0:
             range_string = f"{round(mini_temp, 0):.0f} to {round(maxi_temp, 0):.0f}"
@@ -1372,36 +1741,36 @@ def display_icon_weather_aqi(location, data, barometer_trend, icon_forecast, max
             range_string = f"{round(mini_temp, 0):.0f} to{round(maxi_temp, 0):.0f}"
     else:
         range_string = "------"
-    img = overlay_text(img, (78, 18 + spacing), range_string, font_sm, align_right=True, rectangle=True)
+    img = overlay_text(img, (78, 18 + spacing), range_string, get_font(font_size_sm), align_right=True, rectangle=True)
     temp_icon = Image.open(path + "/icons/temperature.png")
     img.paste(temp_icon, (margin, 23), mask=temp_icon)
     # Humidity
-    corr_humidity = data["Hum"][1]
+    corr_humidity = data.value("Hum")
     humidity_string = f"{corr_humidity:.1f}%"
-    img = overlay_text(img, (73, 48), humidity_string, font_smm, align_right=True)
+    img = overlay_text(img, (73, 48), humidity_string, get_font(font_size_smm), align_right=True)
     # Dewpoint
-    spacing = font_smm.getbbox(humidity_string)[3] + 1
-    dewpoint_data = data["Dew"][1]
+    spacing = get_font(font_size_smm).getbbox(humidity_string)[3] + 1
+    dewpoint_data = data.value("Dew")
     dewpoint_string = f"{dewpoint_data:.1f}°C"
-    comfort_desc = describe_dewpoint(data["Dew"][1]).upper()
-    img = overlay_text(img, (68, 48 + spacing), dewpoint_string, font_sm, align_right=True, rectangle=True)
+    comfort_desc = describe_dewpoint(data.value("Dew")).upper()
+    img = overlay_text(img, (68, 48 + spacing), dewpoint_string, get_font(font_size_sm), align_right=True, rectangle=True)
     comfort_icon = Image.open(path + "/icons/humidity-" + comfort_desc.lower() + ".png")
     img.paste(comfort_icon, (margin, 53), mask=comfort_icon)
     # AQI
     aqi_string = f"{max_aqi[1]}: {max_aqi[0]}"
-    img = overlay_text(img, (WIDTH - margin, 18), aqi_string, font_smm, align_right=True)
-    spacing = font_smm.getbbox(aqi_string)[3] + 1
+    img = overlay_text(img, (WIDTH - margin, 18), aqi_string, get_font(font_size_smm), align_right=True)
+    spacing = get_font(font_size_smm).getbbox(aqi_string)[3] + 1
     aqi_desc = icon_air_quality_levels[max_aqi[1]].upper()
-    img = overlay_text(img, (WIDTH - margin - 1, 18 + spacing), aqi_desc, font_sm, align_right=True, rectangle=True)
+    img = overlay_text(img, (WIDTH - margin - 1, 18 + spacing), aqi_desc, get_font(font_size_sm), align_right=True, rectangle=True)
     aqi_icon = Image.open(path + "/icons/aqi.png")
     img.paste(aqi_icon, (85, 23), mask=aqi_icon)
     # Pressure
-    pressure = data["Bar"][1]
+    pressure = data.value("Bar")
     pressure_string = f"{int(pressure)} {barometer_trend}"
-    img = overlay_text(img, (WIDTH - margin, 48), pressure_string, font_smm, align_right=True)
+    img = overlay_text(img, (WIDTH - margin, 48), pressure_string, get_font(font_size_smm), align_right=True)
     pressure_desc = icon_forecast.upper()
-    spacing = font_smm.getbbox(pressure_string)[3] + 1
-    img = overlay_text(img, (WIDTH - margin - 1, 48 + spacing), pressure_desc, font_sm, align_right=True, rectangle=True)
+    spacing = get_font(font_size_smm).getbbox(pressure_string)[3] + 1
+    img = overlay_text(img, (WIDTH - margin - 1, 48 + spacing), pressure_desc, get_font(font_size_sm), align_right=True, rectangle=True)
     pressure_icon = Image.open(path + "/icons/weather-" + pressure_desc.lower() +  ".png")
     img.paste(pressure_icon, (80, 53), mask=pressure_icon)
     # Noise Level
@@ -1583,8 +1952,14 @@ def capture_external_outdoor_data(outdoor_source_type, outdoor_source_id, outdoo
 def process_noise_frames(captured_recording, frames, time, status):
     global recording
     global noise_sample_counter
-    recording = captured_recording
     noise_sample_counter += 1
+    heartbeats.beat('Audio')
+    if noise_worker_process is not None: # Multi-process mode. Hand the block to the noise DSP process
+        audio_block.write(captured_recording.tobytes())
+        noise_worker_sender.send_bytes(b'')
+    else:
+        recording = captured_recording.copy() # sounddevice reuses its buffer after the callback returns
+        notify_main_loop(noise_sample_event)
       
 def ABC_weighting(curve='A'):
     """
@@ -1685,6 +2060,19 @@ def get_rms_at_frequency_ranges(recording, ranges, noise_sample_rate):
         result.append(np.sqrt(np.mean(magnitude[start:end])))
     return result
 
+def analyse_noise(recording, frequency_bands=True): # Returns the A-weighted RMS level and the RMS levels of the
+    # low, mid and high frequency bands of an audio block. The bands are None if frequency_bands is False
+    recording_offset = np.mean(recording)
+    noise_recording = recording - recording_offset # Remove remaining microphone DC Offset
+    weighted_recording = A_weight(noise_recording, noise_sample_rate)
+    weighted_rms = np.sqrt(np.mean(np.square(weighted_recording)))
+    if frequency_bands:
+        amps = get_rms_at_frequency_ranges(weighted_recording, [(20, 500), (500, 2000), (2000, 20000)],
+                                           noise_sample_rate)
+    else:
+        amps = None
+    return weighted_rms, amps
+
 class NullContextManager(object): # Dummy context manager that's used when noise is disabled
     def __init__(self, dummy_resource=None):
         self.dummy_resource = dummy_resource
@@ -1693,6 +2081,258 @@ class NullContextManager(object): # Dummy context manager that's used when noise
     def __exit__(self, *args):
         pass
 
+class MonitorScheduler(object): # Runs each monitor duty as its own asyncio task, timed by the event loop's
+    # monotonic clock, and records how late each duty started relative to its deadline
+    shed_priorities = ['Noise Frequencies', 'Display Frames', 'Persistence'] # Optional work, in the order that it's
+    # shed when the duties fall behind
+
+    def __init__(self, shedding_budget=0.1):
+        self.duties = []
+        self.jitter = {}
+        self.shedding_budget = shedding_budget # Smoothed lateness that the duties can run at before optional work is
+        # shed. Each further multiple of the budget sheds the next priority
+        self.lag = 0 # Smoothed lateness of the periodic duties
+        self.shed_level = 0 # Number of the shed_priorities currently being shed
+        self.shed_counts = {work: 0 for work in self.shed_priorities}
+        self.running_duties = None
+        self.stopped = False
+        self.deadlines = {} # The next deadline and the interval of each periodic duty, in event loop time
+
+    def add_periodic(self, name, interval, duty, first_delay=0):
+        # A duty can return a number of seconds to override the delay until its next run
+        self.duties.append((self.run_periodic, name, interval, duty, first_delay))
+        self.jitter[name] = {'Runs': 0, 'Mean': 0, 'Max': 0}
+
+    def add_task(self, name, duty):
+        # One-off duties, such as bringing up slow devices, run once as soon as the scheduler starts
+        self.duties.append((self.run_once, name, duty))
+        self.jitter[name] = {'Runs': 0}
+
+    def add_event(self, name, event, duty):
+        # Event-driven duties run once each time their asyncio.Event is set
+        self.duties.append((self.run_on_event, name, event, duty))
+        self.jitter[name] = {'Runs': 0}
+
+    async def run_duty(self, duty):
+        result = duty()
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def record_jitter(self, name, lateness):
+        stats = self.jitter[name]
+        stats['Runs'] += 1
+        stats['Mean'] += (lateness - stats['Mean']) / stats['Runs']
+        if lateness > stats['Max']:
+            stats['Max'] = lateness
+        self.lag += (lateness - self.lag) * 0.1
+        # Shed more work when the lag exceeds the next multiple of the budget and less when it falls below half of
+        # the current one, so that the level doesn't flap
+        if self.shed_level < len(self.shed_priorities) and self.lag > self.shedding_budget * (self.shed_level + 1):
+            self.shed_level += 1
+            print('Load Shedding Level Raised to', self.shed_level, 'Lag:', round(self.lag * 1000, 1), 'ms')
+        elif self.shed_level > 0 and self.lag < self.shedding_budget * self.shed_level / 2:
+            self.shed_level -= 1
+            print('Load Shedding Level Lowered to', self.shed_level, 'Lag:', round(self.lag * 1000, 1), 'ms')
+
+    def next_run_after(self, names, earliest): # The event loop time of the first run of any of the named periodic
+        # duties at or after earliest, assuming that they keep their cadence. None if none of them are running
+        run_times = []
+        for name in names:
+            if name in self.deadlines:
+                deadline, interval = self.deadlines[name]
+                if deadline < earliest and interval > 0:
+                    deadline += math.ceil((earliest - deadline) / interval) * interval
+                run_times.append(deadline)
+        if run_times == []:
+            return None
+        return min(run_times)
+
+    def shed(self, work): # True if the named optional work should be skipped this time. Sensor sampling and audio
+        # capture are never shed
+        if self.shed_level > self.shed_priorities.index(work):
+            self.shed_counts[work] += 1
+            return True
+        return False
+
+    def shedding_summary(self):
+        summary = {'Level': self.shed_level, 'Lag': round(self.lag * 1000, 1)}
+        summary.update(self.shed_counts)
+        return summary
+
+    async def run_periodic(self, name, interval, duty, first_delay):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + first_delay
+        while True:
+            self.deadlines[name] = (deadline, interval)
+            await asyncio.sleep(max(0, deadline - loop.time())) # Still yields to other duties when already due
+            self.record_jitter(name, loop.time() - deadline)
+            next_delay = await self.run_duty(duty)
+            if next_delay is not None:
+                deadline = loop.time() + next_delay
+            else:
+                deadline += interval # Keep a fixed cadence rather than drifting by each duty's run time
+                if deadline < loop.time(): # Don't try to catch up on missed runs
+                    deadline = loop.time()
+
+    async def run_once(self, name, duty):
+        self.jitter[name]['Runs'] += 1
+        await self.run_duty(duty)
+
+    async def run_on_event(self, name, event, duty):
+        while True:
+            await event.wait()
+            event.clear()
+            self.jitter[name]['Runs'] += 1
+            await self.run_duty(duty)
+
+    def jitter_summary(self): # Mean and max lateness in milliseconds for each periodic duty
+        summary = {}
+        for name in self.jitter:
+            if 'Mean' in self.jitter[name]:
+                summary[name] = {'Runs': self.jitter[name]['Runs'], 'Mean': round(self.jitter[name]['Mean'] * 1000, 1),
+                                 'Max': round(self.jitter[name]['Max'] * 1000, 1)}
+            else:
+                summary[name] = {'Runs': self.jitter[name]['Runs']}
+        return summary
+
+    async def run(self, run_duration=None): # Runs until stopped if no run_duration is given
+        self.running_duties = asyncio.gather(*[duty[0](*duty[1:]) for duty in self.duties])
+        try:
+            if run_duration is None:
+                await self.running_duties
+            else:
+                await asyncio.wait_for(self.running_duties, run_duration)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if not self.stopped:
+                raise
+
+    def stop(self): # Cancels all the duties, so that run returns
+        self.stopped = True
+        if self.running_duties is not None:
+            self.running_duties.cancel()
+
+main_loop = None # Set when the monitor's event loop starts
+noise_sample_event = None # Set by the noise stream callback when a new sample is available
+outdoor_data_event = None # Set by the mqtt thread when paired outdoor unit data is received
+
+async def run_blocking(function, *args): # Runs blocking serial and network calls in an executor thread. With a
+    # simulated clock, they're run inline so that the clock can't jump ahead while they're in progress, and then
+    # their simulated duration is awaited as if they had run in a thread
+    if clock.simulated:
+        result, call_duration = clock.run_concurrently(function, *args)
+        await asyncio.sleep(call_duration)
+        return result
+    return await main_loop.run_in_executor(None, function, *args)
+
+def notify_main_loop(event): # Thread-safe wake up of an event-driven duty from the noise or mqtt threads
+    if main_loop is not None and event is not None and not main_loop.is_closed():
+        main_loop.call_soon_threadsafe(event.set)
+
+Reading = collections.namedtuple('Reading', ['name', 'value', 'time']) # A timestamped reading on the readings bus
+
+class ReadingsSubscriber(object): # Receives the readings that a consumer uses and flags those that have changed,
+    # so that the consumer can skip work when nothing it uses has changed since it last ran
+    def __init__(self, names, on_reading=None):
+        self.names = set(names)
+        self.on_reading = on_reading # Optional callback for each reading
+        self.dirty = set()
+        self.all_dirty = False
+
+    def receive(self, reading):
+        self.dirty.add(reading.name)
+        if self.on_reading is not None:
+            self.on_reading(reading)
+
+    def changed(self, names=None): # True if any of the given readings (or any reading) have changed
+        if self.all_dirty:
+            return True
+        if names is None:
+            return self.dirty != set()
+        return not self.dirty.isdisjoint(names)
+
+    def mark_all_dirty(self): # Used when the consumer's output needs to be refreshed without a new reading
+        self.all_dirty = True
+
+    def clear(self):
+        self.dirty.clear()
+        self.all_dirty = False
+
+class ReadingsBus(object): # In-process publish/subscribe bus for sensor readings. Each reading is published once and
+    # delivered to every subscriber that uses it
+    def __init__(self, clock):
+        self.clock = clock
+        self.subscribers = {} # Subscribers by reading name
+        self.latest = {} # Latest Reading by name
+
+    def subscribe(self, subscriber):
+        for name in subscriber.names:
+            self.subscribers.setdefault(name, []).append(subscriber)
+        return subscriber
+
+    def publish(self, name, value):
+        reading = Reading(name, value, self.clock.time())
+        self.latest[name] = reading
+        for subscriber in self.subscribers.get(name, []):
+            subscriber.receive(reading)
+
+    def value(self, name, default=None):
+        if name in self.latest:
+            return self.latest[name].value
+        return default
+
+class AdaptiveSampler(object): # Stretches an outdoor unit's PM and climate read intervals while the recent PM,
+    # temperature and pressure readings are stable, and snaps them back to full rate as soon as one of them changes
+    def __init__(self, settings, enable_particle_sensor, pm_frame_interval, climate_base_interval): # The full rate
+        # read intervals
+        self.enable_particle_sensor = enable_particle_sensor
+        self.pm_frame_interval = pm_frame_interval
+        self.climate_base_interval = climate_base_interval
+        self.thresholds = {"P2.5": 1.0, "Temp": 0.2, "Bar": 0.2} # Standard deviations below which readings are stable
+        if "Thresholds" in settings:
+            self.thresholds.update(settings["Thresholds"])
+        if not enable_particle_sensor:
+            del self.thresholds["P2.5"]
+        if "Window" in settings: # Number of readings of each type that have to be stable before the intervals stretch
+            self.window = settings["Window"]
+        else:
+            self.window = 6
+        if "Max PM Interval" in settings:
+            self.max_pm_interval = settings["Max PM Interval"]
+        else:
+            self.max_pm_interval = 30
+        if "Max Climate Interval" in settings:
+            self.max_climate_interval = settings["Max Climate Interval"]
+        else:
+            self.max_climate_interval = 600
+        self.history = {name: collections.deque(maxlen=self.window) for name in self.thresholds}
+        self.stretch = 1 # Multiple of the full rate read intervals
+
+    def update(self, reading): # ReadingsSubscriber callback
+        history = self.history[reading.name]
+        threshold = self.thresholds[reading.name]
+        if len(history) >= 2 and abs(reading.value - statistics.mean(history)) > 3 * threshold:
+            if self.stretch > 1:
+                print('Adaptive Sampling Back to Full Rate.', reading.name, 'Changed to', reading.value)
+            self.stretch = 1
+        history.append(reading.value)
+        if all(len(self.history[name]) == self.window and statistics.pstdev(self.history[name]) <= self.thresholds[name]
+               for name in self.history):
+            if ((self.enable_particle_sensor and self.pm_interval() < self.max_pm_interval) or
+                    self.climate_interval() < self.max_climate_interval): # Stop stretching once both are capped
+                self.stretch *= 2
+                print('Adaptive Sampling Intervals Stretched by a Factor of', self.stretch)
+            for name in self.history: # Require a new window of stable readings at the new rate before stretching again
+                self.history[name].clear()
+
+    def pm_interval(self): # Time between PMS5003 reads
+        return min(self.pm_frame_interval * self.stretch, self.max_pm_interval)
+
+    def climate_interval(self): # Time between climate and gas reads
+        return min(self.climate_base_interval * self.stretch, self.max_climate_interval)
+
 # Display setup
 delay = 0.5 # Debounce the proximity tap when choosing the data to be displayed
 mode = 0 # The starting mode for the data display
@@ -1715,12 +2355,14 @@ font_size_smm = 14
 font_size_medium = 16
 font_size_ml = 18
 font_size_large = 20
-smallfont = ImageFont.truetype(UserFont, font_size_small)
-font_sm = ImageFont.truetype(UserFont, font_size_sm)
-font_smm = ImageFont.truetype(UserFont, font_size_smm)
-mediumfont = ImageFont.truetype(UserFont, font_size_medium)
-font_ml = ImageFont.truetype(UserFont, font_size_ml)
-largefont = ImageFont.truetype(UserFont, font_size_large)
+font_cache = {} # TrueType fonts by size. Each one is loaded when it's first drawn with
+
+def get_font(size):
+    if size not in font_cache:
+        from fonts.ttf import RobotoMedium as UserFont
+        font_cache[size] = ImageFont.truetype(UserFont, size)
+    return font_cache[size]
+
 message = ""
 
 # Set up icon display
@@ -1734,16 +2376,87 @@ sun_radius = 20
 # Margins
 margin = 3
 
-# Create own_data dict to store the data to be displayed in Display Everything
-# Format: {Display Item: [Units, Current Value, [Level Thresholds], display_all_aq position]}
-if enable_eco2_tvoc: # eCO2 and TVOC added when enabling the SGP30 sensor
-    own_data = {"P1": ["ug/m3", 0, [6,17,27,35], 0], "P2.5": ["ug/m3", 0, [11,35,53,70], 1],
-                "P10": ["ug/m3", 0, [16,50,75,100], 2], "Oxi": ["ppm", 0, [0.2, 0.4, 0.8, 1], 3],
-                "Red": ["ppm", 0, [6, 10, 50, 75], 4], "NH3": ["ppm", 0, [1, 2, 10, 15], 5],
-                "CO2": ["ppm", 0, [500, 1000, 1600, 2000], 6], "VOC": ["ppb", 0, [120, 220, 660, 2200], 7],
-                "Temp": ["C", 0, [10,18,25,32], 8], "Hum": ["%", 0, [30,50,75,90], 9],
-                "Dew": ["C", 0, [10,15,20,24], 10], "Bar": ["hPa", 0, [980,990,1030,1040], 11],
-                "Lux": ["Lux", 1, [100,1000,12000,30000], 12]}
+class Metric(object): # Metadata for a displayed reading. Its value, level thresholds and validity are held in the
+    # registry's arrays at its index
+    __slots__ = ('name', 'unit', 'index')
+
+    def __init__(self, name, unit, index):
+        self.name = name
+        self.unit = unit
+        self.index = index
+
+class MetricRegistry(object): # The current values, level thresholds and validity of the displayed readings, compiled
+    # from metric_definitions into index-addressed arrays so that air quality levels and display colours can be
+    # worked out for all the readings at once
+    def __init__(self, definitions):
+        self.names = [definition[0] for definition in definitions]
+        self.metrics = {name: Metric(name, unit, index) for index, (name, unit, thresholds, initial_value)
+                        in enumerate(definitions)}
+        self.values = np.array([definition[3] for definition in definitions], dtype=float)
+        self.thresholds = np.array([definition[2] for definition in definitions], dtype=float)
+        self.valid = np.ones(len(definitions), dtype=bool) # False for readings that aren't available
+        self.index_cache = {} # Index arrays for lists of reading names
+
+    def __contains__(self, name):
+        return name in self.metrics
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def indices(self, names):
+        key = tuple(names)
+        if key not in self.index_cache:
+            self.index_cache[key] = np.array([self.metrics[name].index for name in names], dtype=int)
+        return self.index_cache[key]
+
+    def unit(self, name):
+        return self.metrics[name].unit
+
+    def value(self, name): # None if the reading isn't available
+        index = self.metrics[name].index
+        if self.valid[index]:
+            return self.values[index].item()
+        return None
+
+    def set_value(self, name, value):
+        index = self.metrics[name].index
+        if value is None:
+            self.valid[index] = False
+        else:
+            self.values[index] = value
+            self.valid[index] = True
+
+    def levels(self): # Air quality level of each reading, from 0 to the number of thresholds. 0 if it's not available
+        return np.sum(self.values[:, np.newaxis] > self.thresholds, axis=1) * self.valid
+
+    def levels_of(self, name, values): # Air quality levels of a series of values of a reading
+        return np.searchsorted(self.thresholds[self.metrics[name].index], values, side='left')
+
+    def max_level(self, names): # [Reading, Level] of the first of the named readings with the highest level, or
+        # ['All', 0] if they're all at level 0
+        indices = self.indices(names)
+        levels = self.levels()[indices]
+        highest = int(np.argmax(levels))
+        if levels[highest] == 0:
+            return ['All', 0]
+        return [names[highest], int(levels[highest])]
+
+# The readings to be displayed, in their display_all_aq order
+# Format: [Display Item, Units, [Level Thresholds], Initial Value]
+metric_definitions = [["P1", "ug/m3", [6,17,27,35], 0], ["P2.5", "ug/m3", [11,35,53,70], 0],
+                      ["P10", "ug/m3", [16,50,75,100], 0], ["Oxi", "ppm", [0.2, 0.4, 0.8, 1], 0],
+                      ["Red", "ppm", [6, 10, 50, 75], 0], ["NH3", "ppm", [1, 2, 10, 15], 0],
+                      ["CO2", "ppm", [500, 1000, 1600, 2000], 0], ["VOC", "ppb", [120, 220, 660, 2200], 0],
+                      ["Temp", "C", [10,18,25,32], 0], ["Hum", "%", [30,50,75,90], 0],
+                      ["Dew", "C", [10,15,20,24], 0], ["Bar", "hPa", [980,990,1030,1040], 0],
+                      ["Lux", "Lux", [100,1000,12000,30000], 1]]
+if not enable_eco2_tvoc: # eCO2 and TVOC are only displayed when the SGP30 sensor is enabled
+    metric_definitions = [definition for definition in metric_definitions if definition[0] not in ["CO2", "VOC"]]
+own_data = MetricRegistry(metric_definitions)
+if enable_eco2_tvoc:
     data_in_display_all_aq =  ["P1", "P2.5", "P10", "Oxi", "Red", "NH3", "CO2", "VOC"]
     # Defines the order in which display modes are chosen
     if enable_noise:
@@ -1753,12 +2466,6 @@ if enable_eco2_tvoc: # eCO2 and TVOC added when enabling the SGP30 sensor
         display_modes = ["Icon Weather", "All Air", "P1", "P2.5", "P10", "Oxi", "Red", "NH3", "CO2", "VOC",
                      "Forecast", "Temp", "Hum", "Dew", "Bar", "Lux", "Status"]
 else:
-    own_data = {"P1": ["ug/m3", 0, [6,17,27,35], 0], "P2.5": ["ug/m3", 0, [11,35,53,70], 1],
-                "P10": ["ug/m3", 0, [16,50,75,100], 2], "Oxi": ["ppm", 0, [0.2, 0.4, 0.8, 1], 3],
-                "Red": ["ppm", 0, [6, 10, 50, 75], 4], "NH3": ["ppm", 0, [1, 2, 10, 15], 5],
-                "Temp": ["C", 0, [10,18,25,32], 6], "Hum": ["%", 0, [30,50,75,90], 7],
-                "Dew": ["C", 0, [10,15,20,24], 8], "Bar": ["hPa", 0, [980,990,1030,1040], 9],
-                "Lux": ["Lux", 1, [100,1000,12000,30000], 10]}
     data_in_display_all_aq =  ["P1", "P2.5", "P10", "Oxi", "Red", "NH3"]
     # Defines the order in which display modes are chosen
     if enable_noise:
@@ -1768,6 +2475,9 @@ else:
         display_modes = ["Icon Weather", "All Air", "P1", "P2.5", "P10", "Oxi", "Red", "NH3", "CO2", "VOC",
                      "Forecast", "Temp", "Hum", "Dew", "Bar", "Lux", "Status"]
 
+if enable_particle_sensor: # Particle count size distribution, after the PM graphs
+    display_modes.insert(display_modes.index("P10") + 1, "PM Sizes")
+
 # Set up display graph data
 own_disp_values = {}
 for v in own_data:
@@ -1775,21 +2485,7 @@ for v in own_data:
                    
 if enable_indoor_outdoor_functionality and indoor_outdoor_function == 'Indoor': # Prepare outdoor data, if it's required
     captured_outdoor_data = {}
-    if enable_eco2_tvoc:
-        outdoor_data = {"P1": ["ug/m3", 0, [6,17,27,35], 0], "P2.5": ["ug/m3", 0, [11,35,53,70], 1],
-                        "P10": ["ug/m3", 0, [16,50,75,100], 2], "Oxi": ["ppm", 0, [0.2, 0.4, 0.8, 1], 3],
-                        "Red": ["ppm", 0, [6, 10, 50, 75], 4], "NH3": ["ppm", 0, [1, 2, 10, 15], 5],
-                        "CO2": ["ppm", 0, [500, 1000, 1600, 2000], 6], "VOC": ["ppb", 0, [120, 220, 660, 2200], 7],
-                        "Temp": ["C", 0, [10,18,25,32], 8], "Hum": ["%", 0, [30,50,75,90], 9],
-                        "Dew": ["C", 0, [10,15,20,24], 10], "Bar": ["hPa", 0, [980,990,1030,1040], 10],
-                        "Lux": ["Lux", 1, [100,1000,12000,30000], 11]}
-    else:
-        outdoor_data = {"P1": ["ug/m3", 0, [6,17,27,35], 0], "P2.5": ["ug/m3", 0, [11,35,53,70], 1],
-                        "P10": ["ug/m3", 0, [16,50,75,100], 2], "Oxi": ["ppm", 0, [0.2, 0.4, 0.8, 1], 3],
-                        "Red": ["ppm", 0, [6, 10, 50, 75], 4], "NH3": ["ppm", 0, [1, 2, 10, 15], 5],
-                        "Temp": ["C", 0, [10,18,25,32], 6], "Hum": ["%", 0, [30,50,75,90], 7],
-                        "Dew": ["C", 0, [10,15,20,24], 10], "Bar": ["hPa", 0, [980,990,1030,1040], 8],
-                        "Lux": ["Lux", 1, [100,1000,12000,30000], 9]}
+    outdoor_data = MetricRegistry(metric_definitions)
     # For graphing outdoor display data
     outdoor_disp_values = {}
     for v in outdoor_data:
@@ -1807,7 +2503,7 @@ else:
     air_quality_data = ["P1", "P2.5", "P10", "Oxi", "Red", "NH3"]
     air_quality_data_no_gas = ["P1", "P2.5", "P10"]
 current_display_is_own = True # Start with own display
-start_current_display = time.time()
+start_current_display = clock.time()
 indoor_outdoor_display_duration = 5 # Seconds for duration of indoor or outdoor display
 outdoor_reading_captured = False # Used to determine whether the outdoor display is ready
 outdoor_reading_captured_time = 0 # Used to determine the last time that an mqtt message was received from
@@ -1834,52 +2530,21 @@ palette = [(128,128,255),   # Very Low
            (255,165,0),     # High
            (255,0,0)]       # Very High
      
-# Compensation factors for temperature, humidity and air pressure
-if enable_display and not enable_eco2_tvoc: # Set temp and hum compensation when display is enabled (no weather
-    # protection cover in place) and no ECO2 or TVOC sensor is in place
-    # Cubic polynomial temp comp coefficients adjusted by config's temp_offset
-    comp_temp_cub_a = -0.0001
-    comp_temp_cub_b = 0.0037
-    comp_temp_cub_c = 1.00568
-    comp_temp_cub_d = -6.78291
-    comp_temp_cub_d = comp_temp_cub_d + temp_offset
-    # Quadratic polynomial hum comp coefficients
-    comp_hum_quad_a = -0.0032
-    comp_hum_quad_b = 1.6931
-    comp_hum_quad_c = 0.9391
-elif enable_display and enable_eco2_tvoc: # Set temp and hum compensation when display is enabled (no weather
-    # protection cover in place) and ECO2 or TVOC sensor is in place
-    comp_temp_cub_a = -0.00005
-    comp_temp_cub_b = 0.00563
-    comp_temp_cub_c = 0.76548
-    comp_temp_cub_d = -5.2795
-    comp_temp_cub_d = comp_temp_cub_d + temp_offset
-    # Quadratic polynomial hum comp coefficients
-    comp_hum_quad_a = -0.0047
-    comp_hum_quad_b = 2.1582
-    comp_hum_quad_c = -3.8446
-else: # Set temp and hum compensation when display is disabled (weather protection cover in place)
-    # Cubic polynomial temp comp coefficients adjusted by config's temp_offset
-    comp_temp_cub_a = 0.00033
-    comp_temp_cub_b = -0.03129
-    comp_temp_cub_c = 1.8736
-    comp_temp_cub_d = -14.82131
-    comp_temp_cub_d = comp_temp_cub_d + temp_offset
-    # Quadratic polynomial hum comp coefficients
-    comp_hum_quad_a = -0.0221
-    comp_hum_quad_b = 3.3824
-    comp_hum_quad_c = -25.8102
-
-# New Gas Comp Factors based on long term regression testing and proportion of RS
-red_temp_comp_factor = -0.015
-red_hum_comp_factor = 0.0125
-red_bar_comp_factor = -0.0053
-oxi_temp_comp_factor = -0.017
-oxi_hum_comp_factor = 0.0115
-oxi_bar_comp_factor = -0.0072
-nh3_temp_comp_factor = -0.02695
-nh3_hum_comp_factor = 0.0094
-nh3_bar_comp_factor = 0.003254
+# Compensation models for temperature, humidity and the gas sensors. The built-in variant is chosen by whether the
+# display is enabled (no weather protection cover in place) and whether an ECO2 or TVOC sensor is in place. The
+# config's temp_offset is added to the compensated temperature
+if enable_display and not enable_eco2_tvoc:
+    builtin_compensation_variant = 'Display'
+elif enable_display and enable_eco2_tvoc:
+    builtin_compensation_variant = 'Display SGP30'
+else:
+    builtin_compensation_variant = 'Weather Cover'
+try:
+    compensation = CompensationModels(compensation_models.get("Variant", builtin_compensation_variant),
+                                      compensation_models.get("File"))
+except (IOError, ValueError, KeyError, TypeError) as error: # Keeps the monitor running with the built-in models
+    print('Invalid Compensation Models. Using the Built-in Models.', repr(error))
+    compensation = CompensationModels(builtin_compensation_variant)
 
 luft_values = {} # To be sent to Luftdaten
 mqtt_values = {} # To be sent to Home Manager, outdoor to indoor unit communications and used for the Adafruit IO Feeds
@@ -1891,6 +2556,26 @@ mini_temp = None
 outdoor_maxi_temp = None
 outdoor_mini_temp = None
 
+# Set up the readings bus. Each reading is published once and each consumer subscribes to the readings that it uses
+readings_bus = ReadingsBus(clock)
+own_data_subscriber = readings_bus.subscribe(ReadingsSubscriber(list(own_data), record_own_reading))
+mqtt_subscriber = readings_bus.subscribe(ReadingsSubscriber(list(own_data) + ["Min Temp", "Max Temp", "Gas Calibrated"],
+                                                            record_mqtt_reading))
+luftdaten_subscriber = readings_bus.subscribe(ReadingsSubscriber(luftdaten_readings, record_luftdaten_reading))
+display_subscriber = readings_bus.subscribe(ReadingsSubscriber(list(own_data)))
+display_subscriber.mark_all_dirty() # Always draw the first display
+aio_subscriber = readings_bus.subscribe(ReadingsSubscriber(list(own_data)))
+climate_log_subscriber = readings_bus.subscribe(ReadingsSubscriber(climate_log_readings))
+# Each sink aggregates the PM and gas readings over its own reporting interval
+luftdaten_aggregator = IntervalAggregator({name: aggregated_readings[name] for name in luftdaten_readings
+                                           if name in aggregated_readings})
+mqtt_aggregator = IntervalAggregator(aggregated_readings)
+aio_aggregator = IntervalAggregator(aggregated_readings)
+for aggregator in (luftdaten_aggregator, mqtt_aggregator, aio_aggregator):
+    readings_bus.subscribe(ReadingsSubscriber(list(aggregator.decimal_places), aggregator.add))
+last_climate_read_time = 0
+pm_sampling_paused = False
+
 # Raspberry Pi ID to send to Luftdaten
 id = "raspi-" + get_serial_number()
 
@@ -1907,10 +2592,8 @@ if enable_send_data_to_homemanager or enable_receive_data_from_homemanager or (e
     client.on_message = on_message
     if mqtt_username and mqtt_password:
         client.username_pw_set(mqtt_username, mqtt_password)
-    try:
-        client.connect(mqtt_broker_name, 1883, 60)
-    except:
-        print('No mqtt Broker Connection')   
+    client.connect_async(mqtt_broker_name, 1883, 60) # Connects from the mqtt network thread, so that startup doesn't
+    # wait for the broker. The thread keeps retrying if the broker can't be reached
     client.loop_start()
   
 if enable_adafruit_io:
@@ -1993,24 +2676,24 @@ if enable_adafruit_io:
 # Set up comms error and failure flags
 luft_resp = True # Set to False when there is a Luftdaten comms error
 aio_resp = True # Set to False when there is an comms error on all Adafruit IO feeds
-successful_comms_time = time.time() # Used to record the latest time that comms was successful
-comms_failure_tolerance = 3600 # Adjust this to set the comms failure duration before a reboot via the watchdog
-# is triggered
+successful_comms_time = clock.time() # Used to record the latest time that comms was successful
+comms_failure_tolerance = 3600 # Adjust this to set the comms failure duration before the systemd watchdog stops
+# being kicked
 comms_failure = False # Set to True when there has been a comms failure on either Luftdaten and/or Adafruit IO,
 # depending on the enabled combination
     
 # Take one reading from each climate and gas sensor on start up to stabilise readings
-first_temperature_reading = bme280.get_temperature()
-first_humidity_reading = bme280.get_humidity()
-first_pressure_reading = bme280.get_pressure() * barometer_altitude_comp_factor(altitude, first_temperature_reading)
-use_external_temp_hum = False
-use_external_barometer = False
-first_light_reading = ltr559.get_lux()
-first_proximity_reading = ltr559.get_proximity()
-raw_red_rs, raw_oxi_rs, raw_nh3_rs = read_raw_gas()
+first_climate_sample = i2c_bus.call('BME280', bme280.read_sample)
+first_temperature_reading = first_climate_sample.temperature
+first_humidity_reading = first_climate_sample.humidity
+first_pressure_reading = first_climate_sample.pressure * barometer_altitude_comp_factor(altitude,
+                                                                                      first_temperature_reading)
+first_light_reading = i2c_bus.call('LTR559', ltr559.get_lux)
+first_proximity_reading = i2c_bus.call('LTR559', ltr559.get_proximity)
+first_gas_reading = read_raw_gas(i2c_bus.call('ADS1015', gas.read_all))
 
 # Set up startup gas sensors' R0 with no compensation (Compensation will be set up after warm up time)
-red_r0, oxi_r0, nh3_r0 = read_raw_gas()
+red_r0, oxi_r0, nh3_r0 = read_raw_gas(i2c_bus.call('ADS1015', gas.read_all))
 # Set up daily gas sensor calibration lists
 reds_r0 = []
 oxis_r0 = []
@@ -2026,7 +2709,9 @@ gas_calib_bar = round(first_pressure_reading, 1)
 gas_sensors_warm = False
 outdoor_gas_sensors_warm = False # Only used for an indoor unit when indoor/outdoor functionality is enabled
 mqtt_values["Gas Calibrated"] = False # Only set to true after the gas sensor warmup time has been completed
-gas_sensors_warmup_time = 6000
+gas_sensors_warmup_time = 6000 # The longest wait for the gas sensors' raw Rs drift to settle
+gas_warm_up_detector = GasWarmUpDetector(gas_warm_up)
+gas_baseline_tracker = GasBaselineTracker(gas_baseline) # Used for the daily R0 calibration
 gas_daily_r0_calibration_completed = False
 
 # Set up weather forecast
@@ -2042,16 +2727,33 @@ domoticz_forecast = '0'
 aio_forecast = 'question'
 
 # Set up times
-eco2_tvoc_update_time = 0 # Set the eCO2 and TVOC update time baseline
 eco2_tvoc_get_baseline_update_time = 0 # Set the eCO2 and TVOC get_baseline update time 
-short_update_time = 0 # Set the short update time baseline (for watchdog alive file and Luftdaten updates)
 short_update_delay = 150 # Time between short updates
 previous_aio_update_minute = None # Used to record the last minute that the aio feeds were updated
 long_update_time = 0 # Set the long update time baseline (for all other updates)
 long_update_delay = 300 # Time between long updates
 long_update_toggle = False # Allows external outdoor Luftdaten or Adafruit updates to be undertaken every second long-update cycle
 startup_stabilisation_time = 300 # Time to allow sensor stabilisation before sending external updates
-start_time = time.time()
+display_update_interval = 0.5 # Time between display updates (and proximity tap checks)
+if "Display Interval" in simulated_clock: # Allows long simulated runs to skip most display rendering
+    display_update_interval = simulated_clock["Display Interval"]
+comms_check_interval = 10 # Time between Luftdaten, Adafruit IO and outdoor sensor comms checks
+load_shedding_budget = 0.1 # Smoothed duty lateness above which noise frequency analysis, then display frames, then
+# persistence are shed
+max_persistence_deferrals = 3 # Number of long updates that persistence can be deferred before it's written anyway
+persistence_deferrals = 0
+handover_timeout = 240 # Time allowed for a new software version to take over before falling back to a restart
+watchdog_check_interval = 5 # Time between subsystem heartbeat checks. Halved systemd WatchdogSec if that's shorter
+pms5003_frame_interval = 1 # The PMS5003 sends a frame every second
+if adaptive_sampling != {} and indoor_outdoor_function == 'Outdoor' and not enable_display: # Only for outdoor units
+    # without a display, because the display's graphs need every reading
+    adaptive_sampler = AdaptiveSampler(adaptive_sampling, enable_particle_sensor, pms5003_frame_interval,
+                                       short_update_delay)
+    readings_bus.subscribe(ReadingsSubscriber(list(adaptive_sampler.thresholds), adaptive_sampler.update))
+else:
+    adaptive_sampler = None
+stalled_subsystems = []
+start_time = clock.time()
 barometer_available_time = start_time + 10945 # Initialise the time until a forecast is available (3 hours + the time
 # taken before the first climate reading)
 mqtt_values["Bar"] = [gas_calib_bar, domoticz_forecast]
@@ -2062,23 +2764,31 @@ path = os.path.dirname(os.path.realpath(__file__))
 # Set up outdoor aio readings dictionary and requests session
 outdoor_aio_readings = {"Temp": "-temperature", "Hum": "-humidity", "Dew": "-dewpoint", "P1": "-pm1", "P10": "-pm10", "P2.5": "-pm2-dot-5",
                         "Oxi": "-oxidising", "Red": "-reducing", "NH3": "-ammonia"}
-external_outdoor_data_session = requests.Session()
+if requests_required:
+    external_outdoor_data_session = requests.Session()
 
 if enable_eco2_tvoc: # Set up SGP30 if it's enabled
     eco2_tvoc_baseline = [] # Initialise tvoc_co2_baseline format: get - [eco2 value, tvoc value, time set] set
     # - [tvoc value, eco2 value]
     valid_eco2_tvoc_baseline = False
-    from sgp30 import SGP30
-    import sys
-    def crude_progress_bar():
-        sys.stdout.write('.')
-        sys.stdout.flush()
+    last_eco2_tvoc_time = None # The time of the last published SGP30 reading
+    sgp30_ready = False # Set once the SGP30 has warmed up and its baseline has been restored
     # Create an SGP30 instance
-    sgp30 = SGP30()
-    display_startup("Northcliff\nEnviro Monitor\nSensor Warmup\nPlease Wait")
-    print("SGP30 Sensor warming up, please wait...")
-    sgp30.start_measurement(crude_progress_bar)
-    sys.stdout.write('\n')
+    if sensor_trace.get("Mode") == 'Replay':
+        from Northcliff_Enviro_Monitor_Trace import ReplaySGP30
+        sgp30 = ReplaySGP30(trace_reader)
+    elif hardware_backend == 'Simulated':
+        from Northcliff_Enviro_Monitor_Simulation import SimulatedSGP30
+        sgp30 = SimulatedSGP30(simulated_environment)
+    else:
+        from sgp30 import SGP30
+        sgp30 = SGP30()
+    if sensor_trace.get("Mode") == 'Record':
+        from Northcliff_Enviro_Monitor_Trace import RecordingSGP30
+        sgp30 = RecordingSGP30(sgp30, trace_writer)
+    if handover_payload is None: # The SGP30 is still measuring after a process handover, so there's no warm up
+        display_startup("Northcliff\nEnviro Monitor\nSensor Warmup\nPlease Wait") # Shown until the first display
+        # update
 
 # Set up Noise Monitor
 own_noise_level = 0
@@ -2090,10 +2800,10 @@ own_noise_freq = [0, 0, 0] # Set up spl by frequency list
 noise_thresholds = (70, 90)
 own_noise_values = [[0,0] for i in range(26)]
 own_noise_freq_values = [[0,0,0,0] for i in range(8)]
-noise_vsmallfont = ImageFont.truetype(UserFont, 11)
-noise_smallfont = ImageFont.truetype(UserFont, 16)
-noise_mediumfont = ImageFont.truetype(UserFont, 24)
-noise_largefont = ImageFont.truetype(UserFont, 32)
+noise_font_size_vsmall = 11
+noise_font_size_small = 16
+noise_font_size_medium = 24
+noise_font_size_large = 32
 noise_back_colour = (0, 0, 0)
 outdoor_noise_level = 0
 outdoor_noise_max = 0
@@ -2109,13 +2819,41 @@ if enable_noise:
     recording = []
     global noise_sample_counter
     noise_sample_counter = 0
-    noise_previous_sample_count = 0
     noise_sample_rate = 48000
     noise_block_size = 12000
-    noise_stream = sd.InputStream(samplerate=noise_sample_rate, channels=1, blocksize = noise_block_size, device = "dmic_sv", callback=process_noise_frames)
+    noise_callback = process_noise_frames
+    if sensor_trace.get("Mode") == 'Record' and trace_writer.record_audio:
+        from Northcliff_Enviro_Monitor_Trace import recording_audio_callback
+        noise_callback = recording_audio_callback(trace_writer, process_noise_frames)
+    if sensor_trace.get("Mode") == 'Replay':
+        from Northcliff_Enviro_Monitor_Trace import ReplayInputStream
+        noise_stream = ReplayInputStream(trace_reader, noise_callback)
+    elif hardware_backend == 'Simulated':
+        from Northcliff_Enviro_Monitor_Simulation import SimulatedInputStream
+        noise_stream = SimulatedInputStream(simulated_environment, samplerate=noise_sample_rate, channels=1,
+                                            blocksize = noise_block_size, callback=noise_callback)
+    else:
+        noise_stream = sd.InputStream(samplerate=noise_sample_rate, channels=1, blocksize = noise_block_size, device = "dmic_sv", callback=noise_callback)
 else:
     noise_stream = NullContextManager() # Dummy Context Manager when noise is disabled
 
+# Storage Setup. When staging is enabled, the environment log writes are staged in tmpfs and flushed to the SD card
+# together. The persistent data log is always written straight through, so that it's still recent enough to be
+# restored after a power loss. Writes that were staged by a previous monitor are flushed now
+if "Directory" in storage_staging:
+    storage_staging_directory = storage_staging["Directory"]
+else:
+    storage_staging_directory = '/dev/shm/aqimonitor'
+if "Flush Interval" in storage_staging:
+    storage_flush_interval = storage_staging["Flush Interval"]
+else:
+    storage_flush_interval = 0 # Staging is opt-in
+storage_writer = StorageWriter(clock, storage_staging_directory, storage_flush_interval)
+recovered_writes = storage_writer.flush()
+if recovered_writes > 0:
+    print('Flushed', recovered_writes, 'Staged Writes Left by the Previous Monitor')
+atexit.register(storage_writer.flush)
+
 # Capture software and config versions. Used to determine if a mender code or config update has been sent.
 try:
     with open('<Your Mender Software Version File Location Here>', 'r') as f:
@@ -2193,456 +2931,1051 @@ if "eCO2 TVOC Baseline" in persistent_data_log and enable_eco2_tvoc: # Capture t
     # and eCO2 and TVOC are enabled
     eco2_tvoc_baseline = persistent_data_log["eCO2 TVOC Baseline"]
     if eco2_tvoc_baseline != []:
-        if time.time() - eco2_tvoc_baseline[2] < 6048000: # Only use the baseline if it has been populated in the
+        if clock.time() - eco2_tvoc_baseline[2] < 6048000: # Only use the baseline if it has been populated in the
             # persistent data file and was updated less than a week ago
-            valid_eco2_tvoc_baseline = True
-            print('Setting eCO2 and TVOC baseline. get_baseline:', eco2_tvoc_baseline[0:2], 'set_baseline:',
-                  eco2_tvoc_baseline[::-1][1:3])
-            sgp30.command('set_baseline', eco2_tvoc_baseline[::-1][1:3]) # Reverse the order. get_baseline is in
-            # the order of CO2, TVOC. set_baseline is TVOC, CO2 !Arghh!
+            valid_eco2_tvoc_baseline = True # The baseline is set once the SGP30 has warmed up
+if isinstance(persistent_data_log.get("Gas Baseline"), dict) and not reset_gas_sensor_calibration: # Capture the
+    # tracked gas sensor baseline. Days that have left its window are ignored, however old the log is. Baselines that
+    # were tracked from uncompensated Rs aren't restored
+    gas_baseline_tracker.restore(persistent_data_log["Gas Baseline"])
 if reset_gas_sensor_calibration: # Uses reset_gas_sensor_calibration in config to reset gas sensor calibration.
     #Assume that the gas sensors don't need a warmup time (but need to be stable) in this situation.
     print("Reset Gas Sensor Calibration")
     gas_sensors_warm = False
     gas_sensors_warmup_time = startup_stabilisation_time
 
-if enable_adafruit_io: # Send Version info to Adafruit IO
+version_text = None # Only sent with the Premium Adafruit IO packages
+if enable_adafruit_io: # Version info is sent to Adafruit IO once the main loop has started
     if aio_package == "Premium Plus" or aio_package == "Premium" or aio_package == "Premium Plus Noise" or aio_package == "Premium Noise":
         version_text = "Code: " + startup_mender_software_version + " Config: " + startup_mender_config_version
-        print("Sending Startup Versions to Adafruit IO", version_text)
-        feed_resp = send_data_to_aio(aio_version_text_format, version_text)
+
+# The live state that's handed over to a new software version. Includes everything in the persistent data log, as
+# well as the readings, the sensor warm up and calibration timing, and the data that's waiting to be uploaded
+handover_state_names = ["long_update_time", "barometer_log_time", "forecast", "barometer_available_time",
+                        "valid_barometer_history", "barometer_history", "barometer_change", "barometer_trend",
+                        "icon_forecast", "domoticz_forecast", "aio_forecast", "gas_sensors_warm", "gas_calib_temp",
+                        "gas_calib_hum", "gas_calib_bar", "gas_calib_temps", "gas_calib_hums", "gas_calib_bars",
+                        "gas_baseline_tracker", "red_r0", "oxi_r0", "nh3_r0", "reds_r0", "oxis_r0", "nh3s_r0",
+                        "gas_daily_r0_calibration_completed", "own_disp_values", "outdoor_disp_values", "maxi_temp",
+                        "mini_temp", "last_page", "mode", "own_noise_level", "own_noise_max", "own_noise_max_datetime",
+                        "own_noise_freq", "own_noise_values", "own_noise_freq_values", "outdoor_noise_level",
+                        "outdoor_noise_max", "outdoor_noise_max_datetime", "outdoor_noise_freq",
+                        "outdoor_noise_values", "outdoor_noise_freq_values", "eco2_tvoc_baseline",
+                        "valid_eco2_tvoc_baseline", "eco2_tvoc_get_baseline_update_time", "start_time", "own_data",
+                        "outdoor_data", "outdoor_reading_captured", "outdoor_reading_captured_time",
+                        "outdoor_maxi_temp", "outdoor_mini_temp", "outdoor_gas_sensors_warm", "captured_outdoor_data",
+                        "mqtt_values", "luft_values", "luft_noise_values", "aio_noise_values",
+                        "previous_aio_update_minute", "long_update_toggle", "luft_resp", "aio_resp",
+                        "successful_comms_time", "comms_failure"]
+if handover_payload is not None: # Continue from the outgoing monitor's live state
+    handover_state = pickle.loads(handover_payload)
+    readings_bus.latest.update(handover_state.pop("Readings"))
+    for registry_name in ("own_data", "outdoor_data"): # Only used if the metrics haven't been changed by the new
+        # software version or config
+        if registry_name in handover_state and (type(handover_state[registry_name]) != type(globals()[registry_name]) or
+                                                list(handover_state[registry_name]) != list(globals()[registry_name])):
+            print('Not Taking Over', registry_name, 'because its metrics have changed')
+            del handover_state[registry_name]
+    globals().update({name: handover_state[name] for name in handover_state if name in handover_state_names})
+    print("Live State Taken Over. Red R0:", round(red_r0, 0), "Oxi R0:", round(oxi_r0, 0), "NH3 R0:",
+          round(nh3_r0, 0), "Run Time:", round(clock.time() - start_time), "seconds")
 
 # Update the weather forecast, based on the data retrieved from the persistent data log
 mqtt_values["Forecast"] = {"Valid": valid_barometer_history, "3 Hour Change": round(barometer_change, 1),
                            "Forecast": forecast}
 
-# Main loop
-try:
-    with noise_stream:
+# Multi-process mode. Noise DSP and display rendering run in their own processes so that they can use the other CPU
+# cores and can't delay sensor acquisition. The processes exchange their latest state through shared memory
+noise_worker_process = None
+display_process = None
+display_errors = [0, ''] # Count and latest message of the errors to be shown by the display process
+noise_max_resets = 0 # Number of times that the display process has reset the max noise level
+display_state_names = ["own_data", "own_disp_values", "outdoor_data", "outdoor_disp_values", "outdoor_reading_captured",
+                       "valid_barometer_history", "forecast", "barometer_available_time", "barometer_change",
+                       "barometer_trend", "icon_forecast", "maxi_temp", "mini_temp", "outdoor_maxi_temp",
+                       "outdoor_mini_temp", "gas_sensors_warm", "outdoor_gas_sensors_warm", "own_noise_level",
+                       "own_noise_max", "own_noise_max_datetime", "own_noise_values", "own_noise_freq_values",
+                       "outdoor_noise_level", "outdoor_noise_max", "outdoor_noise_max_datetime", "outdoor_noise_values",
+                       "outdoor_noise_freq_values", "pm_size_distribution"] # The monitor state that's used by the
+# display
+if enable_multi_process and clock.simulated:
+    print('Multi-Process Mode is not available with a simulated clock. Running in a single process')
+    enable_multi_process = False
+if enable_multi_process:
+    try:
+        from Northcliff_Enviro_Monitor_Shared import SeqlockBlock
+    except ImportError: # multiprocessing.shared_memory needs Python 3.8 or later
+        print('Multi-Process Mode needs Python 3.8 or later. Running in a single process')
+        enable_multi_process = False
+if enable_multi_process:
+    import multiprocessing
+    import pickle
+    process_context = multiprocessing.get_context('fork')
+    monitor_state_block = SeqlockBlock(262144) # Written by the acquisition process
+    display_state_block = SeqlockBlock(4096) # Written by the display process
+    atexit.register(monitor_state_block.close)
+    atexit.register(display_state_block.close)
+    if enable_noise:
+        audio_block = SeqlockBlock(noise_block_size * 4) # float32 samples
+        noise_result_block = SeqlockBlock(32) # Weighted RMS and the three frequency band RMS levels
+        atexit.register(audio_block.close)
+        atexit.register(noise_result_block.close)
+        noise_worker_receiver, noise_worker_sender = process_context.Pipe(duplex=False)
+        noise_result_receiver, noise_result_sender = process_context.Pipe(duplex=False)
+        noise_result = None
+
+class SharedLTR559(object): # Multi-process mode. Gives the display process the proximity readings that are taken by
+    # the acquisition process, so that only one process uses the I2C bus
+    def __init__(self):
+        self.proximity = 0
+    def get_proximity(self):
+        return self.proximity
+
+def show_display_error(message):
+    global display_errors
+    if display_process is not None: # Multi-process mode. The display process shows the error
+        display_errors = [display_errors[0] + 1, message]
+    else:
+        display_error(message)
+        display_subscriber.mark_all_dirty() # Redraw over the error message on the next display update
+
+def run_noise_worker(): # Multi-process mode. Analyses the latest audio block each time that one arrives
+    try:
         while True:
-            if enable_noise:# Take noise sample on every loop if noise is enabled
-                if noise_sample_counter != noise_previous_sample_count: # Only process new sample
-                    noise_previous_sample_count = noise_sample_counter
-                    if noise_sample_counter > 10: # Wait for microphone stability
-                        recording_offset = np.mean(recording)
-                        recording = recording - recording_offset # Remove remaining microphone DC Offset
-                        weighted_recording = A_weight(recording, noise_sample_rate)
-                        weighted_rms = np.sqrt(np.mean(np.square(weighted_recording)))
-                        own_noise_ratio = (weighted_rms)/noise_ref_level
-                        new_noise_mqtt_value = False
-                        if own_noise_ratio > 0:
-                            noise_level = 20*math.log10(own_noise_ratio)
-                            own_noise_level = round(noise_level, 1)
-                            own_noise_values = own_noise_values[1:] + [[own_noise_level, 1]]
-                            # Capture Max, Luftdaten and Adafruit IO sound levels and once display has been changed for > 2 seconds
-                            if (time.time() - last_page) > 2:
-                                if enable_luftdaten and enable_luftdaten_noise:
-                                    luft_noise_values.append(round(noise_level, 2)) # Capture Luftdaten Noise Level
-                                if own_noise_level >= own_noise_max:
-                                    own_noise_max = own_noise_level
-                                    own_noise_max_event = datetime.now()
-                                    date_string = own_noise_max_event.strftime("%d %b %y").lstrip('0')
-                                    time_string = own_noise_max_event.strftime("%H:%M")
-                                    own_noise_max_datetime = {"Date": date_string, "Time": time_string}
-                                    mqtt_values["Max Noise"] = round(own_noise_max, 1)
-                                    mqtt_values["Max Noise Date Time"] = own_noise_max_datetime
-                                aio_noise_values.append(own_noise_level) # Capture Adafruit IO Noise Level
-                                if own_noise_level >= mqtt_values["Noise"]:
-                                    mqtt_values["Noise"] = round(own_noise_level, 1)
-                                    new_noise_mqtt_value = True
-                        amps = get_rms_at_frequency_ranges(weighted_recording, [(20, 500), (500, 2000), (2000, 20000)], noise_sample_rate)
-                        own_noise_ratio_freq = [n/noise_ref_level for n in amps]
-                        all_noise_ratio_freq_ok = True
-                        for noise_ratio in own_noise_ratio_freq: # Ensure that ratios are > 0
-                            if noise_ratio <= 0:
-                                all_noise_ratio_freq_ok = False
-                        if all_noise_ratio_freq_ok:
-                            for item in range(len(own_noise_ratio_freq)):
-                                own_noise_freq[item] = round(20*math.log10(own_noise_ratio_freq[item]), 1)
-                            if new_noise_mqtt_value:
-                                mqtt_values["Noise Freq"] = own_noise_freq
-                            own_noise_freq_values = own_noise_freq_values[1:] + [[own_noise_freq[0], own_noise_freq[1], own_noise_freq[2], 1]]
-            # Read air particle values on every loop
-            luft_values, mqtt_values, own_data, own_disp_values = read_pm_values(luft_values, mqtt_values, own_data,
-                                                                                 own_disp_values)
-            
-            # Read climate values, update Luftdaten and write to watchdog file every 2.5 minutes
-            # (set by short_update_time).
-            run_time = round((time.time() - start_time), 0)
-            time_since_short_update = time.time() - short_update_time
-            if time_since_short_update >= short_update_delay:
-                short_update_time = time.time()
-                # Calibrate gas sensors once after warmup
-                if ((time.time() - start_time) >= gas_sensors_warmup_time) and gas_sensors_warm == False and\
-                        first_climate_reading_done:
-                    gas_calib_temp = round(raw_temp, 1)
-                    gas_calib_hum = round(raw_hum, 1)
-                    gas_calib_bar = round(raw_barometer, 1)
-                    red_r0, oxi_r0, nh3_r0 = read_raw_gas()
-                    print("Gas Sensor Calibration after Warmup. Red R0:", red_r0, "Oxi R0:", oxi_r0, "NH3 R0:", nh3_r0)
-                    print("Gas Calibration Baseline. Temp:", gas_calib_temp, "Hum:", gas_calib_hum,
-                          "Barometer:", gas_calib_bar)
-                    reds_r0 = [red_r0] * 7
-                    oxis_r0 = [oxi_r0] * 7
-                    nh3s_r0 = [nh3_r0] * 7
-                    gas_calib_temps = [gas_calib_temp] * 7
-                    gas_calib_hums = [gas_calib_hum] * 7
-                    gas_calib_bars = [gas_calib_bar] * 7
-                    gas_sensors_warm = True               
-                (luft_values, mqtt_values, own_data, maxi_temp, mini_temp, own_disp_values, raw_red_rs, raw_oxi_rs,
-                 raw_nh3_rs, raw_temp, comp_temp, comp_hum, raw_hum, use_external_temp_hum, use_external_barometer,
-                 raw_barometer, absolute_hum) = read_climate_gas_values(luft_values, mqtt_values, own_data, maxi_temp,
-                                                                        mini_temp, own_disp_values, gas_sensors_warm,
-                                                                        gas_calib_temp, gas_calib_hum, gas_calib_bar,
-                                                                        altitude, enable_eco2_tvoc)
-                first_climate_reading_done = True
-                print('Luftdaten Values', luft_values)
-                print('mqtt Values', mqtt_values)
-                # Write to the watchdog file unless there is a comms failure for >= comms_failure_tolerance
-                # when both Luftdaten and Adafruit IO arenabled
-                if comms_failure == False:
-                    with open('<Your Watchdog File Name Here>', 'w') as f:
-                        f.write('Enviro Script Alive')
-                if enable_luftdaten: # Send data to Luftdaten if enabled
-                    luft_resp = send_to_luftdaten(luft_values, id, enable_particle_sensor, enable_noise, luft_noise_values, disable_luftdaten_sensor_upload)
-                    luft_noise_values = [] #Reset Luftdaten Noise Values List after each attempted transmission
-                    #logging.info("Luftdaten Response: {}\n".format("ok" if luft_resp else "failed"))
-                    data_sent_to_luftdaten_or_aio = True
-                    if luft_resp:
-                        print("Luftdaten update successful. Waiting for next capture cycle")
-                    else:
-                        print("Luftdaten update unsuccessful. Waiting for next capture cycle")
+            noise_worker_receiver.recv_bytes()
+            while noise_worker_receiver.poll(): # Skip to the latest block if the analysis has fallen behind
+                noise_worker_receiver.recv_bytes()
+            sequence, payload = audio_block.read()
+            weighted_rms, amps = analyse_noise(np.frombuffer(payload, dtype=np.float32).reshape(-1, 1))
+            noise_result_block.write(np.array([weighted_rms] + amps, dtype=np.float64).tobytes())
+            noise_result_sender.send_bytes(b'')
+    except (KeyboardInterrupt, EOFError):
+        pass
+
+def receive_noise_result(): # Multi-process mode. Called by the event loop when the noise DSP process has a result
+    global noise_result
+    while noise_result_receiver.poll():
+        noise_result_receiver.recv_bytes()
+    sequence, payload = noise_result_block.read()
+    noise_result = np.frombuffer(payload, dtype=np.float64)
+    noise_sample_event.set()
+
+def run_display_process(): # Multi-process mode. Renders the display from the latest monitor state
+    global proximity_sensor
+    proximity_sensor = SharedLTR559()
+    state_sequence = 0
+    error_count = 0
+    errors = [0, '']
+    noise_max_resets = 0
+    display_state = None
+    try:
+        while True:
+            if monitor_state_block.sequence_number() != state_sequence:
+                state_sequence, payload = monitor_state_block.read()
+                state = pickle.loads(payload)
+                proximity_sensor.proximity = state.pop("Proximity")
+                changed = state.pop("Changed")
+                errors = state.pop("Display Errors")
+                globals().update(state)
+                if changed is None:
+                    display_subscriber.mark_all_dirty()
                 else:
-                    print('Waiting for next capture cycle')
-
-            # Read TVOC and eCO2 every second
-            if enable_eco2_tvoc:
-                time_since_eco2_tvoc = time.time() - eco2_tvoc_update_time
-                if time_since_eco2_tvoc >= 1:
-                    eco2_tvoc_update_time = time.time()
-                    mqtt_values, own_data, own_disp_values = read_eco2_tvoc_values(mqtt_values, own_data, own_disp_values)    
-
-            # Read and update the barometer log if the first climate reading has been done and the last update was >=
-            # 20 minutes ago
-            if first_climate_reading_done and (time.time() - barometer_log_time) >= 1200:
-                if barometer_log_time == 0: # If this is the first barometer log, record the time that a forecast will be
-                    # available (3 hours)
-                    barometer_available_time = time.time() + 10800
-                barometer_history, barometer_change, valid_barometer_history, barometer_log_time, forecast,\
-                barometer_trend, icon_forecast, domoticz_forecast, aio_forecast = log_barometer(own_data['Bar'][1],
-                                                                                                barometer_history)
-                mqtt_values["Forecast"] = {"Valid": valid_barometer_history, "3 Hour Change": round(barometer_change, 1),
-                                           "Forecast": forecast.replace("\n", " ")}
-                mqtt_values["Bar"][1] = domoticz_forecast # Add Domoticz Weather Forecast
-                print('Barometer Logged. Waiting for next capture cycle')
-
-            # Process paired outdoor unit, if enabled
-            if (enable_indoor_outdoor_functionality and indoor_outdoor_function == 'Indoor'
-                    and outdoor_source_type == 'Enviro'):
-                if captured_outdoor_data != {}: #If there's new data
-                    for reading in outdoor_data: # Only capture data that's been sent
-                        if reading in captured_outdoor_data:
-                            if reading == "Bar" or reading == "Hum": # Barometer and Humidity readings have their
-                                # data in lists
-                                outdoor_data[reading][1] = captured_outdoor_data[reading][0]
-                            else:
-                                outdoor_data[reading][1] = captured_outdoor_data[reading]
-                            outdoor_disp_values[reading] = outdoor_disp_values[reading][1:] +\
-                                                           [[outdoor_data[reading][1], 1]]
-                    outdoor_maxi_temp = captured_outdoor_data["Max Temp"]
-                    outdoor_mini_temp = captured_outdoor_data["Min Temp"]
-                    outdoor_gas_sensors_warm = captured_outdoor_data["Gas Calibrated"]
-                    if "Noise" in captured_outdoor_data:
-                        outdoor_noise_level = captured_outdoor_data["Noise"]
-                        outdoor_noise_values = outdoor_noise_values[1:] + [[outdoor_noise_level, 1]]
-                    if "Max Noise" in captured_outdoor_data:
-                        outdoor_noise_max = captured_outdoor_data["Max Noise"]
-                    if "Max Noise Date Time" in captured_outdoor_data:
-                        outdoor_noise_max_datetime = captured_outdoor_data["Max Noise Date Time"]
-                    if "Noise Freq" in captured_outdoor_data:
-                        outdoor_noise_freq = captured_outdoor_data["Noise Freq"]
-                        outdoor_noise_freq_values = outdoor_noise_freq_values[1:] + [[outdoor_noise_freq[0], outdoor_noise_freq[1], outdoor_noise_freq[2], 1]]
+                    display_subscriber.dirty.update(changed)
+            previous_noise_max = own_noise_max
+            display_results()
+            proximity_sensor.proximity = 0 # Each proximity reading is only used once
+            if own_noise_max == 0 and previous_noise_max != 0:
+                noise_max_resets += 1
+            if errors[0] != error_count: # Show the error until the next display update
+                error_count = errors[0]
+                display_error(errors[1])
+                display_subscriber.mark_all_dirty()
+            if (mode, last_page, noise_max_resets) != display_state:
+                display_state = (mode, last_page, noise_max_resets)
+                display_state_block.write(pickle.dumps({"Mode": mode, "Last Page": last_page,
+                                                        "Noise Max Resets": noise_max_resets}))
+            clock.sleep(display_update_interval)
+    except KeyboardInterrupt:
+        pass
+
+def share_monitor_state(): # Multi-process mode. Shares the latest monitor state with the display process and
+    # captures the display process's state. Runs in place of the display duty
+    global mode, last_page, own_noise_max, noise_max_resets
+    state = {name: globals()[name] for name in display_state_names}
+    state["Proximity"] = proximity_sensor.get_proximity()
+    if display_subscriber.all_dirty:
+        state["Changed"] = None
+    else:
+        state["Changed"] = list(display_subscriber.dirty)
+    state["Display Errors"] = display_errors
+    display_subscriber.clear()
+    monitor_state_block.write(pickle.dumps(state))
+    sequence, payload = display_state_block.read()
+    if payload is not None:
+        display_state = pickle.loads(payload)
+        mode = display_state["Mode"]
+        last_page = display_state["Last Page"]
+        if display_state["Noise Max Resets"] != noise_max_resets:
+            noise_max_resets = display_state["Noise Max Resets"]
+            own_noise_max = 0
+
+def start_worker_processes(): # Multi-process mode. The processes are forked just before the event loop starts, so
+    # that they start with the monitor's full set up
+    global noise_worker_process, display_process
+    if enable_noise:
+        noise_worker_process = process_context.Process(target=run_noise_worker, name='Noise DSP', daemon=True)
+        noise_worker_process.start()
+    display_process = process_context.Process(target=run_display_process, name='Display', daemon=True)
+    display_process.start()
+    print('Multi-Process Mode. Noise DSP and Display Processes Started')
+
+# Monitor duties. Each one is run by the scheduler as its own asyncio task
+def get_run_time():
+    return round((clock.time() - start_time), 0)
+
+def process_noise(): # Only called when the noise stream has delivered a new sample
+    global own_noise_level, own_noise_values, own_noise_max, own_noise_max_datetime, own_noise_freq_values
+    if noise_sample_counter > 10: # Wait for microphone stability
+        if noise_worker_process is not None: # Multi-process mode. The noise DSP process has analysed the block
+            weighted_rms, amps = noise_result[0], list(noise_result[1:])
+        else:
+            weighted_rms, amps = analyse_noise(recording, frequency_bands=not scheduler.shed('Noise Frequencies'))
+        own_noise_ratio = (weighted_rms)/noise_ref_level
+        new_noise_mqtt_value = False
+        if own_noise_ratio > 0:
+            noise_level = 20*math.log10(own_noise_ratio)
+            own_noise_level = round(noise_level, 1)
+            own_noise_values = own_noise_values[1:] + [[own_noise_level, 1]]
+            # Capture Max, Luftdaten and Adafruit IO sound levels and once display has been changed for > 2 seconds
+            if (clock.time() - last_page) > 2:
+                if enable_luftdaten and enable_luftdaten_noise:
+                    luft_noise_values.append(round(noise_level, 2)) # Capture Luftdaten Noise Level
+                if own_noise_level >= own_noise_max:
+                    own_noise_max = own_noise_level
+                    own_noise_max_event = clock.now()
+                    date_string = own_noise_max_event.strftime("%d %b %y").lstrip('0')
+                    time_string = own_noise_max_event.strftime("%H:%M")
+                    own_noise_max_datetime = {"Date": date_string, "Time": time_string}
+                    mqtt_values["Max Noise"] = round(own_noise_max, 1)
+                    mqtt_values["Max Noise Date Time"] = own_noise_max_datetime
+                aio_noise_values.append(own_noise_level) # Capture Adafruit IO Noise Level
+                if own_noise_level >= mqtt_values["Noise"]:
+                    mqtt_values["Noise"] = round(own_noise_level, 1)
+                    new_noise_mqtt_value = True
+        if amps is None: # Frequency band analysis has been shed
+            return
+        own_noise_ratio_freq = [n/noise_ref_level for n in amps]
+        all_noise_ratio_freq_ok = True
+        for noise_ratio in own_noise_ratio_freq: # Ensure that ratios are > 0
+            if noise_ratio <= 0:
+                all_noise_ratio_freq_ok = False
+        if all_noise_ratio_freq_ok:
+            for item in range(len(own_noise_ratio_freq)):
+                own_noise_freq[item] = round(20*math.log10(own_noise_ratio_freq[item]), 1)
+            if new_noise_mqtt_value:
+                mqtt_values["Noise Freq"] = own_noise_freq
+            own_noise_freq_values = own_noise_freq_values[1:] + [[own_noise_freq[0], own_noise_freq[1], own_noise_freq[2], 1]]
+
+async def update_pm_values(): # Takes the frames that the PMS5003 reader thread has queued since the last update
+    # every second, unless adaptive sampling has stretched the time between reads
+    global pm_sampling_paused
+    if pms5003_reader is None:
+        pm_values, pm_read_error = await run_blocking(read_pms5003, pm_sampling_paused)
+        frames = [pm_values]
+    else:
+        if pms5003_reader.paused(): # Wait for a fresh frame after the pause
+            pms5003_reader.resume()
+            return
+        frames, read_errors = pms5003_reader.take()
+        pm_read_error = read_errors > 0
+        if frames == []:
+            pm_values = None
+        elif len(frames) == 1:
+            pm_values = frames[0]
+        else: # The event loop was held up for more than a frame interval
+            pm_values = AveragedPMValues(frames)
+    if pm_read_error:
+        show_display_error('Particle Sensor Error')
+    if pm_values is None: # No frame has arrived since the last update
+        return
+    record_pm_frames(frames)
+    read_pm_values(pm_values)
+    heartbeats.beat('PM Sensor')
+    startup_timeline.mark('First PM Reading')
+    pm_sampling_paused = adaptive_sampler is not None and adaptive_sampler.stretch > 1
+    if pm_sampling_paused:
+        if pms5003_reader is not None:
+            pms5003_reader.pause()
+        return adaptive_sampler.pm_interval() - pms5003_frame_interval # Allow for the frame interval that the read
+        # waited for
+
+pm_consumers = ['Short Update', 'Adafruit IO'] # The periodic duties that upload the PM readings
+
+async def duty_cycle_pm(): # Wakes the PMS5003 in time to take an averaged burst of reads before the next upload,
+    # and then puts it back to sleep
+    await run_blocking(streaming_pms5003.wake)
+    await asyncio.sleep(pms5003_duty_cycle.spin_up)
+    await run_blocking(streaming_pms5003.set_passive_mode) # It can wake up in active mode
+    frames = []
+    pm_read_error = False
+    for burst_read in range(pms5003_duty_cycle.burst):
+        try:
+            frames.append(await run_blocking(pms5003.read)) # Through pms5003 so that the frames can be recorded
+        except (ReadTimeoutError, ChecksumMismatchError):
+            logging.info("Failed to read PMS5003")
+            pm_read_error = True
+        await asyncio.sleep(pms5003_duty_cycle.read_interval)
+    if frames == []: # Try a reset before the next burst
+        await run_blocking(pms5003.reset)
+    await run_blocking(streaming_pms5003.sleep)
+    if pm_read_error:
+        show_display_error('Particle Sensor Error')
+    if frames != []:
+        record_pm_frames(frames)
+        read_pm_values(AveragedPMValues(frames))
+        heartbeats.beat('PM Sensor')
+        startup_timeline.mark('First PM Reading')
+    lead_time = pms5003_duty_cycle.lead_time()
+    next_run_time = scheduler.next_run_after(pm_consumers, main_loop.time() + lead_time)
+    if next_run_time is None:
+        return short_update_delay - lead_time
+    return max(0, next_run_time - lead_time - main_loop.time())
+
+async def short_update(): # Read climate values and update Luftdaten every 2.5 minutes (set by short_update_delay).
+    global gas_calib_temp, gas_calib_hum, gas_calib_bar, red_r0, oxi_r0, nh3_r0, reds_r0, oxis_r0, nh3s_r0
+    global gas_calib_temps, gas_calib_hums, gas_calib_bars, gas_sensors_warm, first_climate_reading_done
+    global luft_resp, luft_noise_values, data_sent_to_luftdaten_or_aio, last_climate_read_time
+    # Calibrate gas sensors once after warmup
+    if ((clock.time() - start_time) >= gas_sensors_warmup_time or gas_warm_up_detector.warm()) and\
+            gas_sensors_warm == False and first_climate_reading_done:
+        gas_calib_temp = round(readings_bus.value("Raw Temp"), 1)
+        gas_calib_hum = round(readings_bus.value("Raw Hum"), 1)
+        gas_calib_bar = round(readings_bus.value("Raw Bar"), 1)
+        red_r0, oxi_r0, nh3_r0 = read_raw_gas(await on_i2c_bus('ADS1015', gas.read_all))
+        print("Gas Sensor Calibration after Warmup. Red R0:", red_r0, "Oxi R0:", oxi_r0, "NH3 R0:", nh3_r0)
+        print("Gas Calibration Baseline. Temp:", gas_calib_temp, "Hum:", gas_calib_hum,
+              "Barometer:", gas_calib_bar)
+        reds_r0 = [red_r0] * 7
+        oxis_r0 = [oxi_r0] * 7
+        nh3s_r0 = [nh3_r0] * 7
+        gas_calib_temps = [gas_calib_temp] * 7
+        gas_calib_hums = [gas_calib_hum] * 7
+        gas_calib_bars = [gas_calib_bar] * 7
+        gas_sensors_warm = True
+        startup_timeline.mark('Gas Sensors Warm')
+    if adaptive_sampler is None or clock.time() - last_climate_read_time >= (
+            adaptive_sampler.climate_interval() - short_update_delay / 2):
+        read_climate_gas_values(*await read_climate_gas_sensors())
+        last_climate_read_time = clock.time()
+        first_climate_reading_done = True
+        heartbeats.beat('Climate Sensor')
+        startup_timeline.mark('First Climate Reading')
+    else:
+        print('Adaptive Sampling. Skipping Climate and Gas Read')
+    print('Luftdaten Values', luft_values)
+    print('mqtt Values', mqtt_values)
+    if enable_luftdaten and (luftdaten_subscriber.changed() or luft_noise_values != []): # Send data to Luftdaten
+        # if enabled and there are new readings
+        luftdaten_subscriber.clear()
+        for name, mean in interval_means(luftdaten_aggregator.take()).items(): # Send the PM means since the last
+            # upload
+            record_luftdaten_reading(Reading(name, mean, clock.time()))
+        sent_luft_noise_values = luft_noise_values
+        luft_noise_values = [] #Reset Luftdaten Noise Values List after each attempted transmission
+        luft_resp = await run_blocking(send_to_luftdaten, dict(luft_values), id, enable_particle_sensor,
+                                       enable_noise, sent_luft_noise_values, disable_luftdaten_sensor_upload)
+        #logging.info("Luftdaten Response: {}\n".format("ok" if luft_resp else "failed"))
+        data_sent_to_luftdaten_or_aio = True
+        if luft_resp:
+            print("Luftdaten update successful. Waiting for next capture cycle")
+        else:
+            print("Luftdaten update unsuccessful. Waiting for next capture cycle")
+    else:
+        print('Waiting for next capture cycle')
+
+def update_eco2_tvoc(): # Read TVOC and eCO2 every second, once the SGP30 has warmed up
+    if sgp30_ready:
+        read_eco2_tvoc_values()
+
+def warm_up_sgp30(): # Blocks the I2C bus for about 15 seconds, so the bus service runs its other transactions between
+    # the warm up's readings
+    if handover_payload is not None: # The SGP30 has kept measuring, and kept its baseline, since the outgoing monitor
+        # warmed it up
+        print("SGP30 Sensor taken over while measuring")
+        return
+    print("SGP30 Sensor warming up")
+    sgp30.start_measurement(i2c_bus.run_pending)
+    if valid_eco2_tvoc_baseline:
+        print('Setting eCO2 and TVOC baseline. get_baseline:', eco2_tvoc_baseline[0:2], 'set_baseline:',
+              eco2_tvoc_baseline[::-1][1:3])
+        sgp30.command('set_baseline', eco2_tvoc_baseline[::-1][1:3]) # Reverse the order. get_baseline is in
+        # the order of CO2, TVOC. set_baseline is TVOC, CO2 !Arghh!
+    if first_climate_reading_done: # Catch up on the humidity compensation that was skipped during the warm up
+        send_humidity_to_sgp30(readings_bus.value("Raw Temp"), readings_bus.value("Raw Hum"))
+
+async def bring_up_sgp30(): # The eCO2 and TVOC readings join the other readings once the SGP30 has warmed up
+    global sgp30_ready
+    await on_i2c_bus('SGP30', warm_up_sgp30)
+    i2c_bus.add_poll('Air Quality', 'SGP30', i2c_poll_intervals.get('SGP30', 1), sgp30.command, 'measure_air_quality')
+    sgp30_ready = True
+    startup_timeline.mark('SGP30 Warm Up')
+
+async def send_startup_versions_to_aio():
+    print("Sending Startup Versions to Adafruit IO", version_text)
+    await run_blocking(send_data_to_aio, aio_version_text_format, version_text)
+
+def update_barometer_log(): # Read and update the barometer log every 20 minutes, once the first climate reading has
+    # been done
+    global barometer_available_time, barometer_history, barometer_change, valid_barometer_history
+    global barometer_log_time, forecast, barometer_trend, icon_forecast, domoticz_forecast, aio_forecast
+    if not first_climate_reading_done:
+        return 1 # Check again in a second
+    if barometer_log_time == 0: # If this is the first barometer log, record the time that a forecast will be
+        # available (3 hours)
+        barometer_available_time = clock.time() + 10800
+    barometer_history, barometer_change, valid_barometer_history, barometer_log_time, forecast,\
+    barometer_trend, icon_forecast, domoticz_forecast, aio_forecast = log_barometer(own_data.value('Bar'),
+                                                                                    barometer_history)
+    mqtt_values["Forecast"] = {"Valid": valid_barometer_history, "3 Hour Change": round(barometer_change, 1),
+                               "Forecast": forecast.replace("\n", " ")}
+    mqtt_values["Bar"][1] = domoticz_forecast # Add Domoticz Weather Forecast
+    print('Barometer Logged. Waiting for next capture cycle')
+
+def process_outdoor_data(): # Process paired outdoor unit data when an mqtt message has been captured
+    global outdoor_maxi_temp, outdoor_mini_temp, outdoor_gas_sensors_warm, outdoor_noise_level, outdoor_noise_values
+    global outdoor_noise_max, outdoor_noise_max_datetime, outdoor_noise_freq, outdoor_noise_freq_values
+    global outdoor_reading_captured, outdoor_reading_captured_time, captured_outdoor_data
+    if captured_outdoor_data != {}: #If there's new data
+        for reading in outdoor_data: # Only capture data that's been sent
+            if reading in captured_outdoor_data:
+                if reading == "Bar" or reading == "Hum": # Barometer and Humidity readings have their
+                    # data in lists
+                    outdoor_data.set_value(reading, captured_outdoor_data[reading][0])
+                else:
+                    outdoor_data.set_value(reading, captured_outdoor_data[reading])
+                outdoor_disp_values[reading] = outdoor_disp_values[reading][1:] +\
+                                               [[outdoor_data.value(reading), 1]]
+        outdoor_maxi_temp = captured_outdoor_data["Max Temp"]
+        outdoor_mini_temp = captured_outdoor_data["Min Temp"]
+        outdoor_gas_sensors_warm = captured_outdoor_data["Gas Calibrated"]
+        if "Noise" in captured_outdoor_data:
+            outdoor_noise_level = captured_outdoor_data["Noise"]
+            outdoor_noise_values = outdoor_noise_values[1:] + [[outdoor_noise_level, 1]]
+        if "Max Noise" in captured_outdoor_data:
+            outdoor_noise_max = captured_outdoor_data["Max Noise"]
+        if "Max Noise Date Time" in captured_outdoor_data:
+            outdoor_noise_max_datetime = captured_outdoor_data["Max Noise Date Time"]
+        if "Noise Freq" in captured_outdoor_data:
+            outdoor_noise_freq = captured_outdoor_data["Noise Freq"]
+            outdoor_noise_freq_values = outdoor_noise_freq_values[1:] + [[outdoor_noise_freq[0], outdoor_noise_freq[1], outdoor_noise_freq[2], 1]]
+        outdoor_reading_captured = True
+        outdoor_reading_captured_time = clock.time()
+        captured_outdoor_data = {}
+        display_subscriber.mark_all_dirty()
+
+def update_display():
+    display_results()
+
+def seconds_until_aio_window(): # Time until the configured aio_feed_window and aio_feed_sequence slot next opens
+    today = clock.now()
+    ten_minute_position = (today.minute % 10) * 60 + today.second + today.microsecond / 1000000
+    return (aio_feed_window * 60 + aio_feed_sequence * 15 - ten_minute_position) % 600
+
+async def update_adafruit_io(): # Send data to Adafruit IO when the configured window and sequence slot opens
+    global aio_resp, aio_noise_values, data_sent_to_luftdaten_or_aio, previous_aio_update_minute
+    window_minute = clock.now().minute
+    if (get_run_time() > startup_stabilisation_time and window_minute != previous_aio_update_minute and
+            (aio_subscriber.changed() or aio_noise_values != [])):
+        # Wait until the gas sensors have stabilised before providing external updates. Skip the update if there are
+        # no new readings
+        aio_subscriber.clear()
+        sent_aio_noise_values = aio_noise_values
+        aio_noise_values = [] # Reset noise Adafruit IO Noise Levels after each transmission
+        previous_aio_update_minute = window_minute
+        aio_values = dict(mqtt_values)
+        aio_values.update(interval_means(aio_aggregator.take())) # Send the PM and gas means since the last update
+        aio_resp = await run_blocking(update_aio, aio_values, forecast, aio_format, aio_forecast_text_format,
+                                      aio_air_quality_level_format, aio_air_quality_text_format, own_data,
+                                      icon_air_quality_levels, aio_package, gas_sensors_warm, air_quality_data,
+                                      air_quality_data_no_gas, sent_aio_noise_values, aio_version_text_format,
+                                      version_text)
+        data_sent_to_luftdaten_or_aio = True
+        if aio_resp:
+            print("At least one Adafruit IO feed successful. Waiting for next capture cycle")
+        else:
+            print("No Adafruit IO feeds successful. Waiting for next capture cycle")
+    return seconds_until_aio_window()
+
+async def long_update(): # Provide/capture other external updates and update persistent data log every 5 minutes
+    # (Set by long_update_delay)
+    global long_update_time, long_update_toggle, outdoor_reading_captured, outdoor_reading_captured_time
+    global outdoor_maxi_temp, outdoor_mini_temp, outdoor_gas_sensors_warm, eco2_tvoc_get_baseline_update_time
+    global eco2_tvoc_baseline, persistent_data_log, persistence_deferrals, startup_mender_config_version
+    long_update_time = clock.time()
+    run_time = get_run_time()
+    defer_persistence = persistence_deferrals < max_persistence_deferrals and scheduler.shed('Persistence')
+    if defer_persistence:
+        persistence_deferrals += 1
+        print('Deferring Climate Log and Persistent Data Log Writes. Load Shedding.', scheduler.shedding_summary())
+    else:
+        persistence_deferrals = 0
+    if (indoor_outdoor_function == 'Indoor' and enable_send_data_to_homemanager):
+        client.publish(indoor_mqtt_topic, json.dumps(mqtt_report())) # Send indoor mqtt data
+    elif (indoor_outdoor_function == 'Outdoor' and (enable_indoor_outdoor_functionality or
+                                                    enable_send_data_to_homemanager)):
+        client.publish(outdoor_mqtt_topic, json.dumps(mqtt_report())) # Send outdoor mqtt data
+    if enable_noise:
+        mqtt_values["Noise"] = 0 # Reset noise mqtt reading after each transmission to capture new max level
+    if enable_climate_and_gas_logging and climate_log_subscriber.changed() and not defer_persistence: # Log data if
+        # there are new readings
+        log_climate_and_gas(run_time)
+        climate_log_subscriber.clear()
+    if (enable_indoor_outdoor_functionality and indoor_outdoor_function == 'Indoor'
+            and (outdoor_source_type == 'Luftdaten' or outdoor_source_type == 'Adafruit IO')): # Capture
+        # outdoor data via Luftdaten or Adafruit IO
+        long_update_toggle = not long_update_toggle
+        if long_update_toggle: # Only capture outdoor data via Luftdaten or Adafruit IO on every second cycle
+            outdoor_reading_captured = False
+            external_outdoor_data = await run_blocking(capture_external_outdoor_data, outdoor_source_type,
+                                                       outdoor_source_id, outdoor_aio_readings)
+            if external_outdoor_data != {}:
+                print('External Outdoor Data', external_outdoor_data)
+                display_subscriber.mark_all_dirty()
+                if outdoor_source_type == 'Luftdaten':
+                    if "Temp" in external_outdoor_data:
+                        outdoor_data.set_value("Temp", external_outdoor_data["Temp"])
+                        outdoor_disp_values["Temp"] = outdoor_disp_values["Temp"][1:] +\
+                                                      [[outdoor_data.value("Temp"), 1]]
+                        if outdoor_maxi_temp == None:
+                            outdoor_maxi_temp = outdoor_data.value("Temp")
+                        elif outdoor_data.value("Temp") > outdoor_maxi_temp:
+                            outdoor_maxi_temp = outdoor_data.value("Temp")
+                        if outdoor_mini_temp == None:
+                            outdoor_mini_temp = outdoor_data.value("Temp")
+                        elif outdoor_data.value("Temp") < outdoor_mini_temp:
+                            outdoor_mini_temp = outdoor_data.value("Temp")
+                    if "Hum" in external_outdoor_data:
+                        outdoor_data.set_value("Hum", external_outdoor_data["Hum"])
+                        outdoor_disp_values["Hum"] = outdoor_disp_values["Hum"][1:] +\
+                                                     [[outdoor_data.value("Hum"), 1]]
+                    if "P10" in external_outdoor_data:
+                        outdoor_data.set_value("P10", external_outdoor_data["P10"])
+                        outdoor_disp_values["P10"] = outdoor_disp_values["P10"][1:] +\
+                                                     [[outdoor_data.value("P10"), 1]]
+                    if "P2.5" in external_outdoor_data:
+                        outdoor_data.set_value("P2.5", external_outdoor_data["P2.5"])
+                        outdoor_disp_values["P2.5"] = outdoor_disp_values["P2.5"][1:] +\
+                                                      [[outdoor_data.value("P2.5"), 1]]
+                    outdoor_data.set_value("Dew", round(calculate_dewpoint(outdoor_data.value("Temp"),
+                                                                           outdoor_data.value("Hum")), 1))
+                    outdoor_disp_values["Dew"] = outdoor_disp_values["Dew"][1:] +\
+                                                 [[outdoor_data.value("Dew"), 1]]
+                    outdoor_data.set_value("Bar", own_data.value("Bar")) # Use internal air pressure data
+                    outdoor_data.set_value("P1", None)
+                    outdoor_data.set_value("Oxi", None)
+                    outdoor_data.set_value("Red", None)
+                    outdoor_data.set_value("NH3", None)
+                    outdoor_data.set_value("Lux", None)
+                    outdoor_gas_sensors_warm = False
                     outdoor_reading_captured = True
-                    outdoor_reading_captured_time = time.time()
-                    captured_outdoor_data = {}
-                    
-            # Update Display on every loop
-            last_page, mode, start_current_display, current_display_is_own, own_noise_max =\
-                display_results(start_current_display, current_display_is_own, display_modes,
-                                indoor_outdoor_display_duration, own_data, data_in_display_all_aq, outdoor_data,
-                                outdoor_reading_captured, own_disp_values, outdoor_disp_values, delay, last_page, mode,
-                                WIDTH, valid_barometer_history, forecast, barometer_available_time, barometer_change,
-                                barometer_trend, icon_forecast, maxi_temp, mini_temp, air_quality_data,
-                                air_quality_data_no_gas, gas_sensors_warm, outdoor_gas_sensors_warm, enable_display,
-                                palette, enable_adafruit_io, aio_user_name, aio_household_prefix, enable_eco2_tvoc,
-                                outdoor_source_type, own_noise_level, own_noise_max, own_noise_max_datetime,
-                                own_noise_values, own_noise_freq_values, outdoor_noise_level, outdoor_noise_max,
-                                outdoor_noise_max_datetime, outdoor_noise_values, outdoor_noise_freq_values)
-
-            # Provide external updates and update persistent data log
-            if run_time > startup_stabilisation_time: # Wait until the gas sensors have stabilised before providing
-                # external updates or updating the persistent data log
-                # Send data to Adafruit IO if enabled, set up and the time is now within the configured window and sequence
-                if enable_adafruit_io and aio_format != {}:
-                    today=datetime.now()
-                    window_minute = int(today.strftime('%M'))
-                    window_second = int(today.strftime('%S'))
-                    if window_minute % 10 == aio_feed_window and window_second // 15 == aio_feed_sequence and\
-                            window_minute != previous_aio_update_minute:
-                        aio_resp = update_aio(mqtt_values, forecast, aio_format, aio_forecast_text_format,
-                                              aio_air_quality_level_format, aio_air_quality_text_format,
-                                              own_data, icon_air_quality_levels, aio_package, gas_sensors_warm,
-                                              air_quality_data, air_quality_data_no_gas, aio_noise_values,
-                                             aio_version_text_format, version_text)
-                        aio_noise_values = [] # Reset noise Adafruit IO Noise Levels after each transmission
-                        data_sent_to_luftdaten_or_aio = True
-                        previous_aio_update_minute = window_minute
-                        if aio_resp:
-                            print("At least one Adafruit IO feed successful. Waiting for next capture cycle")
-                        else:
-                            print("No Adafruit IO feeds successful. Waiting for next capture cycle")
-                time_since_long_update = time.time() - long_update_time
-                
-                # Provide/capture other external updates and update persistent data log every 5 minutes
-                # (Set by long_update_delay)
-                if time_since_long_update >= long_update_delay:
-                    long_update_time = time.time()
-                    if (indoor_outdoor_function == 'Indoor' and enable_send_data_to_homemanager):
-                        client.publish(indoor_mqtt_topic, json.dumps(mqtt_values)) # Send indoor mqtt data
-                    elif (indoor_outdoor_function == 'Outdoor' and (enable_indoor_outdoor_functionality or
-                                                                    enable_send_data_to_homemanager)):
-                        client.publish(outdoor_mqtt_topic, json.dumps(mqtt_values)) # Send outdoor mqtt data
-                    if enable_noise:
-                        mqtt_values["Noise"] = 0 # Reset noise mqtt reading after each transmission to capture new max level
-                    if enable_climate_and_gas_logging: # Log data
-                        log_climate_and_gas(run_time, own_data, raw_red_rs, raw_oxi_rs, raw_nh3_rs, raw_temp,
-                                            comp_temp, comp_hum, raw_hum, use_external_temp_hum, use_external_barometer,
-                                            raw_barometer)
-                    if (enable_indoor_outdoor_functionality and indoor_outdoor_function == 'Indoor'
-                            and (outdoor_source_type == 'Luftdaten' or outdoor_source_type == 'Adafruit IO')): # Capture
-                        # outdoor data via Luftdaten or Adafruit IO
-                        long_update_toggle = not long_update_toggle
-                        if long_update_toggle: # Only capture outdoor data via Luftdaten or Adafruit IO on every second cycle
-                            outdoor_reading_captured = False
-                            external_outdoor_data = capture_external_outdoor_data(outdoor_source_type, outdoor_source_id,
-                                                                                  outdoor_aio_readings)
-                            if external_outdoor_data != {}:
-                                print('External Outdoor Data', external_outdoor_data)
-                                if outdoor_source_type == 'Luftdaten':
-                                    if "Temp" in external_outdoor_data:
-                                        outdoor_data["Temp"][1] = external_outdoor_data["Temp"]
-                                        outdoor_disp_values["Temp"] = outdoor_disp_values["Temp"][1:] +\
-                                                                      [[outdoor_data["Temp"][1], 1]]
-                                        if outdoor_maxi_temp == None:
-                                            outdoor_maxi_temp = outdoor_data["Temp"][1]
-                                        elif outdoor_data["Temp"][1] > outdoor_maxi_temp:
-                                            outdoor_maxi_temp = outdoor_data["Temp"][1]
-                                        if outdoor_mini_temp == None:
-                                            outdoor_mini_temp = outdoor_data["Temp"][1]
-                                        elif outdoor_data["Temp"][1] < outdoor_mini_temp:
-                                            outdoor_mini_temp = outdoor_data["Temp"][1]
-                                    if "Hum" in external_outdoor_data:
-                                        outdoor_data["Hum"][1] = external_outdoor_data["Hum"]
-                                        outdoor_disp_values["Hum"] = outdoor_disp_values["Hum"][1:] +\
-                                                                     [[outdoor_data["Hum"][1], 1]]
-                                    if "P10" in external_outdoor_data:
-                                        outdoor_data["P10"][1] = external_outdoor_data["P10"]
-                                        outdoor_disp_values["P10"] = outdoor_disp_values["P10"][1:] +\
-                                                                     [[outdoor_data["P10"][1], 1]]
-                                    if "P2.5" in external_outdoor_data:
-                                        outdoor_data["P2.5"][1] = external_outdoor_data["P2.5"]
-                                        outdoor_disp_values["P2.5"] = outdoor_disp_values["P2.5"][1:] +\
-                                                                      [[outdoor_data["P2.5"][1], 1]]
-                                    outdoor_data["Dew"][1] = round(calculate_dewpoint(outdoor_data["Temp"][1], outdoor_data["Hum"][1]),1)
-                                    outdoor_disp_values["Dew"] = outdoor_disp_values["Dew"][1:] +\
-                                                                 [[outdoor_data["Dew"][1], 1]]
-                                    outdoor_data["Bar"][1] = own_data["Bar"][1] # Use internal air pressure data
-                                    outdoor_data["P1"][1] = None
-                                    outdoor_data["Oxi"][1] = None
-                                    outdoor_data["Red"][1] = None
-                                    outdoor_data["NH3"][1] = None
-                                    outdoor_data["Lux"][1] = None
-                                    outdoor_gas_sensors_warm = False
-                                    outdoor_reading_captured = True
-                                    outdoor_reading_captured_time = time.time()
-                                elif outdoor_source_type == 'Adafruit IO':
-                                    for reading in outdoor_aio_readings:
-                                        if reading in external_outdoor_data:
-                                            outdoor_reading_captured = True
-                                            outdoor_reading_captured_time = time.time()
-                                            outdoor_data[reading][1] = external_outdoor_data[reading]
-                                            outdoor_disp_values[reading] = outdoor_disp_values[reading][1:] + [
-                                                [outdoor_data[reading][1], 1]]
-                                    if outdoor_maxi_temp == None:
-                                        outdoor_maxi_temp = outdoor_data["Temp"][1]
-                                    elif outdoor_data["Temp"][1] > outdoor_maxi_temp:
-                                        outdoor_maxi_temp = outdoor_data["Temp"][1]
-                                    if outdoor_mini_temp == None:
-                                        outdoor_mini_temp = outdoor_data["Temp"][1]
-                                    elif outdoor_data["Temp"][1] < outdoor_mini_temp:
-                                        outdoor_mini_temp = outdoor_data["Temp"][1]
-                                    outdoor_data["Lux"][1] = None
-                                    outdoor_data["Bar"][1] = own_data["Bar"][1] # Use internal air pressure data
-                                    outdoor_gas_sensors_warm = True
-                            else:
-                                print("No external outdoor data captured")
-                                
-                    # Write to the persistent data log
-                    if enable_eco2_tvoc: # Update and add eco2_tvoc_baseline if CO2/TVOC is enabled and the SGP30 sensor
-                        # has been active for more than 12 hours, or there's a valid baseline
-                        if run_time > 43200 or valid_eco2_tvoc_baseline:
-                            time_since_eco2_tvoc_get_baseline = time.time() - eco2_tvoc_get_baseline_update_time
-                            if time_since_eco2_tvoc_get_baseline >= 3600: # Update every hour
-                                eco2_tvoc_get_baseline_update_time = time.time()
-                                eco2_tvoc_baseline = sgp30.command('get_baseline')
-                                eco2_tvoc_baseline.append(eco2_tvoc_get_baseline_update_time)
-                                print('Storing eCO2/TVOC Baseline', eco2_tvoc_baseline)
-                        persistent_data_log = {"Update Time": long_update_time, "Barometer Log Time": barometer_log_time,
-                                               "Forecast": forecast, "Barometer Available Time": barometer_available_time,
-                                               "Valid Barometer History": valid_barometer_history,
-                                               "Barometer History": barometer_history, "Barometer Change": barometer_change,
-                                               "Barometer Trend": barometer_trend, "Icon Forecast": icon_forecast,
-                                               "Domoticz Forecast": domoticz_forecast, "AIO Forecast": aio_forecast,
-                                               "Gas Sensors Warm": gas_sensors_warm, "Gas Temp": gas_calib_temp,
-                                               "Gas Hum": gas_calib_hum, "Gas Bar": gas_calib_bar, "Red R0": red_r0,
-                                               "Oxi R0": oxi_r0, "NH3 R0": nh3_r0, "Red R0 List": reds_r0,
-                                               "Oxi R0 List": oxis_r0, "NH3 R0 List": nh3s_r0,
-                                               "Gas Calib Temp List": gas_calib_temps, "Gas Calib Hum List": gas_calib_hums,
-                                               "Gas Calib Bar List": gas_calib_bars, "Own Disp Values": own_disp_values,
-                                               "Outdoor Disp Values": outdoor_disp_values, "Maxi Temp": maxi_temp,
-                                               "Mini Temp": mini_temp, "Last Page": last_page, "Mode": mode,
-                                               "eCO2 TVOC Baseline": eco2_tvoc_baseline}
-                    else: # Don't add eco2_tvoc_baseline if eCO2/TVOC is not enabled or the SGP30 sensor
-                          # has not been active for more than 12 hours, or there isn't a valid baseline
-                        persistent_data_log = {"Update Time": long_update_time, "Barometer Log Time": barometer_log_time,
-                                               "Forecast": forecast, "Barometer Available Time": barometer_available_time,
-                                               "Valid Barometer History": valid_barometer_history,
-                                               "Barometer History": barometer_history, "Barometer Change": barometer_change,
-                                               "Barometer Trend": barometer_trend, "Icon Forecast": icon_forecast,
-                                               "Domoticz Forecast": domoticz_forecast, "AIO Forecast": aio_forecast,
-                                               "Gas Sensors Warm": gas_sensors_warm, "Gas Temp": gas_calib_temp,
-                                               "Gas Hum": gas_calib_hum, "Gas Bar": gas_calib_bar, "Red R0": red_r0,
-                                               "Oxi R0": oxi_r0, "NH3 R0": nh3_r0, "Red R0 List": reds_r0,
-                                               "Oxi R0 List": oxis_r0, "NH3 R0 List": nh3s_r0,
-                                               "Gas Calib Temp List": gas_calib_temps, "Gas Calib Hum List": gas_calib_hums,
-                                               "Gas Calib Bar List": gas_calib_bars, "Own Disp Values": own_disp_values,
-                                               "Outdoor Disp Values": outdoor_disp_values,
-                                               "Maxi Temp": maxi_temp, "Mini Temp": mini_temp, "Last Page": last_page,
-                                               "Mode": mode}
-                    # Add Noise data
-                    persistent_data_log["Own Noise Values"] = own_noise_values
-                    persistent_data_log["Outdoor Noise Values"] = outdoor_noise_values
-                    persistent_data_log["Own Noise Freq Values"] = own_noise_freq_values
-                    persistent_data_log["Outdoor Noise Freq Values"] = outdoor_noise_freq_values
-                    persistent_data_log["Own Noise Max"] = own_noise_max
-                    persistent_data_log["Outdoor Noise Max"] = outdoor_noise_max
-                    persistent_data_log["Own Noise Max Date Time"] = own_noise_max_datetime
-                    persistent_data_log["Outdoor Noise Max Date Time"] = outdoor_noise_max_datetime
-                    print('Logging Barometer, Forecast, Gas Calibration and Display Data')
-                    with open('<Your Persistent Data Log File Name Here>', 'w') as f:
-                        f.write(json.dumps(persistent_data_log))
-                    if "Forecast" in mqtt_values:
-                        mqtt_values.pop("Forecast") # Remove Forecast after sending it to home manager so that
-                        # forecast data is only sent when updated
-                    # Check if there has been software or config update and restart code if either has been updated
-                    try:
-                        with open('<Your Mender Software Version File Location Here>', 'r') as f:
-                            latest_mender_software_version = f.read()
-                    except IOError:
-                        print('No Mender Software Version Available')
-                        latest_mender_software_version = startup_mender_software_version
-                    print("Startup Mender Software Version:", startup_mender_software_version,
-                          "Latest Mender Software Version:", latest_mender_software_version)
-                    try:
-                        with open('<Your Mender Config Version File Location Here>', 'r') as f:
-                            latest_mender_config_version = f.read()
-                    except IOError:
-                        print('No Mender Config Version Available')
-                        latest_mender_config_version = startup_mender_config_version
-                    print("Startup Mender Config Version:", startup_mender_config_version, "Latest Mender Config Version:", latest_mender_config_version)
-                    if latest_mender_software_version != startup_mender_software_version or\
-                            latest_mender_config_version != startup_mender_config_version:
-                        print('Software or Config Update Received. Restarting aqimonitor')
-                        if enable_send_data_to_homemanager or enable_receive_data_from_homemanager:
-                            client.loop_stop()
-                        time.sleep(10)
-                        os.system('sudo systemctl restart aqimonitor')
-                    print('Waiting for next capture cycle')
-
-            # Luftdaten and/or Adafruit IO Communications Check. Note that aio_resp and luft_resp are both TRUE on startup,
-            # so there has to be a comms error for either of them to be set to FALSE
-            # Either aio_resp and luft_resp is set to TRUE if there's a subsequent error-free comms to their
-            # respective platform
-            if enable_adafruit_io and enable_luftdaten:
-                if aio_resp or luft_resp: # Set time when a successful Luftdaten or Adafruit IO response is received,
-                    # if both Luftdaten and Adafruit IO are enabled
-                    successful_comms_time = time.time()
-            elif enable_adafruit_io and not enable_luftdaten: # Set time when a successful Adafruit IO response is received,
-                # if only Adafruit IO is enabled
-                if aio_resp:
-                    successful_comms_time = time.time()
-            elif enable_luftdaten and not enable_adafruit_io: # Set time when a successful Luftdaten response is received,
-                # if only Luftdaten is enabled
-                if luft_resp:
-                    successful_comms_time = time.time()
-            else: # Set time if both Adafruit IO and Luftdaten are disabled so that comms failure is never triggered
-                successful_comms_time = time.time()
-            if time.time() - successful_comms_time >= comms_failure_tolerance:
-                comms_failure = True
-                print("Communications has been lost for more than " + str(int(comms_failure_tolerance/60)) +
-                      " minutes. System will reboot via watchdog")
-            # Outdoor Sensor Comms Check
-            if time.time() - outdoor_reading_captured_time > long_update_delay * 4:
-                outdoor_reading_captured = False # Reset outdoor reading captured flag if comms with the
-                # outdoor sensor is lost for more than 20 minutes so that old outdoor data is not displayed
-                
-            # Calibrate gas sensors daily at time set by gas_daily_r0_calibration_hour,
-            # using average of daily readings over a week if not already done in the current day and if warmup
-            # calibration is completed
-            # Compensates for gas sensor drift over time
-            today=datetime.now()
-            if int(today.strftime('%H')) == gas_daily_r0_calibration_hour and gas_daily_r0_calibration_completed == False\
-                    and gas_sensors_warm and first_climate_reading_done:
-                print("Daily Gas Sensor Calibration. Old R0s. Red R0:", red_r0, "Oxi R0:", oxi_r0, "NH3 R0:", nh3_r0)
-                print("Old Calibration Baseline. Temp:", gas_calib_temp, "Hum:", gas_calib_hum,
-                      "Barometer:", gas_calib_bar)
-                # Set new calibration baseline using 7 day rolling average
-                gas_calib_temps = gas_calib_temps[1:] + [round(raw_temp, 1)]
-                #print("Calib Temps", gas_calib_temps)
-                gas_calib_temp = round(sum(gas_calib_temps)/float(len(gas_calib_temps)), 1)
-                gas_calib_hums = gas_calib_hums[1:] + [round(raw_hum, 1)]
-                #print("Calib Hums", gas_calib_hums)
-                gas_calib_hum = round(sum(gas_calib_hums)/float(len(gas_calib_hums)), 0)
-                gas_calib_bars = gas_calib_bars[1:] + [round(raw_barometer, 1)]
-                #print("Calib Bars", gas_calib_bars)
-                gas_calib_bar = round(sum(gas_calib_bars)/float(len(gas_calib_bars)), 1)
-                # Update R0s and create new calibration baseline
-                # spot_red_r0, spot_oxi_r0, spot_nh3_r0, raw_red_r0, raw_oxi_r0, raw_nh3_r0 = comp_gas(gas_calib_temp,
-                # gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer)
-                spot_red_r0, spot_oxi_r0, spot_nh3_r0 = read_raw_gas()
-                # Convert R0s to 7 day rolling average
-                reds_r0 = reds_r0[1:] + [round(spot_red_r0, 0)]
-                #print("Reds R0", reds_r0)
-                red_r0 = round(sum(reds_r0)/float(len(reds_r0)), 0)
-                oxis_r0 = oxis_r0[1:] + [round(spot_oxi_r0, 0)]
-                #print("Oxis R0", oxis_r0)
-                oxi_r0 = round(sum(oxis_r0)/float(len(oxis_r0)), 0)
-                nh3s_r0 = nh3s_r0[1:] + [round(spot_nh3_r0, 0)]
-                #print("NH3s R0", nh3s_r0)
-                nh3_r0 = round(sum(nh3s_r0)/float(len(nh3s_r0)), 0)
-                print('New R0s. Red R0:', red_r0, 'Oxi R0:', oxi_r0, 'NH3 R0:', nh3_r0)
-                print("New Calibration Baseline. Temp:", gas_calib_temp, "Hum:", gas_calib_hum,
-                      "Barometer:", gas_calib_bar)
-                gas_daily_r0_calibration_completed = True
-            if int(today.strftime('%H')) == (gas_daily_r0_calibration_hour + 1) and gas_daily_r0_calibration_completed:
-                gas_daily_r0_calibration_completed = False
+                    outdoor_reading_captured_time = clock.time()
+                elif outdoor_source_type == 'Adafruit IO':
+                    for reading in outdoor_aio_readings:
+                        if reading in external_outdoor_data:
+                            outdoor_reading_captured = True
+                            outdoor_reading_captured_time = clock.time()
+                            outdoor_data.set_value(reading, external_outdoor_data[reading])
+                            outdoor_disp_values[reading] = outdoor_disp_values[reading][1:] + [
+                                [outdoor_data.value(reading), 1]]
+                    if outdoor_maxi_temp == None:
+                        outdoor_maxi_temp = outdoor_data.value("Temp")
+                    elif outdoor_data.value("Temp") > outdoor_maxi_temp:
+                        outdoor_maxi_temp = outdoor_data.value("Temp")
+                    if outdoor_mini_temp == None:
+                        outdoor_mini_temp = outdoor_data.value("Temp")
+                    elif outdoor_data.value("Temp") < outdoor_mini_temp:
+                        outdoor_mini_temp = outdoor_data.value("Temp")
+                    outdoor_data.set_value("Lux", None)
+                    outdoor_data.set_value("Bar", own_data.value("Bar")) # Use internal air pressure data
+                    outdoor_gas_sensors_warm = True
+            else:
+                print("No external outdoor data captured")
+
+    # Write to the persistent data log
+    if enable_eco2_tvoc: # Update and add eco2_tvoc_baseline if CO2/TVOC is enabled and the SGP30 sensor
+        # has been active for more than 12 hours, or there's a valid baseline
+        if run_time > 43200 or valid_eco2_tvoc_baseline:
+            time_since_eco2_tvoc_get_baseline = clock.time() - eco2_tvoc_get_baseline_update_time
+            if time_since_eco2_tvoc_get_baseline >= 3600: # Update every hour
+                eco2_tvoc_get_baseline_update_time = clock.time()
+                eco2_tvoc_baseline = await on_i2c_bus('SGP30', sgp30.command, 'get_baseline')
+                eco2_tvoc_baseline.append(eco2_tvoc_get_baseline_update_time)
+                print('Storing eCO2/TVOC Baseline', eco2_tvoc_baseline)
+        persistent_data_log = {"Update Time": long_update_time, "Barometer Log Time": barometer_log_time,
+                               "Forecast": forecast, "Barometer Available Time": barometer_available_time,
+                               "Valid Barometer History": valid_barometer_history,
+                               "Barometer History": barometer_history, "Barometer Change": barometer_change,
+                               "Barometer Trend": barometer_trend, "Icon Forecast": icon_forecast,
+                               "Domoticz Forecast": domoticz_forecast, "AIO Forecast": aio_forecast,
+                               "Gas Sensors Warm": gas_sensors_warm, "Gas Temp": gas_calib_temp,
+                               "Gas Hum": gas_calib_hum, "Gas Bar": gas_calib_bar, "Red R0": red_r0,
+                               "Oxi R0": oxi_r0, "NH3 R0": nh3_r0, "Red R0 List": reds_r0,
+                               "Oxi R0 List": oxis_r0, "NH3 R0 List": nh3s_r0,
+                               "Gas Calib Temp List": gas_calib_temps, "Gas Calib Hum List": gas_calib_hums,
+                               "Gas Calib Bar List": gas_calib_bars, "Own Disp Values": own_disp_values,
+                               "Outdoor Disp Values": outdoor_disp_values, "Maxi Temp": maxi_temp,
+                               "Mini Temp": mini_temp, "Last Page": last_page, "Mode": mode,
+                               "eCO2 TVOC Baseline": eco2_tvoc_baseline}
+    else: # Don't add eco2_tvoc_baseline if eCO2/TVOC is not enabled or the SGP30 sensor
+          # has not been active for more than 12 hours, or there isn't a valid baseline
+        persistent_data_log = {"Update Time": long_update_time, "Barometer Log Time": barometer_log_time,
+                               "Forecast": forecast, "Barometer Available Time": barometer_available_time,
+                               "Valid Barometer History": valid_barometer_history,
+                               "Barometer History": barometer_history, "Barometer Change": barometer_change,
+                               "Barometer Trend": barometer_trend, "Icon Forecast": icon_forecast,
+                               "Domoticz Forecast": domoticz_forecast, "AIO Forecast": aio_forecast,
+                               "Gas Sensors Warm": gas_sensors_warm, "Gas Temp": gas_calib_temp,
+                               "Gas Hum": gas_calib_hum, "Gas Bar": gas_calib_bar, "Red R0": red_r0,
+                               "Oxi R0": oxi_r0, "NH3 R0": nh3_r0, "Red R0 List": reds_r0,
+                               "Oxi R0 List": oxis_r0, "NH3 R0 List": nh3s_r0,
+                               "Gas Calib Temp List": gas_calib_temps, "Gas Calib Hum List": gas_calib_hums,
+                               "Gas Calib Bar List": gas_calib_bars, "Own Disp Values": own_disp_values,
+                               "Outdoor Disp Values": outdoor_disp_values,
+                               "Maxi Temp": maxi_temp, "Mini Temp": mini_temp, "Last Page": last_page,
+                               "Mode": mode}
+    # Add Noise data
+    persistent_data_log["Own Noise Values"] = own_noise_values
+    persistent_data_log["Outdoor Noise Values"] = outdoor_noise_values
+    persistent_data_log["Gas Baseline"] = gas_baseline_tracker.state()
+    persistent_data_log["Own Noise Freq Values"] = own_noise_freq_values
+    persistent_data_log["Outdoor Noise Freq Values"] = outdoor_noise_freq_values
+    persistent_data_log["Own Noise Max"] = own_noise_max
+    persistent_data_log["Outdoor Noise Max"] = outdoor_noise_max
+    persistent_data_log["Own Noise Max Date Time"] = own_noise_max_datetime
+    persistent_data_log["Outdoor Noise Max Date Time"] = outdoor_noise_max_datetime
+    if not defer_persistence:
+        print('Logging Barometer, Forecast, Gas Calibration and Display Data')
+        storage_writer.replace_durably('<Your Persistent Data Log File Name Here>',
+                                       json.dumps(persistent_data_log))
+    if "Forecast" in mqtt_values:
+        mqtt_values.pop("Forecast") # Remove Forecast after sending it to home manager so that
+        # forecast data is only sent when updated
+    print('Scheduler Jitter.', scheduler.jitter_summary(), 'Load Shedding.', scheduler.shedding_summary(),
+          'Storage.', storage_writer.summary(), 'I2C.', i2c_bus.summary())
+    if streaming_pms5003 is not None:
+        print('PMS5003 Frames.', streaming_pms5003.summary())
+    # Check if there has been software or config update and restart code if either has been updated
+    try:
+        with open('<Your Mender Software Version File Location Here>', 'r') as f:
+            latest_mender_software_version = f.read()
+    except IOError:
+        print('No Mender Software Version Available')
+        latest_mender_software_version = startup_mender_software_version
+    print("Startup Mender Software Version:", startup_mender_software_version,
+          "Latest Mender Software Version:", latest_mender_software_version)
+    try:
+        with open('<Your Mender Config Version File Location Here>', 'r') as f:
+            latest_mender_config_version = f.read()
+    except IOError:
+        print('No Mender Config Version Available')
+        latest_mender_config_version = startup_mender_config_version
+    print("Startup Mender Config Version:", startup_mender_config_version, "Latest Mender Config Version:", latest_mender_config_version)
+    if latest_mender_config_version != startup_mender_config_version and config_restart_keys == set():
+        # The config update has already been applied by reload_config, so only a software update needs a restart
+        print('Config Update Applied Without Restarting')
+        startup_mender_config_version = latest_mender_config_version
+    if latest_mender_software_version != startup_mender_software_version or\
+            latest_mender_config_version != startup_mender_config_version:
+        if handover_socket != '' and handover_server is None:
+            print('Software or Config Update Received. Handing Over to the New Version')
+            await start_handover()
+        elif handover_socket == '' or clock.time() - handover_start_time > handover_timeout:
+            if handover_server is not None:
+                print('The New Version Did Not Take Over')
+                handover_server.close()
+            print('Software or Config Update Received. Restarting aqimonitor')
+            if enable_send_data_to_homemanager or enable_receive_data_from_homemanager:
+                client.loop_stop()
+            await asyncio.sleep(10)
+            os.system('sudo systemctl restart aqimonitor')
+    print('Waiting for next capture cycle')
+
+def check_comms():
+    # Luftdaten and/or Adafruit IO Communications Check. Note that aio_resp and luft_resp are both TRUE on startup,
+    # so there has to be a comms error for either of them to be set to FALSE
+    # Either aio_resp and luft_resp is set to TRUE if there's a subsequent error-free comms to their
+    # respective platform
+    global successful_comms_time, comms_failure, outdoor_reading_captured
+    if enable_adafruit_io and enable_luftdaten:
+        if aio_resp or luft_resp: # Set time when a successful Luftdaten or Adafruit IO response is received,
+            # if both Luftdaten and Adafruit IO are enabled
+            successful_comms_time = clock.time()
+    elif enable_adafruit_io and not enable_luftdaten: # Set time when a successful Adafruit IO response is received,
+        # if only Adafruit IO is enabled
+        if aio_resp:
+            successful_comms_time = clock.time()
+    elif enable_luftdaten and not enable_adafruit_io: # Set time when a successful Luftdaten response is received,
+        # if only Luftdaten is enabled
+        if luft_resp:
+            successful_comms_time = clock.time()
+    else: # Set time if both Adafruit IO and Luftdaten are disabled so that comms failure is never triggered
+        successful_comms_time = clock.time()
+    if clock.time() - successful_comms_time >= comms_failure_tolerance:
+        comms_failure = True
+        print("Communications has been lost for more than " + str(int(comms_failure_tolerance/60)) +
+              " minutes. The systemd watchdog will no longer be kicked")
+    if not comms_failure:
+        heartbeats.beat('Uploads')
+    # Outdoor Sensor Comms Check
+    if clock.time() - outdoor_reading_captured_time > long_update_delay * 4:
+        outdoor_reading_captured = False # Reset outdoor reading captured flag if comms with the
+        # outdoor sensor is lost for more than 20 minutes so that old outdoor data is not displayed
+
+async def flush_storage(): # Writes the staged log writes to the SD card
+    await run_blocking(storage_writer.flush)
+
+def kick_watchdog(): # Kicks the systemd watchdog while every subsystem has a recent heartbeat, so that systemd
+    # restarts the monitor if one of them stalls
+    global stalled_subsystems
+    stalled = heartbeats.stalled()
+    if stalled != stalled_subsystems:
+        stalled_subsystems = stalled
+        if stalled == []:
+            print('All Subsystems Alive')
+            systemd_notifier.notify('STATUS=Monitoring')
+        else:
+            print('Stalled Subsystems:', stalled)
+            systemd_notifier.notify('STATUS=Stalled: ' + ', '.join(stalled))
+    if stalled == []:
+        systemd_notifier.notify('WATCHDOG=1')
+
+async def daily_gas_calibration():
+    # Calibrate gas sensors daily at time set by gas_daily_r0_calibration_hour,
+    # using the tracked clean air baseline over the last week (or the average of daily readings over a week until
+    # enough readings have been tracked) if not already done in the current day and if warmup calibration is completed
+    # Compensates for gas sensor drift over time
+    global gas_calib_temps, gas_calib_temp, gas_calib_hums, gas_calib_hum, gas_calib_bars, gas_calib_bar
+    global reds_r0, red_r0, oxis_r0, oxi_r0, nh3s_r0, nh3_r0, gas_daily_r0_calibration_completed
+    today=clock.now()
+    if int(today.strftime('%H')) == gas_daily_r0_calibration_hour and gas_daily_r0_calibration_completed == False\
+            and gas_sensors_warm and first_climate_reading_done:
+        print("Daily Gas Sensor Calibration. Old R0s. Red R0:", red_r0, "Oxi R0:", oxi_r0, "NH3 R0:", nh3_r0)
+        print("Old Calibration Baseline. Temp:", gas_calib_temp, "Hum:", gas_calib_hum,
+              "Barometer:", gas_calib_bar)
+        tracked_r0s = gas_baseline_tracker.baseline(today.date().toordinal())
+        if tracked_r0s is not None: # Use the clean air Rs over the baseline window, with the reference conditions that
+            # it was tracked at as the calibration baseline
+            red_r0, oxi_r0, nh3_r0 = [round(r0, 0) for r0 in tracked_r0s]
+            gas_calib_temp, gas_calib_hum, gas_calib_bar = gas_baseline_tracker.reference
+            # Keep the rolling lists up to date, in case the spot readings are used again
+            gas_calib_temps = gas_calib_temps[1:] + [gas_calib_temp]
+            gas_calib_hums = gas_calib_hums[1:] + [gas_calib_hum]
+            gas_calib_bars = gas_calib_bars[1:] + [gas_calib_bar]
+            reds_r0 = reds_r0[1:] + [red_r0]
+            oxis_r0 = oxis_r0[1:] + [oxi_r0]
+            nh3s_r0 = nh3s_r0[1:] + [nh3_r0]
+            print('Tracked Gas Baseline from', gas_baseline_tracker.readings(today.date().toordinal()), 'Readings')
+        else: # Not enough readings have been tracked yet, so use a spot reading
+            # Set new calibration baseline using 7 day rolling average
+            gas_calib_temps = gas_calib_temps[1:] + [round(readings_bus.value("Raw Temp"), 1)]
+            #print("Calib Temps", gas_calib_temps)
+            gas_calib_temp = round(sum(gas_calib_temps)/float(len(gas_calib_temps)), 1)
+            gas_calib_hums = gas_calib_hums[1:] + [round(readings_bus.value("Raw Hum"), 1)]
+            #print("Calib Hums", gas_calib_hums)
+            gas_calib_hum = round(sum(gas_calib_hums)/float(len(gas_calib_hums)), 0)
+            gas_calib_bars = gas_calib_bars[1:] + [round(readings_bus.value("Raw Bar"), 1)]
+            #print("Calib Bars", gas_calib_bars)
+            gas_calib_bar = round(sum(gas_calib_bars)/float(len(gas_calib_bars)), 1)
+            # Update R0s and create new calibration baseline
+            # spot_red_r0, spot_oxi_r0, spot_nh3_r0, raw_red_r0, raw_oxi_r0, raw_nh3_r0 = comp_gas(gas_calib_temp,
+            # gas_calib_hum, gas_calib_bar, raw_temp, raw_hum, raw_barometer)
+            spot_red_r0, spot_oxi_r0, spot_nh3_r0 = read_raw_gas(await on_i2c_bus('ADS1015', gas.read_all))
+            # Convert R0s to 7 day rolling average
+            reds_r0 = reds_r0[1:] + [round(spot_red_r0, 0)]
+            #print("Reds R0", reds_r0)
+            red_r0 = round(sum(reds_r0)/float(len(reds_r0)), 0)
+            oxis_r0 = oxis_r0[1:] + [round(spot_oxi_r0, 0)]
+            #print("Oxis R0", oxis_r0)
+            oxi_r0 = round(sum(oxis_r0)/float(len(oxis_r0)), 0)
+            nh3s_r0 = nh3s_r0[1:] + [round(spot_nh3_r0, 0)]
+            #print("NH3s R0", nh3s_r0)
+            nh3_r0 = round(sum(nh3s_r0)/float(len(nh3s_r0)), 0)
+        print('New R0s. Red R0:', red_r0, 'Oxi R0:', oxi_r0, 'NH3 R0:', nh3_r0)
+        print("New Calibration Baseline. Temp:", gas_calib_temp, "Hum:", gas_calib_hum,
+              "Barometer:", gas_calib_bar)
+        gas_daily_r0_calibration_completed = True
+    if int(today.strftime('%H')) == (gas_daily_r0_calibration_hour + 1) and gas_daily_r0_calibration_completed:
+        gas_daily_r0_calibration_completed = False
+
+# Config keys that are applied in-process when config.json changes. Changes to any other key are reported and only
+# take effect after a restart
+hot_config_keys = ['temp_offset', 'altitude', 'aio_user_name', 'aio_key', 'aio_feed_window', 'aio_feed_sequence',
+                   'enable_luftdaten_noise', 'disable_luftdaten_sensor_upload', 'enable_climate_and_gas_logging',
+                   'gas_daily_r0_calibration_hour', 'outdoor_source_id', 'city_name', 'time_zone', 'custom_locations']
+mqtt_config_keys = ['mqtt_broker_name', 'mqtt_username', 'mqtt_password', 'incoming_temp_hum_mqtt_topic',
+                    'incoming_temp_hum_mqtt_sensor_name', 'incoming_barometer_mqtt_topic',
+                    'incoming_barometer_sensor_id', 'outdoor_mqtt_topic', 'indoor_mqtt_topic'] # Applied by
+# reconnecting the mqtt client
+config_value_ranges = {'aio_feed_window': (0, 9), 'aio_feed_sequence': (0, 3), 'gas_daily_r0_calibration_hour': (0, 23)}
+config_restart_keys = set() # Changed config keys that are waiting for a restart
+config_watcher = None
+config_changed_event = None # Set when config.json has changed and has stopped changing
+config_debounce_handle = None
+
+def config_value_valid(name, value, current): # A changed key must keep the type of its current value
+    if value is None or current is None:
+        valid = True
+    elif isinstance(current, bool) or isinstance(value, bool):
+        valid = isinstance(value, bool) and isinstance(current, bool)
+    elif isinstance(current, (int, float)):
+        valid = isinstance(value, (int, float))
+    else:
+        valid = isinstance(value, type(current))
+    if valid and name in config_value_ranges:
+        valid = config_value_ranges[name][0] <= value <= config_value_ranges[name][1]
+    return valid
+
+def on_config_file_event(): # Called by the event loop when inotify reports a write in the config file's directory.
+    # Waits for the writes to stop before reloading, so that a partly written file isn't read
+    global config_debounce_handle
+    if config_watcher.changed():
+        if config_debounce_handle is not None:
+            config_debounce_handle.cancel()
+        config_debounce_handle = main_loop.call_later(1, config_changed_event.set)
+
+def check_config_file(): # Used instead of on_config_file_event when inotify isn't available
+    if config_watcher.changed():
+        config_changed_event.set()
+
+def restart_mqtt_client():
+    client.disconnect()
+    client.loop_stop()
+    if mqtt_username and mqtt_password:
+        client.username_pw_set(mqtt_username, mqtt_password)
+    else:
+        client.username_pw_set(None)
+    client.connect_async(mqtt_broker_name, 1883, 60)
+    client.loop_start() # on_connect subscribes to the new topics
+
+async def reload_config(): # Applies the changed config keys that don't need a restart
+    global config_restart_keys, aio_url, db
+    try:
+        new_config = dict(zip(config_variable_names, retrieve_config(read_config_file())))
+    except (IOError, ValueError, KeyError) as error: # ValueError when the json is invalid and KeyError when a
+        # required key is missing
+        print('Config Reload Failed. Keeping the Current Config.', repr(error))
+        return
+    config = globals()
+    changed_keys = [name for name in config_variable_names if new_config[name] != parsed_config[name]]
+    applied_keys = []
+    rejected_keys = []
+    for name in changed_keys:
+        if (name in hot_config_keys or name in mqtt_config_keys) and not config_value_valid(name, new_config[name],
+                                                                                            config[name]):
+            rejected_keys.append(name)
+    if enable_display and ('city_name' in changed_keys or 'time_zone' in changed_keys or
+                           'custom_locations' in changed_keys):
+        try: # Check that the sun and moon positions can still be found, with a new city database so that the
+            # one in use isn't changed unless the keys are accepted
+            new_db = database()
+            add_locations(new_config['custom_locations'], new_db)
+            lookup(new_config['city_name'], new_db)
+            pytz.timezone(new_config['time_zone'])
+        except (KeyError, ValueError, IndexError) as error:
+            print('Invalid Location Config.', repr(error))
+            rejected_keys.extend([name for name in ('city_name', 'time_zone', 'custom_locations') if name in changed_keys
+                                  and name not in rejected_keys])
+    restart_mqtt = False
+    for name in changed_keys:
+        if name in rejected_keys:
+            continue
+        if name in hot_config_keys or name in mqtt_config_keys:
+            config[name] = new_config[name]
+            parsed_config[name] = new_config[name] # Rejected and restart keys stay changed until they're applied
+            applied_keys.append(name)
+            if name in mqtt_config_keys and (enable_send_data_to_homemanager or enable_receive_data_from_homemanager
+                                             or (enable_indoor_outdoor_functionality and
+                                                 outdoor_source_type == 'Enviro')):
+                restart_mqtt = True
+    if enable_display and 'custom_locations' in applied_keys:
+        db = new_db
+    if enable_adafruit_io and 'aio_user_name' in applied_keys:
+        aio_url = "https://io.adafruit.com/api/v2/" + aio_user_name
+    config_restart_keys = set([name for name in changed_keys if name not in hot_config_keys and
+                               name not in mqtt_config_keys])
+    print('Config Reloaded. Applied:', applied_keys, 'Rejected:', rejected_keys, 'Restart Required For:',
+          sorted(config_restart_keys))
+    if restart_mqtt:
+        print('Restarting mqtt Client')
+        await run_blocking(restart_mqtt_client)
+
+async def start_handover(): # Starts the new software version, which asks for the handover once it has done its
+    # slow imports. This monitor keeps sampling until then
+    global handover_server, handover_start_time, handover_done
+    if os.path.exists(handover_socket): # Left by a monitor that didn't exit cleanly
+        os.unlink(handover_socket)
+    handover_done = asyncio.Event()
+    handover_server = await asyncio.start_unix_server(hand_over, path=handover_socket)
+    os.chmod(handover_socket, 0o600) # Only this monitor's user can connect
+    handover_start_time = clock.time()
+    subprocess.Popen([sys.executable] + sys.argv)
+
+def release_hardware(): # Stops using the microphone, particle sensor, display and mqtt connection so that the
+    # incoming monitor can set them up
+    noise_stream.abort()
+    if noise_worker_process is not None:
+        noise_worker_process.terminate()
+    if display_process is not None:
+        display_process.terminate()
+    if pms5003_reader is not None:
+        pms5003_reader.stop()
+    i2c_bus.stop()
+    if enable_particle_sensor and hasattr(pms5003, '_serial'):
+        pms5003._serial.close()
+    if enable_send_data_to_homemanager or enable_receive_data_from_homemanager or (enable_indoor_outdoor_functionality
+                                                                                  and outdoor_source_type == 'Enviro'):
+        client.disconnect() # The incoming monitor connects with the same client name
+        client.loop_stop()
+
+async def hand_over(reader, writer): # Called when the incoming monitor connects to the handover socket
+    if not same_user(writer.get_extra_info('socket')):
+        print('Handover Request From Another User Ignored')
+        writer.close()
+        return
+    try:
+        request = await read_message(reader)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        print('Incomplete Handover Request Ignored')
+        writer.close()
+        return
+    print('Handing Over to Software Version', request.decode(errors='replace'))
+    systemd_notifier.notify('STATUS=Handing Over')
+    scheduler.stop()
+    await asyncio.sleep(0) # Allow the duties to be cancelled before the state is captured
+    release_hardware()
+    storage_writer.flush()
+    state = {name: globals()[name] for name in handover_state_names if name in globals()}
+    state["Readings"] = readings_bus.latest
+    try:
+        await write_message(writer, pickle.dumps(state))
+        writer.close()
+        print('Handover Completed')
+    except ConnectionError: # The incoming monitor has gone, so restart instead
+        print('Handover Failed. Restarting aqimonitor')
+        os.system('sudo systemctl restart aqimonitor')
+    handover_server.close()
+    if os.path.exists(handover_socket):
+        os.unlink(handover_socket)
+    handover_done.set()
+
+async def run_monitor():
+    global main_loop, noise_sample_event, outdoor_data_event, config_watcher, config_changed_event
+    global watchdog_check_interval
+    main_loop = asyncio.get_running_loop()
+    startup_timeline.mark('Event Loop')
+    if clock.simulated: # The simulated clock can't be shared with another thread, so the scheduler runs the polls
+        scheduler.add_periodic('I2C Poll', 0, i2c_bus.run_due_polls)
+    else:
+        i2c_bus.start() # Started here rather than at setup so that it isn't running when the worker processes are
+        # forked
+    # Readings are taken in the same order as the original polling loop on the first pass
+    if enable_noise:
+        noise_sample_event = asyncio.Event()
+        scheduler.add_event('Noise', noise_sample_event, process_noise)
+        if noise_worker_process is not None:
+            main_loop.add_reader(noise_result_receiver.fileno(), receive_noise_result)
+    if enable_particle_sensor:
+        if pms5003_duty_cycle is not None:
+            scheduler.add_periodic('PM Duty Cycle', short_update_delay, duty_cycle_pm)
+        elif pms5003_reader is not None:
+            pms5003_reader.start() # Started here rather than at setup so that it isn't running when the worker
+            # processes are forked
+            scheduler.add_periodic('PM', 1, update_pm_values)
+        else:
+            scheduler.add_periodic('PM', 0, update_pm_values)
+    scheduler.add_periodic('Short Update', short_update_delay, short_update)
+    if enable_eco2_tvoc:
+        scheduler.add_task('SGP30 Bring Up', bring_up_sgp30)
+        scheduler.add_periodic('eCO2 TVOC', 1, update_eco2_tvoc)
+    if enable_adafruit_io and version_text is not None:
+        scheduler.add_task('AIO Startup Versions', send_startup_versions_to_aio)
+    scheduler.add_periodic('Barometer Log', 1200, update_barometer_log,
+                           first_delay=max(0, barometer_log_time + 1200 - clock.time()))
+    if (enable_indoor_outdoor_functionality and indoor_outdoor_function == 'Indoor'
+            and outdoor_source_type == 'Enviro'):
+        outdoor_data_event = asyncio.Event()
+        if captured_outdoor_data != {}: # Process any outdoor data that arrived before the main loop started
+            outdoor_data_event.set()
+        scheduler.add_event('Outdoor Data', outdoor_data_event, process_outdoor_data)
+    if display_process is not None:
+        scheduler.add_periodic('Shared State', display_update_interval, share_monitor_state)
+    else:
+        scheduler.add_periodic('Display', display_update_interval, update_display)
+    if enable_adafruit_io and aio_format != {}:
+        scheduler.add_periodic('Adafruit IO', 600, update_adafruit_io, first_delay=seconds_until_aio_window())
+    scheduler.add_periodic('Long Update', long_update_delay, long_update,
+                           first_delay=max(startup_stabilisation_time - get_run_time(), # Already stabilised after
+                                           # a process handover
+                                           long_update_time + long_update_delay - clock.time()))
+    scheduler.add_periodic('Comms Check', comms_check_interval, check_comms)
+    if storage_writer.flush_interval > 0:
+        scheduler.add_periodic('Storage Flush', storage_writer.flush_interval, flush_storage,
+                               first_delay=storage_writer.flush_interval)
+    # Heartbeat timeouts allow for each subsystem's slowest normal cadence
+    if enable_particle_sensor:
+        if pms5003_duty_cycle is not None: # Read once for each upload
+            heartbeats.register('PM Sensor', short_update_delay * 2 + pms5003_duty_cycle.lead_time() +
+                                (0 if adaptive_sampler is None else adaptive_sampler.max_climate_interval))
+        elif adaptive_sampler is not None:
+            heartbeats.register('PM Sensor', adaptive_sampler.max_pm_interval + 10)
+        else:
+            heartbeats.register('PM Sensor', 10)
+    if adaptive_sampler is not None:
+        heartbeats.register('Climate Sensor', adaptive_sampler.max_climate_interval + short_update_delay * 2)
+    else:
+        heartbeats.register('Climate Sensor', short_update_delay * 2)
+    if enable_noise:
+        heartbeats.register('Audio', 20 * noise_block_size / noise_sample_rate)
+    heartbeats.register('Uploads', comms_check_interval * 3)
+    if systemd_notifier.watchdog_enabled():
+        watchdog_check_interval = min(watchdog_check_interval, systemd_notifier.watchdog_interval / 2)
+    scheduler.add_periodic('Watchdog', watchdog_check_interval, kick_watchdog)
+    scheduler.add_periodic('Gas Calibration', 60, daily_gas_calibration)
+    config_watcher = ConfigFileWatcher(config_file)
+    config_changed_event = asyncio.Event()
+    scheduler.add_event('Config Reload', config_changed_event, reload_config)
+    if config_watcher.uses_inotify():
+        main_loop.add_reader(config_watcher.fileno(), on_config_file_event)
+    else:
+        scheduler.add_periodic('Config Watch', 5, check_config_file)
+    systemd_notifier.notify('READY=1', 'STATUS=Monitoring')
+    with noise_stream:
+        try:
+            await scheduler.run(clock.run_duration)
+        except EOFError: # A replayed sensor trace has no more readings
+            print('Sensor Trace Replay Completed at', clock.now(), 'Scheduler Jitter.', scheduler.jitter_summary(),
+                  'Load Shedding.', scheduler.shedding_summary())
+            return
+    if scheduler.stopped and handover_done is not None: # Exit once the live state has been handed over
+        await handover_done.wait()
+        return
+    if clock.simulated:
+        print('Simulated Clock Run Completed at', clock.now(), 'Scheduler Jitter.', scheduler.jitter_summary(),
+              'Load Shedding.', scheduler.shedding_summary())
 
+# Main loop
+scheduler = MonitorScheduler(load_shedding_budget)
+if enable_multi_process:
+    start_worker_processes()
+try:
+    asyncio.run(run_monitor())
 except KeyboardInterrupt:
     if enable_send_data_to_homemanager or enable_receive_data_from_homemanager:
         client.loop_stop()
     noise_stream.abort()
     print('Keyboard Interrupt')
 
+
 # Acknowledgements
 # Based on code from:
 # https://github.com/pimoroni/enviroplus-python/blob/master/examples/all-in-one.py
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Interval Aggregation
+# Summarises the readings that arrive between a sink's reports, so that Luftdaten, Adafruit IO and mqtt each receive
+# the statistics of their own reporting interval instead of the last instantaneous reading. Each metric keeps a
+# running count, total, minimum and maximum, and its median is taken from a small sorted window of its most recent
+# readings, so the memory used doesn't grow with the number of readings in an interval
+
+import bisect
+import collections
+
+class IntervalStatistics(object): # Streaming statistics of one metric's readings since the last reset
+    def __init__(self, median_window=15):
+        self.recent = collections.deque(maxlen=median_window) # In arrival order, so the oldest can be evicted
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.recent.clear()
+        self.sorted_recent = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if len(self.recent) == self.recent.maxlen:
+            del self.sorted_recent[bisect.bisect_left(self.sorted_recent, self.recent[0])]
+        self.recent.append(value)
+        bisect.insort(self.sorted_recent, value)
+
+    def median(self):
+        middle = len(self.sorted_recent) // 2
+        if len(self.sorted_recent) % 2 == 1:
+            return self.sorted_recent[middle]
+        return (self.sorted_recent[middle - 1] + self.sorted_recent[middle]) / 2
+
+    def summary(self, decimal_places):
+        return {'Mean': round(self.total / self.count, decimal_places),
+                'Median': round(self.median(), decimal_places), 'Min': round(self.minimum, decimal_places),
+                'Max': round(self.maximum, decimal_places), 'Count': self.count}
+
+class IntervalAggregator(object): # One sink's statistics for each aggregated metric. Its add method is used as a
+    # readings bus subscriber's callback
+    def __init__(self, decimal_places, median_window=15): # decimal_places - {metric name: decimal places}
+        self.decimal_places = decimal_places
+        self.statistics = {name: IntervalStatistics(median_window) for name in decimal_places}
+
+    def add(self, reading):
+        self.statistics[reading.name].add(reading.value)
+
+    def take(self): # Returns the statistics of each metric that has had readings since the last take, and starts a
+        # new interval
+        summaries = {}
+        for name, statistics in self.statistics.items():
+            if statistics.count > 0:
+                summaries[name] = statistics.summary(self.decimal_places[name])
+                statistics.reset()
+        return summaries
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Climate Samples
+# Reads the BME280's temperature, humidity and pressure together as one timestamped sample, so that the climate
+# readings and the gas sensor compensation all use values from the same conversion. The bme280 module's get_
+# functions each read all of the data registers again, so one burst read per sample replaces three
+
+import collections
+
+ClimateSample = collections.namedtuple('ClimateSample', ['temperature', 'humidity', 'pressure', 'time'])
+
+class BurstBME280(object): # Wraps the bme280 module's BME280
+    def __init__(self, bme280, clock):
+        self.bme280 = bme280
+        self.clock = clock
+
+    def read_sample(self):
+        self.bme280.update_sensor() # One burst read of the data registers, which hold a single conversion's results
+        return ClimateSample(self.bme280.temperature, self.bme280.humidity, self.bme280.pressure, self.clock.time())
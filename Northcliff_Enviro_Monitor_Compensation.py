@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Compensation Models
+# Evaluates the temperature, humidity and gas sensor compensation as models that are loaded from a coefficients file,
+# so that a new enclosure variant only needs a new set of coefficients. Polynomials are evaluated with Horner's
+# scheme and piecewise models select a polynomial for each range of their input. Every model takes a single reading
+# or a NumPy array of readings, so the same models serve the live readings and bulk reprocessing of logged data.
+# The built-in variants hold the coefficients from the regression analysis of each enclosure
+
+import bisect
+import json
+import numpy as np
+
+# Coefficients are listed from the highest power down to the constant
+builtin_models = {
+    "Variants": {
+        "Display": { # Display enabled (no weather protection cover in place) and no SGP30
+            "Temp": {"Polynomial": [-0.0001, 0.0037, 1.00568, -6.78291]},
+            "Hum": {"Polynomial": [-0.0032, 1.6931, 0.9391], "Max": 100}},
+        "Display SGP30": { # Display enabled (no weather protection cover in place) and an SGP30 in place
+            "Temp": {"Polynomial": [-0.00005, 0.00563, 0.76548, -5.2795]},
+            "Hum": {"Polynomial": [-0.0047, 2.1582, -3.8446], "Max": 100}},
+        "Weather Cover": { # Display disabled (weather protection cover in place)
+            "Temp": {"Polynomial": [0.00033, -0.03129, 1.8736, -14.82131]},
+            "Hum": {"Polynomial": [-0.0221, 3.3824, -25.8102], "Max": 100}}},
+    # Fractional change of each gas sensor's Rs for the difference of the raw temperature, humidity and pressure from
+    # their values at the last gas calibration, based on long term regression testing
+    "Gas": {
+        "Red": {"Temp": {"Polynomial": [-0.015, 0]}, "Hum": {"Polynomial": [0.0125, 0]},
+                "Bar": {"Polynomial": [-0.0053, 0]}},
+        "Oxi": {"Temp": {"Polynomial": [-0.017, 0]}, "Hum": {"Polynomial": [0.0115, 0]},
+                "Bar": {"Polynomial": [-0.0072, 0]}},
+        "NH3": {"Temp": {"Polynomial": [-0.02695, 0]}, "Hum": {"Polynomial": [0.0094, 0]},
+                "Bar": {"Polynomial": [0.003254, 0]}}}}
+
+def horner(coefficients, x): # Works unchanged on a float and on a NumPy array
+    result = 0.0
+    for coefficient in coefficients:
+        result = result * x + coefficient
+    return result
+
+class PolynomialModel(object):
+    def __init__(self, coefficients):
+        if len(coefficients) == 0:
+            raise ValueError('A polynomial model needs at least one coefficient')
+        self.coefficients = [float(coefficient) for coefficient in coefficients]
+
+    def evaluate(self, x):
+        return horner(self.coefficients, x)
+
+class PiecewiseModel(object): # Uses pieces[0] below breakpoints[0], pieces[i] from breakpoints[i - 1] up to
+    # breakpoints[i] and the last piece from the last breakpoint up
+    def __init__(self, breakpoints, pieces):
+        if len(pieces) != len(breakpoints) + 1:
+            raise ValueError('A piecewise model needs one more piece than it has breakpoints')
+        if list(breakpoints) != sorted(breakpoints):
+            raise ValueError('A piecewise model\'s breakpoints must be in ascending order')
+        self.breakpoints = list(breakpoints)
+        self.pieces = pieces
+
+    def evaluate(self, x):
+        if not isinstance(x, np.ndarray):
+            return self.pieces[bisect.bisect_right(self.breakpoints, x)].evaluate(x)
+        indices = np.searchsorted(self.breakpoints, x, side='right')
+        result = np.empty(x.shape)
+        for index, piece in enumerate(self.pieces):
+            selected = indices == index
+            if selected.any():
+                result[selected] = piece.evaluate(x[selected])
+        return result
+
+class ClippedModel(object): # Limits a model's result, such as humidity to 100%
+    def __init__(self, model, minimum=None, maximum=None):
+        self.model = model
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def evaluate(self, x):
+        result = self.model.evaluate(x)
+        if isinstance(result, np.ndarray):
+            return np.clip(result, self.minimum, self.maximum)
+        if self.maximum is not None:
+            result = min(self.maximum, result)
+        if self.minimum is not None:
+            result = max(self.minimum, result)
+        return result
+
+def build_model(spec): # spec - {"Polynomial": coefficients} or {"Piecewise": {"Breakpoints": [x values],
+    # "Pieces": [model specs]}}, with optional "Min" and "Max" limits
+    if "Polynomial" in spec:
+        model = PolynomialModel(spec["Polynomial"])
+    elif "Piecewise" in spec:
+        model = PiecewiseModel(spec["Piecewise"]["Breakpoints"],
+                               [build_model(piece) for piece in spec["Piecewise"]["Pieces"]])
+    else:
+        raise ValueError('A model needs "Polynomial" or "Piecewise" coefficients')
+    if "Min" in spec or "Max" in spec:
+        model = ClippedModel(model, spec.get("Min"), spec.get("Max"))
+    return model
+
+class GasCompensationModel(object): # Compensates a gas sensor's Rs for the change in temperature, humidity and
+    # pressure since its calibration
+    def __init__(self, spec):
+        self.temp = build_model(spec["Temp"])
+        self.hum = build_model(spec["Hum"])
+        self.bar = build_model(spec["Bar"])
+
+    def evaluate(self, raw_rs, temp_diff, hum_diff, bar_diff):
+        return raw_rs - raw_rs * (self.temp.evaluate(temp_diff) + self.hum.evaluate(hum_diff) +
+                                  self.bar.evaluate(bar_diff))
+
+class CompensationModels(object):
+    def __init__(self, variant, coefficients_file=None): # The coefficients file's variants and gas models are added
+        # to, or replace, the built-in ones
+        variants = dict(builtin_models["Variants"])
+        gas = dict(builtin_models["Gas"])
+        if coefficients_file is not None:
+            with open(coefficients_file, 'r') as f:
+                loaded_models = json.loads(f.read())
+            variants.update(loaded_models.get("Variants", {}))
+            gas.update(loaded_models.get("Gas", {}))
+        if variant not in variants:
+            raise ValueError('Unknown compensation variant ' + repr(variant))
+        self.variant = variant
+        variant_models = variants[variant]
+        self.temp = build_model(variant_models["Temp"])
+        self.hum = build_model(variant_models["Hum"])
+        gas.update(variant_models.get("Gas", {})) # A variant can have its own gas models
+        self.gas = {name: GasCompensationModel(gas[name]) for name in ("Red", "Oxi", "NH3")}
+
+    def temperature(self, raw_temp):
+        return self.temp.evaluate(raw_temp)
+
+    def humidity(self, raw_hum):
+        return self.hum.evaluate(raw_hum)
+
+    def gas_rs(self, name, raw_rs, temp_diff, hum_diff, bar_diff):
+        return self.gas[name].evaluate(raw_rs, temp_diff, hum_diff, bar_diff)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Config Watch
+# Watches the monitor's config.json file so that changes can be applied without restarting the monitor. Uses Linux
+# inotify on the config file's directory, so that editors and Mender updates that replace the file by renaming
+# another one over it are caught as well as those that write it in place. Falls back to checking the file's
+# modification time when inotify isn't available
+
+import os
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+event_format = struct.Struct('iIII') # Watch descriptor, mask, cookie and name length, followed by the name
+
+class ConfigFileWatcher(object):
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.config_directory = os.path.dirname(os.path.abspath(config_file))
+        self.config_name = os.path.basename(config_file)
+        self.fd = None
+        self.last_modified = self.modified_time()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(fd, self.config_directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, 'inotify_add_watch failed')
+            self.fd = fd
+        except (OSError, AttributeError) as error: # AttributeError when the C library has no inotify functions
+            print('Config File Notification Unavailable. Checking Modification Time Instead.', error)
+
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def fileno(self): # For the event loop's add_reader
+        return self.fd
+
+    def modified_time(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def changed(self): # True if the config file has been written since the last call. Doesn't block
+        if self.fd is None:
+            modified = self.modified_time()
+            if modified != self.last_modified:
+                self.last_modified = modified
+                return modified is not None
+            return False
+        changed = False
+        while True:
+            try:
+                events = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            position = 0
+            while position + event_format.size <= len(events):
+                wd, mask, cookie, length = event_format.unpack_from(events, position)
+                position += event_format.size
+                name = events[position:position + length].rstrip(b'\0').decode(errors='replace')
+                position += length
+                if name == self.config_name:
+                    changed = True
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Gas Sensors
+# Detects when the MICS6814 gas sensors have warmed up from how quickly their raw Rs readings are still drifting,
+# rather than waiting a fixed time after every cold start. Each sensor's drift rate is the slope of an exponentially
+# weighted least squares fit of ln(Rs) against time, so it's a fractional rate that's comparable across the three
+# sensors and only a handful of running sums are kept.
+# Once they're warm, each sensor's clean air Rs (its R0) is tracked continuously as a percentile of its Rs readings
+# over a sliding window of days. The readings are compensated to one fixed set of reference conditions before they're
+# counted, so that the diurnal climate swing doesn't set the percentile and the R0 describes the reference conditions
+# that later readings are compensated against. Each day's readings are counted in a fixed log-spaced histogram, so the
+# memory used is constant and a day's readings are dropped in one step when it leaves the window. Days are local
+# date ordinals, so that each day's histogram lines up with the local daily calibration hour
+
+import math
+import collections
+
+class DriftRateEstimator(object): # Readings fade out of the fit with the given time constant
+    def __init__(self, time_constant):
+        self.time_constant = time_constant
+        self.origin = None # Times are taken from the first reading to keep the sums well conditioned
+        self.last_time = None
+        self.weight = 0.0
+        self.sum_t = 0.0
+        self.sum_y = 0.0
+        self.sum_tt = 0.0
+        self.sum_ty = 0.0
+
+    def add(self, time, value):
+        if self.origin is None:
+            self.origin = time
+            self.last_time = time
+        decay = math.exp(-(time - self.last_time) / self.time_constant)
+        self.last_time = time
+        t = time - self.origin
+        y = math.log(value)
+        self.weight = self.weight * decay + 1
+        self.sum_t = self.sum_t * decay + t
+        self.sum_y = self.sum_y * decay + y
+        self.sum_tt = self.sum_tt * decay + t * t
+        self.sum_ty = self.sum_ty * decay + t * y
+
+    def slope(self): # Fractional change per second, or None until readings have been taken at two different times
+        denominator = self.weight * self.sum_tt - self.sum_t * self.sum_t
+        if denominator <= 0:
+            return None
+        return (self.weight * self.sum_ty - self.sum_t * self.sum_y) / denominator
+
+class GasWarmUpDetector(object): # Declares the gas sensors warm once the drift of all of their raw Rs readings has
+    # stayed below the threshold over the drift window
+    def __init__(self, settings, names=('Red', 'Oxi', 'NH3')):
+        if "Drift Threshold" in settings: # Percent per minute
+            self.drift_threshold = settings["Drift Threshold"]
+        else:
+            self.drift_threshold = 0.5
+        if "Window" in settings: # Seconds. The fit's time constant, and the time that readings must span
+            self.window = settings["Window"]
+        else:
+            self.window = 600
+        self.names = names
+        self.estimators = [DriftRateEstimator(self.window) for name in names]
+        self.first_time = None
+        self.last_time = None
+
+    def add(self, time, rs_values): # Adds a reading of each sensor's raw Rs. Returns True once they're warm
+        if self.first_time is None:
+            self.first_time = time
+        self.last_time = time
+        for estimator, rs in zip(self.estimators, rs_values):
+            estimator.add(time, max(rs, 1))
+        return self.warm()
+
+    def drift_rates(self): # Percent per minute for each sensor, or None if there aren't enough readings yet
+        slopes = [estimator.slope() for estimator in self.estimators]
+        if None in slopes:
+            return None
+        return [slope * 6000 for slope in slopes]
+
+    def warm(self):
+        drift_rates = self.drift_rates()
+        if drift_rates is None or self.last_time - self.first_time < self.window:
+            return False
+        return all([abs(drift_rate) <= self.drift_threshold for drift_rate in drift_rates])
+
+    def summary(self):
+        drift_rates = self.drift_rates()
+        if drift_rates is None:
+            return {}
+        return {name + ' %/min': round(drift_rate, 3) for name, drift_rate in zip(self.names, drift_rates)}
+
+class GasBaselineTracker(object):
+    min_rs = 1000 # Ohms. Lower and higher readings are counted in the end bins
+    bins_per_decade = 50 # About 5% wide bins. Percentiles are interpolated within their bins
+    decades = 4
+
+    def __init__(self, settings, names=('Red', 'Oxi', 'NH3')):
+        if "Days" in settings:
+            self.days = settings["Days"]
+        else:
+            self.days = 7
+        # Reducing gases and ammonia lower the Red and NH3 Rs, while oxidising gases raise the Oxi Rs, so clean air is
+        # at the top of the Red and NH3 readings and at the bottom of the Oxi readings
+        self.percentiles = {"Red": 90, "Oxi": 10, "NH3": 90}
+        if "Percentiles" in settings:
+            self.percentiles.update(settings["Percentiles"])
+        if "Min Readings" in settings: # Readings needed before the tracked baseline is used
+            self.min_readings = settings["Min Readings"]
+        else:
+            self.min_readings = 96
+        self.names = names
+        self.bins = self.bins_per_decade * self.decades
+        self.history = collections.deque(maxlen=self.days) # [day, [histogram for each sensor], readings]
+        self.reference = None # The [temp, hum, bar] raw climate that the tracked readings are compensated to
+
+    def bin(self, rs):
+        index = int((math.log10(max(rs, 1)) - math.log10(self.min_rs)) * self.bins_per_decade)
+        return min(max(index, 0), self.bins - 1)
+
+    def add(self, day, rs_values): # Adds an Rs reading of each sensor, compensated to the reference conditions.
+        # day - the local date's ordinal
+        if len(self.history) == 0 or self.history[-1][0] != day:
+            self.history.append([day, [[0] * self.bins for name in self.names], 0])
+        entry = self.history[-1]
+        for histogram, rs in zip(entry[1], rs_values):
+            histogram[self.bin(rs)] += 1
+        entry[2] += 1
+
+    def window(self, day): # The days that are still in the window
+        first_day = day - self.days + 1
+        return [entry for entry in self.history if entry[0] >= first_day]
+
+    def readings(self, day):
+        return sum([entry[2] for entry in self.window(day)])
+
+    def percentile_rs(self, histogram, percentile):
+        target = sum(histogram) * percentile / 100
+        count = 0
+        for index, bin_count in enumerate(histogram):
+            if bin_count > 0 and count + bin_count >= target:
+                position = index + (target - count) / bin_count
+                return self.min_rs * math.pow(10, position / self.bins_per_decade)
+            count += bin_count
+        return self.min_rs * math.pow(10, self.decades)
+
+    def baseline(self, day): # The clean air Rs of each sensor at the reference conditions over the window, or None if
+        # there are too few readings
+        window = self.window(day)
+        if sum([entry[2] for entry in window]) < self.min_readings:
+            return None
+        r0s = []
+        for sensor, name in enumerate(self.names):
+            histogram = [sum(counts) for counts in zip(*[entry[1][sensor] for entry in window])]
+            r0s.append(self.percentile_rs(histogram, self.percentiles[name]))
+        return r0s
+
+    def state(self): # Each histogram is stored from its first to its last occupied bin, to keep the persistent data
+        # log small
+        days = []
+        for day, histograms, readings in self.history:
+            stored_histograms = []
+            for histogram in histograms:
+                occupied = [index for index, count in enumerate(histogram) if count > 0]
+                if occupied == []:
+                    stored_histograms.append([0, []])
+                else:
+                    stored_histograms.append([occupied[0], histogram[occupied[0]:occupied[-1] + 1]])
+            days.append([day, stored_histograms, readings])
+        return {"Reference": self.reference, "Days": days}
+
+    def restore(self, state):
+        self.history.clear()
+        self.reference = state["Reference"]
+        for day, stored_histograms, readings in state["Days"]:
+            histograms = []
+            for first_bin, counts in stored_histograms:
+                histogram = [0] * self.bins
+                histogram[first_bin:first_bin + len(counts)] = counts
+                histograms.append(histogram)
+            self.history.append([day, histograms, readings])
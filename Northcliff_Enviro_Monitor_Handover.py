@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Process Handover
+# Lets a newly installed version of the monitor take over from the running one without losing its live state. The
+# running monitor listens on a Unix socket and starts the new version, which does its slow imports and then asks for
+# the handover. The running monitor stops sampling, releases the sensors, display, microphone and mqtt connection and
+# replies with its pickled live state before it exits. Messages are a little-endian uint32 length followed by the
+# payload. The socket is only accessible by its owner and both monitors check that the other end of the connection
+# is run by the same user, because the live state is pickled
+
+import os
+import socket
+import struct
+
+message_header = struct.Struct('<I')
+peer_credentials = struct.Struct('3i') # pid, uid, gid
+
+def same_user(sock): # True if the process at the other end of the Unix socket is run by this process's user
+    pid, uid, gid = peer_credentials.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                            peer_credentials.size))
+    return uid == os.getuid()
+
+def send_message(sock, payload):
+    sock.sendall(message_header.pack(len(payload)) + payload)
+
+def receive_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if chunk == b'':
+            raise EOFError('Handover Connection Closed')
+        data += chunk
+    return data
+
+def receive_message(sock):
+    length = message_header.unpack(receive_exactly(sock, message_header.size))[0]
+    return receive_exactly(sock, length)
+
+async def read_message(reader): # asyncio versions, used by the outgoing monitor
+    length = message_header.unpack(await reader.readexactly(message_header.size))[0]
+    return await reader.readexactly(length)
+
+async def write_message(writer, payload):
+    writer.write(message_header.pack(len(payload)) + payload)
+    await writer.drain()
+
+def request_handover(socket_path, request, timeout=60): # Used by the incoming monitor. Returns the outgoing
+    # monitor's state payload, or None if no monitor is waiting to hand over
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    if not same_user(sock):
+        print('Handover Socket is Owned by Another User. Not Taking Over')
+        sock.close()
+        return None
+    try:
+        sock.settimeout(timeout) # Allows for the outgoing monitor finishing its current sensor reads
+        send_message(sock, request)
+        return receive_message(sock)
+    finally:
+        sock.close()
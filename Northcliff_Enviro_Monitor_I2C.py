@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor I2C Bus Service
+# Owns the I2C bus that the BME280, LTR559, ADS1015 gas ADC and SGP30 share. A single thread runs every transaction,
+# one at a time, so that I2C latency never lands on the event loop's display and audio duties. Devices that need
+# regular reads are polled on their own cadences and their latest timestamped results are kept for the monitor to
+# take without waiting. Other transactions are queued and their results are returned through futures. The number of
+# transactions and the bus time are counted for each device
+
+import threading
+import queue
+import concurrent.futures
+
+class I2CBusService(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.requests = queue.Queue()
+        self.lock = threading.Lock() # Protects the polls, latest results and counts that the event loop reads
+        self.polls = {} # Name: [device, function, args, interval, next run time]
+        self.latest = {} # Name: (result, time)
+        self.transactions = {} # Device: [transactions, bus time]
+        self.total_bus_time = 0
+        self.start_time = clock.monotonic()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def running(self): # False until start is called, and with a simulated clock
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='I2C Bus', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.requests.put(None) # Wakes the thread
+        if self.running():
+            self.thread.join(timeout=5)
+
+    def add_poll(self, name, device, interval, function, *args): # Runs function(*args) every interval seconds
+        with self.lock:
+            self.polls[name] = [device, function, args, interval, self.clock.monotonic()]
+
+    def value(self, name): # The latest result of a poll, or None if it hasn't run yet
+        with self.lock:
+            if name in self.latest:
+                return self.latest[name][0]
+        return None
+
+    def result(self, name): # The latest (result, time) of a poll, or None if it hasn't run yet
+        with self.lock:
+            return self.latest.get(name)
+
+    def transact(self, device, function, args):
+        start_time = self.clock.monotonic()
+        nested_bus_time = self.total_bus_time
+        try:
+            return function(*args)
+        finally:
+            # Transactions that run_pending ran in the middle of this one are counted against their own devices
+            bus_time = self.clock.monotonic() - start_time - (self.total_bus_time - nested_bus_time)
+            with self.lock:
+                counts = self.transactions.setdefault(device, [0, 0])
+                counts[0] += 1
+                counts[1] += bus_time
+                self.total_bus_time += bus_time
+
+    def submit(self, device, function, *args): # Returns a concurrent.futures.Future of function(*args). Runs it
+        # inline when the bus thread isn't running, which is only at startup, at shutdown and with a simulated clock
+        future = concurrent.futures.Future()
+        if self.running():
+            self.requests.put((future, device, function, args))
+        else:
+            self.run_request((future, device, function, args))
+        return future
+
+    def call(self, device, function, *args): # Blocks until the transaction has been run
+        return self.submit(device, function, *args).result()
+
+    def run_request(self, request):
+        future, device, function, args = request
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.transact(device, function, args))
+        except Exception as error:
+            print('I2C Transaction Failed.', device, error)
+            future.set_exception(error)
+
+    def run_due_polls(self): # Returns the time until the next poll is due. Called by the bus thread, or by the
+        # monitor's scheduler with a simulated clock
+        now = self.clock.monotonic()
+        with self.lock:
+            due = [(name, poll) for name, poll in self.polls.items() if poll[4] <= now]
+        for name, poll in due:
+            device, function, args, interval, next_time = poll
+            try:
+                result = self.transact(device, function, args)
+            except Exception as error:
+                print('I2C Poll Failed.', name, error)
+            else:
+                with self.lock:
+                    self.latest[name] = (result, self.clock.time())
+            poll[4] = max(next_time + interval, now) # Keeps the cadence without catching up on missed polls
+        with self.lock:
+            if self.polls == {}:
+                return 1
+            return max(0, min([poll[4] for poll in self.polls.values()]) - self.clock.monotonic())
+
+    def run_pending(self): # Runs the queued requests and due polls. Passed to long transactions, such as the SGP30
+        # warm up, so that the other devices aren't held up between its steps. Does nothing off the bus thread
+        if threading.current_thread() is not self.thread:
+            return
+        self.run_due_polls()
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                self.run_request(request)
+
+    def run(self):
+        while not self.stopping.is_set():
+            delay = self.run_due_polls()
+            try:
+                request = self.requests.get(timeout=delay)
+            except queue.Empty:
+                continue
+            if request is not None:
+                self.run_request(request)
+
+    def summary(self): # Transactions and bus time per device, with the fraction of the time that the bus was busy
+        hours = max(self.clock.monotonic() - self.start_time, 1) / 3600
+        with self.lock:
+            return {device: {'Transactions Per Hour': round(counts[0] / hours),
+                             'Bus Time': round(counts[1], 2),
+                             'Busy %': round(counts[1] / (hours * 36), 3)}
+                    for device, counts in self.transactions.items()}
+
+class PolledProximity(object): # The LTR559's latest polled proximity reading, with the interface of the ltr559
+    # module's LTR559
+    def __init__(self, i2c_bus, name='Proximity'):
+        self.i2c_bus = i2c_bus
+        self.name = name
+
+    def get_proximity(self):
+        proximity = self.i2c_bus.value(self.name)
+        if proximity is None:
+            return 0
+        return proximity
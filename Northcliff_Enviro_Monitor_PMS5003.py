@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor PMS5003 Reader
+# Reads the PMS5003's frames continuously in a dedicated thread and queues them, so that waiting for the sensor's
+# next frame and recovering from read errors never holds up the monitor's event loop. The monitor takes the frames
+# that have arrived since it last looked without blocking. Read errors are recovered from by resetting the sensor,
+# backing off for longer after each consecutive failure. StreamingPMS5003 reads the serial port in bulk and finds the
+# frames in the byte stream itself, so that a corrupted frame is skipped instead of needing a sensor reset. It can
+# also put the sensor into passive mode and to sleep, so that PMS5003DutyCycle only runs it for a burst of reads ahead
+# of each upload. PMS5003FrameStore keeps every frame's full data, including the atmospheric environment values and
+# the particle count bins, with rolling statistics of each value
+
+import collections
+import threading
+import struct
+import time
+import numpy as np
+
+frame_start = b'\x42\x4d'
+frame_length = 28 # The frame length field's value. Covers the data and the checksum
+frame_size = 32 # Including the start marker and the length field
+response_length = 4 # The length field's value in the sensor's responses to commands
+
+def pms5003_command(command, data): # Builds a command frame for the sensor
+    frame = frame_start + bytes([command, data >> 8, data & 0xff])
+    return frame + struct.pack('>H', sum(frame))
+
+passive_mode_command = pms5003_command(0xe1, 0x0000) # Only sends a frame when asked for one
+active_mode_command = pms5003_command(0xe1, 0x0001) # Sends a frame every second. The sensor's default
+passive_read_command = pms5003_command(0xe2, 0x0000)
+sleep_command = pms5003_command(0xe4, 0x0000) # Stops the fan
+wake_command = pms5003_command(0xe4, 0x0001)
+
+# The first 12 values of a frame's data, in their frame order. The counts are particles per 0.1 L of air that are
+# larger than the given size in um
+frame_value_names = ["P1", "P2.5", "P10", "P1 Atm", "P2.5 Atm", "P10 Atm", ">0.3um", ">0.5um", ">1.0um", ">2.5um",
+                     ">5.0um", ">10um"]
+frame_record_type = np.dtype([("Time", "<f8"), ("Values", "<u2", (len(frame_value_names),))]) # 32 bytes a frame
+
+class AveragedPMValues(object): # The mean of a group of PMS5003 frames, with the same interface as a single frame
+    def __init__(self, frames):
+        self.frames = frames
+    def pm_ug_per_m3(self, size):
+        return round(sum([frame.pm_ug_per_m3(size) for frame in self.frames]) / len(self.frames))
+
+class PMS5003Reader(object):
+    def __init__(self, pms5003, errors, queue_length=30, max_backoff=30):
+        self.pms5003 = pms5003
+        self.errors = errors # (ReadTimeoutError, ChecksumMismatchError)
+        self.frames = collections.deque(maxlen=queue_length) # The oldest frames are dropped if they aren't taken
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.read_errors = 0 # Since the frames were last taken
+        self.consecutive_errors = 0
+        self.exception = None # An unexpected exception from the reader thread, raised again by take
+        self.discard_buffered = False
+        self.running = threading.Event() # Cleared while PM sampling is paused
+        self.running.set()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.read_frames, name='PMS5003 Reader', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self): # Returns once the thread has finished its current read
+        self.stopping.set()
+        self.running.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+
+    def pause(self): # Stops reading frames until resume is called
+        self.running.clear()
+
+    def resume(self):
+        if not self.running.is_set():
+            self.discard_buffered = True # Frames that were sent while PM sampling was paused are stale
+            self.running.set()
+
+    def paused(self):
+        return not self.running.is_set()
+
+    def read_frames(self):
+        while not self.stopping.is_set():
+            self.running.wait()
+            if self.stopping.is_set():
+                break
+            if self.discard_buffered:
+                self.discard_buffered = False
+                if hasattr(self.pms5003, 'discard_buffered'):
+                    self.pms5003.discard_buffered()
+                elif hasattr(self.pms5003, '_serial'):
+                    self.pms5003._serial.reset_input_buffer()
+            try:
+                pm_values = self.pms5003.read()
+            except self.errors:
+                with self.lock:
+                    self.read_errors += 1
+                self.consecutive_errors += 1
+                if self.consecutive_errors > 1: # Back off when a reset hasn't cleared the fault
+                    backoff = min(2 ** (self.consecutive_errors - 2), self.max_backoff)
+                    if self.stopping.wait(backoff):
+                        break
+                self.pms5003.reset()
+                continue
+            except Exception as error:
+                if self.stopping.is_set(): # The serial port was closed while the thread was reading it
+                    break
+                with self.lock:
+                    self.exception = error
+                break
+            self.consecutive_errors = 0
+            with self.lock:
+                self.frames.append(pm_values)
+
+    def take(self): # Returns the frames that have arrived since the last call and the number of read errors. Doesn't
+        # block
+        with self.lock:
+            if self.exception is not None:
+                raise self.exception
+            frames = list(self.frames)
+            self.frames.clear()
+            read_errors = self.read_errors
+            self.read_errors = 0
+        return frames, read_errors
+
+class PMS5003FrameParser(object): # Finds PMS5003 frames in a stream of bytes. Serial data is read straight into the
+    # parser's buffer and frames are checked in place, so only the data part of each valid frame is copied
+    def __init__(self, frame_data_class, buffer_size=256):
+        self.frame_data_class = frame_data_class # Made from the frame's data part, like the pms5003 module's
+        # PMS5003Data
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # The buffered bytes that haven't been parsed are self.buffer[self.start:self.end]
+        self.end = 0
+        self.synchronised = True
+        self.good_frames = 0
+        self.bad_frames = 0 # Frames with an invalid length or checksum
+        self.resyncs = 0 # Times that a valid frame has been found again after a bad frame or bytes that weren't part
+        # of a frame
+        self.responses = 0 # Responses to commands, which are skipped
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+    def write_view(self): # The free part of the buffer, for the serial port's readinto
+        if self.start == self.end:
+            self.clear()
+        elif self.end == len(self.buffer): # Move the unparsed bytes to the start of the buffer
+            unparsed = self.end - self.start
+            self.buffer[:unparsed] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = unparsed
+        return self.view[self.end:]
+
+    def written(self, count): # Called after count bytes have been read into the write_view
+        self.end += count
+
+    def feed(self, data):
+        while len(data) > 0:
+            view = self.write_view()
+            count = min(len(data), len(view))
+            view[:count] = data[:count]
+            self.written(count)
+            data = data[count:]
+
+    def lose_sync(self):
+        self.synchronised = False
+
+    def next_frame(self): # Returns the next valid frame, or None if there isn't a complete one in the buffer
+        while True:
+            header = self.buffer.find(frame_start, self.start, self.end)
+            if header < 0: # Keep a final 0x42 because it could be the first half of a start marker
+                if self.end > self.start and self.buffer[self.end - 1] == frame_start[0]:
+                    if self.end - 1 > self.start:
+                        self.lose_sync()
+                    self.start = self.end - 1
+                elif self.end > self.start:
+                    self.lose_sync()
+                    self.start = self.end
+                return None
+            if header > self.start:
+                self.lose_sync()
+                self.start = header
+            if self.end - self.start < 4:
+                return None
+            length = struct.unpack_from('>H', self.buffer, self.start + 2)[0]
+            if length == response_length:
+                if self.end - self.start < response_length + 4:
+                    return None
+                response = self.view[self.start:self.start + response_length + 4]
+                if sum(response[:-2]) & 0xffff == struct.unpack_from('>H', response, response_length + 2)[0]:
+                    self.responses += 1
+                    self.start += response_length + 4
+                    continue
+                length = None # Not a valid response
+            if length != frame_length:
+                self.bad_frames += 1
+                self.lose_sync()
+                self.start += len(frame_start) # Look for the next start marker
+                continue
+            if self.end - self.start < frame_size:
+                return None
+            frame = self.view[self.start:self.start + frame_size]
+            if sum(frame[:-2]) & 0xffff != struct.unpack_from('>H', frame, frame_size - 2)[0]:
+                self.bad_frames += 1
+                self.lose_sync()
+                self.start += len(frame_start)
+                continue
+            self.good_frames += 1
+            if not self.synchronised:
+                self.resyncs += 1
+                self.synchronised = True
+            raw_data = bytearray(frame[4:])
+            self.start += frame_size
+            return self.frame_data_class(raw_data)
+
+    def summary(self):
+        return {'Good Frames': self.good_frames, 'Bad Frames': self.bad_frames, 'Resyncs': self.resyncs,
+                'Responses': self.responses}
+
+class StreamingPMS5003(object): # Reads a pms5003 module PMS5003 through a PMS5003FrameParser instead of its read
+    # method, which raises an error for each corrupted frame
+    def __init__(self, pms5003, frame_data_class, timeout_error, timeout=5):
+        self.pms5003 = pms5003
+        self.parser = PMS5003FrameParser(frame_data_class)
+        self.timeout_error = timeout_error # Raised when there's no valid frame for timeout seconds
+        self.timeout = timeout
+        self.passive = False
+        self.request_interval = 1 # Time after which a passive mode request that hasn't been answered is repeated
+
+    @property
+    def _serial(self):
+        return self.pms5003._serial
+
+    def read(self): # Blocks until the next valid frame. In passive mode, the frame is requested
+        start_time = time.monotonic()
+        request_time = None
+        while True:
+            pm_values = self.parser.next_frame()
+            if pm_values is not None:
+                return pm_values
+            if time.monotonic() - start_time > self.timeout:
+                raise self.timeout_error('PMS5003 Read Timeout: No valid frame')
+            if self.passive and (request_time is None or time.monotonic() - request_time > self.request_interval):
+                self.send_command(passive_read_command)
+                request_time = time.monotonic()
+            waiting = self.pms5003._serial.in_waiting
+            if self.passive and waiting == 0: # Poll, so that an unanswered request can be repeated
+                time.sleep(0.05)
+                continue
+            view = self.parser.write_view()
+            # Read everything that's waiting, or wait for the next byte
+            count = self.pms5003._serial.readinto(view[:max(1, min(waiting, len(view)))])
+            self.parser.written(count)
+
+    def send_command(self, command):
+        self.pms5003._serial.write(command)
+        self.pms5003._serial.flush()
+
+    def wake(self):
+        self.send_command(wake_command)
+
+    def sleep(self):
+        self.send_command(sleep_command)
+
+    def set_passive_mode(self): # Frames that were sent in active mode are discarded
+        self.discard_buffered()
+        self.send_command(passive_mode_command)
+        self.passive = True
+
+    def reset(self): # Also returns the sensor to active mode
+        self.passive = False
+        self.parser.clear()
+        self.parser.lose_sync()
+        self.pms5003.reset()
+
+    def discard_buffered(self):
+        self.pms5003._serial.reset_input_buffer()
+        self.parser.clear()
+        self.parser.lose_sync()
+
+    def summary(self):
+        return self.parser.summary()
+
+class PMS5003DutyCycle(object): # Settings for running the PMS5003 only for a burst of passive mode reads ahead of
+    # each upload, and putting it to sleep in between
+    def __init__(self, settings):
+        if "Spin Up" in settings: # Time that the fan needs to run for before the readings are stable
+            self.spin_up = settings["Spin Up"]
+        else:
+            self.spin_up = 30
+        if "Burst" in settings: # Number of frames that are averaged, one a second
+            self.burst = settings["Burst"]
+        else:
+            self.burst = 5
+        self.read_interval = 1
+
+    def lead_time(self): # How long before the readings are needed that the sensor has to be woken. Allows a few
+        # seconds for the commands and the serial reads
+        return self.spin_up + self.burst * self.read_interval + 5
+
+class PMS5003FrameStore(object): # Keeps the latest frames in a fixed size record array, with the rolling mean and
+    # standard deviation of each of their values over the latest window of frames. The statistics are updated as each
+    # frame is added, from running sums that are exact because the values are integers
+    def __init__(self, clock, capacity=3600, window=300):
+        self.clock = clock
+        self.records = np.zeros(capacity, dtype=frame_record_type)
+        self.window = min(window, capacity)
+        self.frame_count = 0 # Total frames added
+        self.sums = np.zeros(len(frame_value_names))
+        self.squares = np.zeros(len(frame_value_names))
+        self.lock = threading.Lock() # Records can be read from an executor thread
+
+    def add(self, pm_values): # A frame with the interface of the pms5003 module's PMS5003Data
+        values = np.array(pm_values.data[:len(frame_value_names)], dtype=np.float64)
+        with self.lock:
+            if self.frame_count >= self.window: # Remove the frame that's leaving the window
+                leaving = self.records[(self.frame_count - self.window) % len(self.records)]["Values"]
+                self.sums -= leaving
+                self.squares -= np.square(leaving, dtype=np.float64)
+            self.records[self.frame_count % len(self.records)] = (self.clock.time(), values)
+            self.sums += values
+            self.squares += np.square(values)
+            self.frame_count += 1
+
+    def frames(self): # The stored frames, oldest first
+        with self.lock:
+            if self.frame_count <= len(self.records):
+                return self.records[:self.frame_count].copy()
+            return np.roll(self.records, -(self.frame_count % len(self.records))).copy()
+
+    def statistics(self): # Rolling mean and standard deviation of each value, or None if there are no frames
+        with self.lock:
+            count = min(self.frame_count, self.window)
+            if count == 0:
+                return None
+            means = self.sums / count
+            deviations = np.sqrt(np.maximum(self.squares / count - np.square(means), 0))
+            latest = self.records[(self.frame_count - 1) % len(self.records)]["Values"]
+        return {name: {"Latest": int(latest[index]), "Mean": round(float(means[index]), 1),
+                       "SD": round(float(deviations[index]), 1)} for index, name in enumerate(frame_value_names)}
+
+    def summary(self): # Rolling means of the atmospheric environment values and the particle counts, for mqtt, the
+        # display and the environment log
+        statistics = self.statistics()
+        if statistics is None:
+            return None
+        return {"Frames": min(self.frame_count, self.window),
+                "Atmospheric": {name[:-4]: statistics[name]["Mean"] for name in frame_value_names[3:6]},
+                "Counts": {name: statistics[name]["Mean"] for name in frame_value_names[6:]},
+                "Count SDs": {name: statistics[name]["SD"] for name in frame_value_names[6:]}}
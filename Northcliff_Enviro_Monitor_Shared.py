@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Shared State
+# Shared memory blocks that let the monitor's acquisition, noise DSP and display processes exchange their latest
+# state without pickling it through pipes or blocking each other. Requires Python 3.8 or later
+
+import struct
+import zlib
+import time
+from multiprocessing import shared_memory
+
+class SeqlockBlock(object): # A latest-value shared memory block with one writer and any number of readers. The
+    # writer makes the sequence number odd while it's writing and readers retry if the sequence number was odd or
+    # changed during their read. A CRC of the payload also catches torn reads on CPUs that reorder stores
+    header_format = struct.Struct('<QQI') # Sequence number, payload length, payload CRC
+
+    def __init__(self, size):
+        self.size = size
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=self.header_format.size + size)
+        self.shared_memory.buf[:self.header_format.size] = bytes(self.header_format.size)
+        self.sequence = 0 # Only used by the writer
+
+    def write(self, payload):
+        if len(payload) > self.size:
+            raise ValueError('Payload of ' + str(len(payload)) + ' bytes is too large for the shared memory block')
+        buf = self.shared_memory.buf
+        self.sequence += 1
+        struct.pack_into('<Q', buf, 0, self.sequence)
+        buf[self.header_format.size:self.header_format.size + len(payload)] = payload
+        struct.pack_into('<QI', buf, 8, len(payload), zlib.crc32(payload))
+        self.sequence += 1
+        struct.pack_into('<Q', buf, 0, self.sequence)
+
+    def read(self): # Returns the sequence number and payload of the latest write, or (0, None) before the first write
+        buf = self.shared_memory.buf
+        while True:
+            sequence, length, crc = self.header_format.unpack_from(buf, 0)
+            if sequence == 0:
+                return 0, None
+            if sequence % 2 == 0:
+                payload = bytes(buf[self.header_format.size:self.header_format.size + length])
+                if struct.unpack_from('<Q', buf, 0)[0] == sequence and zlib.crc32(payload) == crc:
+                    return sequence, payload
+            time.sleep(0.0001) # The writer is part way through a write
+
+    def sequence_number(self): # Allows readers to cheaply check for a new write
+        return struct.unpack_from('<Q', self.shared_memory.buf, 0)[0]
+
+    def close(self): # Only called by the process that created the block
+        self.shared_memory.close()
+        self.shared_memory.unlink()
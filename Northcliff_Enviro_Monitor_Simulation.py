@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Simulated Hardware
+# Synthetic stand-ins for the Enviro+ sensors, display and microphone, so that the monitor can be run and profiled
+# without an Enviro+ board. Each device call blocks for a configurable latency on the monitor's clock, matching
+# the time that the real device takes
+
+import math
+import random
+import struct
+import asyncio
+import numpy as np
+from Northcliff_Enviro_Monitor_Climate import ClimateSample
+
+# Approximate time in seconds that each real device call takes
+default_latencies = {"BME280": 0.002, # One I2C register burst per sample
+                     "PMS5003": 1.0, # Waiting for the next frame in active mode
+                     "Gas": 0.015, # Three ADS1015 single-shot conversions
+                     "LTR559": 0.001,
+                     "SGP30": 0.012, # measure_air_quality command duration
+                     "SGP30 Warmup": 15, # start_measurement waits for the sensor to leave its default readings
+                     "Display": 0.025} # 160x80 RGB565 frame over SPI at 10MHz
+
+class ReadTimeoutError(Exception):
+    pass
+
+class ChecksumMismatchError(Exception):
+    pass
+
+class SimulatedEnvironment(object): # Shared model of the environment that all the simulated devices read from
+    def __init__(self, clock, simulated_hardware):
+        self.clock = clock
+        self.latencies = dict(default_latencies)
+        if "Latencies" in simulated_hardware:
+            self.latencies.update(simulated_hardware["Latencies"])
+        if "PMS5003 Error Rate" in simulated_hardware: # Proportion of PMS5003 reads that fail
+            self.pms5003_error_rate = simulated_hardware["PMS5003 Error Rate"]
+        else:
+            self.pms5003_error_rate = 0
+        if "Gas Pollution" in simulated_hardware: # False keeps the gas sensors in clean air, to check their calibration
+            self.gas_pollution = simulated_hardware["Gas Pollution"]
+        else:
+            self.gas_pollution = True
+        if "Seed" in simulated_hardware:
+            seed = simulated_hardware["Seed"]
+        else:
+            seed = None
+        self.random = random.Random(seed)
+        self.audio_random = np.random.RandomState(seed)
+        self.power_on_time = clock.time()
+        self.pm_events = [] # [start time, peak PM2.5, decay time constant] for cooking, smoke and traffic events
+        self.next_pm_event_time = self.power_on_time + self.random.expovariate(3 / 86400) # About three per day
+        self.next_tap_time = self.power_on_time + self.random.expovariate(1 / 600) # About one tap every 10 minutes
+        self.tap_end_time = 0
+        self.noise_event_end_time = 0
+        self.next_noise_event_time = self.power_on_time + self.random.expovariate(1 / 1800)
+
+    def wait(self, device): # Blocks for the device's latency on the monitor's clock
+        self.clock.sleep(self.latencies[device])
+
+    def hour_of_day(self):
+        now = self.clock.now()
+        return now.hour + now.minute / 60 + now.second / 3600
+
+    def daylight(self): # 0 at night, rising to 1 at midday
+        return max(0, math.sin(2 * math.pi * (self.hour_of_day() - 6) / 24))
+
+    def temperature(self): # Diurnal cycle peaking mid afternoon
+        return 20 + 6 * math.sin(2 * math.pi * (self.hour_of_day() - 9) / 24) + self.random.gauss(0, 0.05)
+
+    def humidity(self): # Relative humidity falls as the temperature rises
+        return min(95, max(20, 60 - 2.5 * (self.temperature() - 20) + self.random.gauss(0, 0.3)))
+
+    def pressure(self): # Weather systems passing every few days plus the semi-diurnal atmospheric tide
+        elapsed = self.clock.time()
+        return (1012 + 6 * math.sin(2 * math.pi * elapsed / 259200) +
+                0.6 * math.sin(4 * math.pi * self.hour_of_day() / 24) + self.random.gauss(0, 0.03))
+
+    def pm2_5(self): # Clean background with decaying spikes
+        now = self.clock.time()
+        while now >= self.next_pm_event_time:
+            self.pm_events.append([self.next_pm_event_time, self.random.uniform(20, 150), self.random.uniform(600, 2400)])
+            self.next_pm_event_time += self.random.expovariate(3 / 86400)
+        self.pm_events = [event for event in self.pm_events if now - event[0] < 10 * event[2]]
+        pm = 4 + 2 * self.daylight()
+        for event in self.pm_events:
+            if now >= event[0]:
+                pm += event[1] * math.exp(-(now - event[0]) / event[2])
+        return max(0, pm + self.random.gauss(0, 0.5))
+
+    def gas_resistances(self): # Warm up settling, slow baseline drift, climate sensitivity and pollution events. The
+        # climate sensitivity is exponential, with the fractional rates of the monitor's gas compensation in terms of
+        # the BME280's raw readings, so the Rs falls as the temperature rises
+        elapsed = self.clock.time() - self.power_on_time
+        warmup = 1 - math.exp(-elapsed / 1800)
+        drift = 1 - 0.01 * elapsed / 86400
+        temp_diff = self.temperature() - 20
+        hum_diff = 0.7 * (self.humidity() - 50)
+        bar_diff = self.pressure() - 1012
+        if self.gas_pollution:
+            pollution = (self.pm2_5() - 5) / 100
+        else:
+            pollution = 0
+        red_rs = (200000 * (0.6 + 0.4 * warmup) * drift *
+                  math.exp(-0.015 * temp_diff + 0.0125 * hum_diff - 0.0053 * bar_diff) / (1 + pollution))
+        oxi_rs = (20000 * (1.5 - 0.5 * warmup) * drift *
+                  math.exp(-0.017 * temp_diff + 0.0115 * hum_diff - 0.0072 * bar_diff) * (1 + 0.5 * pollution))
+        nh3_rs = (150000 * (0.7 + 0.3 * warmup) * drift *
+                  math.exp(-0.02695 * temp_diff + 0.0094 * hum_diff + 0.003254 * bar_diff) / (1 + 0.5 * pollution))
+        return (max(1, red_rs * self.random.gauss(1, 0.005)), max(1, oxi_rs * self.random.gauss(1, 0.005)),
+                max(1, nh3_rs * self.random.gauss(1, 0.005)))
+
+    def lux(self):
+        return max(0, 5 + 800 * self.daylight() + self.random.gauss(0, 2))
+
+    def proximity(self): # Occasional taps on the sensor to change the display
+        now = self.clock.time()
+        if now >= self.next_tap_time:
+            self.tap_end_time = now + 0.3
+            self.next_tap_time = now + self.random.expovariate(1 / 600)
+        if now < self.tap_end_time:
+            return 2000 + self.random.randint(0, 200)
+        return self.random.randint(0, 20)
+
+    def occupancy(self): # Indoor occupancy for eCO2 and TVOC, higher in the morning and evening
+        hour = self.hour_of_day()
+        return 0.5 + 0.5 * math.cos(2 * math.pi * (hour - 19) / 24) * (hour > 6)
+
+    def eco2_tvoc(self):
+        occupancy = self.occupancy()
+        eco2 = int(400 + 600 * occupancy + self.random.gauss(0, 10))
+        tvoc = int(max(0, 50 + 250 * occupancy + self.random.gauss(0, 5)))
+        return max(400, eco2), tvoc
+
+    def noise_level(self): # dB(A) target for the next audio block
+        now = self.clock.time()
+        if now >= self.next_noise_event_time:
+            self.noise_event_end_time = now + self.random.uniform(2, 30)
+            self.next_noise_event_time = now + self.random.expovariate(1 / 1800)
+        level = 45 + 20 * self.daylight()
+        if now < self.noise_event_end_time:
+            level += 20
+        return level
+
+    def audio_block(self, frames, noise_ref_level=0.000001): # Pink noise at the current noise level, with a small
+        # microphone DC offset
+        white = self.audio_random.standard_normal(frames)
+        spectrum = np.fft.rfft(white)
+        spectrum[1:] /= np.sqrt(np.arange(1, len(spectrum)))
+        pink = np.fft.irfft(spectrum, n=frames)
+        pink /= np.sqrt(np.mean(np.square(pink)))
+        return (pink * noise_ref_level * 10 ** (self.noise_level() / 20) + 0.00001).astype(np.float32).reshape(frames, 1)
+
+class SimulatedBME280(object):
+    def __init__(self, environment):
+        self.environment = environment
+    def read_sample(self):
+        self.environment.wait("BME280")
+        return ClimateSample(self.environment.temperature() + 6, # Allow for heating from the Raspberry Pi
+                             self.environment.humidity() * 0.7, self.environment.pressure(),
+                             self.environment.clock.time())
+
+class PMS5003FrameData(object): # Same interface as the pms5003 module's PMS5003Data
+    def __init__(self, raw_data):
+        self.raw_data = raw_data
+        self.data = struct.unpack(">14H", raw_data)
+        self.checksum = self.data[13]
+    def pm_ug_per_m3(self, size, atmospheric_environment=False):
+        if atmospheric_environment:
+            return self.data[{1.0: 3, 2.5: 4, 10: 5}[size]]
+        return self.data[{1.0: 0, 2.5: 1, 10: 2}[size]]
+    def pm_per_1l_air(self, size):
+        return self.data[{0.3: 6, 0.5: 7, 1.0: 8, 2.5: 9, 5: 10, 10: 11}[size]]
+
+def simulated_pms5003_frame(pm2_5): # Builds the data part of a PMS5003 frame, including its checksum
+    pm_values = [round(pm2_5 * 0.65), round(pm2_5), round(pm2_5 * 1.3)]
+    counts = [round(pm2_5 * 180), round(pm2_5 * 55), round(pm2_5 * 9), round(pm2_5 * 0.8), round(pm2_5 * 0.25),
+              round(pm2_5 * 0.1)]
+    values = pm_values + pm_values + counts + [0x9700] # Version and error code
+    raw_data = struct.pack(">13H", *values)
+    checksum = 0x42 + 0x4d + 0x00 + 0x1c + sum(raw_data)
+    return raw_data + struct.pack(">H", checksum & 0xffff)
+
+class SimulatedPMS5003(object):
+    def __init__(self, environment):
+        self.environment = environment
+    def read(self):
+        self.environment.wait("PMS5003")
+        if self.environment.random.random() < self.environment.pms5003_error_rate:
+            raise ChecksumMismatchError("PMS5003 Checksum Mismatch")
+        return PMS5003FrameData(simulated_pms5003_frame(self.environment.pm2_5()))
+    def reset(self):
+        self.environment.clock.sleep(0.5)
+
+class SimulatedGasData(object):
+    def __init__(self, reducing, oxidising, nh3):
+        self.reducing = reducing
+        self.oxidising = oxidising
+        self.nh3 = nh3
+
+class SimulatedGas(object): # Used in place of the enviroplus gas module
+    def __init__(self, environment):
+        self.environment = environment
+    def read_all(self):
+        self.environment.wait("Gas")
+        return SimulatedGasData(*self.environment.gas_resistances())
+
+class SimulatedLTR559(object):
+    def __init__(self, environment):
+        self.environment = environment
+    def get_lux(self):
+        self.environment.wait("LTR559")
+        return self.environment.lux()
+    def get_proximity(self):
+        self.environment.wait("LTR559")
+        return self.environment.proximity()
+
+class SimulatedSGP30(object):
+    def __init__(self, environment):
+        self.environment = environment
+        self.baseline = [37000, 37500]
+    def start_measurement(self, run_while_waiting=None):
+        for second in range(int(self.environment.latencies["SGP30 Warmup"])):
+            self.environment.clock.sleep(1)
+            if run_while_waiting is not None:
+                run_while_waiting()
+    def command(self, command_name, parameters=None):
+        self.environment.wait("SGP30")
+        if command_name == 'measure_air_quality':
+            return list(self.environment.eco2_tvoc())
+        elif command_name == 'get_baseline':
+            return list(self.baseline)
+        elif command_name == 'set_baseline':
+            self.baseline = [parameters[1], parameters[0]] # set_baseline is in the order of TVOC, CO2
+        return []
+
+class SimulatedST7735(object):
+    def __init__(self, environment, width=160, height=80):
+        self.environment = environment
+        self.width = width
+        self.height = height
+        self.image = None # Last image displayed
+    def begin(self):
+        pass
+    def display(self, image):
+        self.environment.wait("Display")
+        self.image = image
+
+class SimulatedInputStream(object): # Delivers audio blocks to the noise callback from the event loop, in the same
+    # way that sounddevice delivers them from its audio thread
+    def __init__(self, environment, samplerate, channels, blocksize, callback, device=None):
+        self.environment = environment
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.handle = None
+    def deliver_block(self):
+        self.callback(self.environment.audio_block(self.blocksize), self.blocksize, None, None)
+        self.handle = self.loop.call_later(self.blocksize / self.samplerate, self.deliver_block)
+    def __enter__(self):
+        self.loop = asyncio.get_event_loop()
+        self.handle = self.loop.call_later(self.blocksize / self.samplerate, self.deliver_block)
+        return self
+    def __exit__(self, *args):
+        self.abort()
+    def abort(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Storage Writer
+# Stages the monitor's SD card writes in a tmpfs directory and flushes them together, so that the card sees one
+# coalesced write per file per flush interval instead of a write from each log on its own timer. Replaced files are
+# written to a temporary file, fsynced and renamed over the original so that a power loss can't leave them half
+# written. Appends are written in one block and fsynced. Staged writes survive a monitor restart or process handover
+# and are flushed by the next monitor when it starts, but a power loss loses up to one flush interval of them. Files
+# that must survive a power loss, such as the persistent data log, bypass the staging. A flush interval of 0 (the
+# default) writes everything straight through
+
+import os
+import threading
+from urllib.parse import quote, unquote
+
+class StorageWriter(object):
+    def __init__(self, clock, staging_directory='/dev/shm/aqimonitor', flush_interval=0):
+        self.clock = clock
+        self.staging_directory = staging_directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock() # Flushes are run in an executor thread
+        self.start_time = clock.monotonic()
+        self.bytes_written = 0
+        self.fsyncs = 0
+        self.flushes = 0
+        if flush_interval > 0:
+            try:
+                os.makedirs(staging_directory, exist_ok=True)
+            except OSError as error:
+                print('Storage Staging Directory Unavailable. Writing Straight Through.', error)
+                self.flush_interval = 0
+
+    def staging_file(self, path, kind): # The staging file name encodes the path of the file that it's staged for
+        return os.path.join(self.staging_directory, quote(os.path.abspath(path), safe='') + kind)
+
+    def replace(self, path, text): # Stages a complete rewrite of a file. Supersedes any earlier staged writes to it
+        data = text.encode()
+        with self.lock:
+            if self.flush_interval == 0:
+                self.write_atomically(path, data)
+                return
+            staging_file = self.staging_file(path, '.replace')
+            with open(staging_file + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(staging_file + '.tmp', staging_file)
+            if os.path.exists(self.staging_file(path, '.append')):
+                os.remove(self.staging_file(path, '.append'))
+
+    def replace_durably(self, path, text): # Rewrites a file straight away, bypassing the staging. Drops any staged
+        # writes to it, so that a later flush can't overwrite it with older data
+        data = text.encode()
+        with self.lock:
+            if self.flush_interval > 0:
+                for kind in ('.replace', '.append'):
+                    if os.path.exists(self.staging_file(path, kind)):
+                        os.remove(self.staging_file(path, kind))
+            self.write_atomically(path, data)
+
+    def append(self, path, text): # Stages an append to a file
+        data = text.encode()
+        with self.lock:
+            if self.flush_interval == 0:
+                self.append_durably(path, data)
+                return
+            with open(self.staging_file(path, '.append'), 'ab') as f:
+                f.write(data)
+
+    def write_atomically(self, path, data):
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY) # Makes the rename durable
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.bytes_written += len(data)
+        self.fsyncs += 2
+
+    def append_durably(self, path, data):
+        with open(path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.bytes_written += len(data)
+        self.fsyncs += 1
+
+    def staged_files(self):
+        if self.flush_interval == 0:
+            return []
+        return [name for name in os.listdir(self.staging_directory) if name.endswith('.replace') or
+                name.endswith('.append')]
+
+    def flush(self): # Writes all the staged files to storage. Blocks on the fsyncs, so it's run in an executor thread
+        with self.lock:
+            names = self.staged_files()
+            # A staged replacement is written before any appends that were staged after it
+            for name in sorted(names, key=lambda name: name.endswith('.append')):
+                staging_file = os.path.join(self.staging_directory, name)
+                if name.endswith('.replace'):
+                    path = unquote(name[:-len('.replace')])
+                else:
+                    path = unquote(name[:-len('.append')])
+                try:
+                    with open(staging_file, 'rb') as f:
+                        data = f.read()
+                    if name.endswith('.replace'):
+                        self.write_atomically(path, data)
+                    else:
+                        self.append_durably(path, data)
+                    os.remove(staging_file)
+                except OSError as error: # Left staged and retried on the next flush
+                    print('Storage Flush Failed for', path, error)
+            if names != []:
+                self.flushes += 1
+            return len(names)
+
+    def summary(self):
+        hours = max(self.clock.monotonic() - self.start_time, 1) / 3600
+        with self.lock:
+            staged_bytes = sum([os.path.getsize(os.path.join(self.staging_directory, name))
+                                for name in self.staged_files()])
+        return {'Bytes Per Hour': round(self.bytes_written / hours), 'Fsyncs Per Hour': round(self.fsyncs / hours, 1),
+                'Flushes': self.flushes, 'Staged Bytes': staged_bytes}
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor systemd Integration
+# Sends READY, STATUS, WATCHDOG and MAINPID notifications to systemd using the sd_notify datagram protocol, and keeps
+# a heartbeat for each monitored subsystem so that the watchdog is only kicked while all of them are alive. Does
+# nothing when the monitor wasn't started by systemd
+
+import os
+import socket
+
+class SystemdNotifier(object):
+    def __init__(self):
+        address = os.environ.get('NOTIFY_SOCKET')
+        if address and address.startswith('@'): # Abstract namespace socket
+            address = '\0' + address[1:]
+        self.address = address
+        self.socket = None
+        if address:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try: # The watchdog interval that's set by the service's WatchdogSec. WATCHDOG_PID isn't checked because a
+            # process that's taken over by a handover has sent systemd its MAINPID
+            self.watchdog_interval = int(os.environ.get('WATCHDOG_USEC', '0')) / 1000000
+        except ValueError:
+            self.watchdog_interval = 0
+
+    def enabled(self):
+        return self.socket is not None
+
+    def watchdog_enabled(self):
+        return self.socket is not None and self.watchdog_interval > 0
+
+    def notify(self, *states): # Each state is a string such as "READY=1" or "STATUS=..."
+        if self.socket is None:
+            return False
+        try:
+            self.socket.sendto('\n'.join(states).encode(), self.address)
+            return True
+        except OSError:
+            return False
+
+class Heartbeats(object): # The time of the latest heartbeat of each subsystem. beat can be called from any thread
+    def __init__(self, clock):
+        self.clock = clock
+        self.timeouts = {}
+        self.latest = {}
+
+    def register(self, name, timeout): # The subsystem has stalled if it hasn't had a heartbeat for timeout seconds
+        self.timeouts[name] = timeout
+        self.latest[name] = self.clock.monotonic()
+
+    def beat(self, name):
+        if name in self.timeouts:
+            self.latest[name] = self.clock.monotonic()
+
+    def stalled(self): # Names of the subsystems that have stalled
+        now = self.clock.monotonic()
+        return [name for name in self.timeouts if now - self.latest[name] > self.timeouts[name]]
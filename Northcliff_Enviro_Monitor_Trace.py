@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+#Northcliff Environment Monitor Sensor Trace
+# Records every raw sensor reading with a monotonic timestamp into a compact binary trace, and replays a trace in
+# place of the sensors so that field incidents can be reproduced and versions compared on identical input.
+# Trace format: a header of b'NEMT', a version byte and the wall clock start time (little-endian double), followed by
+# records of a type byte, the seconds since the start of the trace (double) and the payload length (uint32), then
+# the payload
+
+import struct
+import threading
+import atexit
+import collections
+import asyncio
+import numpy as np
+from Northcliff_Enviro_Monitor_Simulation import PMS5003FrameData
+from Northcliff_Enviro_Monitor_Climate import ClimateSample
+
+trace_magic = b'NEMT'
+trace_version = 1
+header_format = struct.Struct('<4sBd')
+record_format = struct.Struct('<BdI')
+
+# Record types and their payload formats
+BME280_TEMPERATURE = 1 # <f
+BME280_HUMIDITY = 2 # <f
+BME280_PRESSURE = 3 # <f
+PMS5003_FRAME = 4 # The 28 byte data part of the frame, including its checksum
+PMS5003_ERROR = 5 # <B index into the errors tuple that was given to the recorder
+GAS = 6 # <3f reducing, oxidising and nh3 Rs
+LTR559_LUX = 7 # <f
+LTR559_PROXIMITY = 8 # <H
+SGP30_AIR_QUALITY = 9 # <2H eCO2 and TVOC
+SGP30_BASELINE = 10 # <2H eCO2 and TVOC baselines
+AUDIO = 11 # float16 samples
+SGP30_WARMED_UP = 12 # No payload. Marks the end of the SGP30's start_measurement warm up
+
+class TraceExhausted(EOFError): # Raised when a replayed trace has no more readings for a sensor
+    pass
+
+def read_trace_start_time(trace_file):
+    with open(trace_file, 'rb') as f:
+        magic, version, start_time = header_format.unpack(f.read(header_format.size))
+    if magic != trace_magic or version != trace_version:
+        raise ValueError('Unsupported Sensor Trace File ' + trace_file)
+    return start_time
+
+class TraceWriter(object):
+    def __init__(self, trace_file, clock, record_audio=False):
+        self.clock = clock
+        self.record_audio = record_audio
+        self.start_time = clock.monotonic()
+        self.lock = threading.Lock() # The PMS5003 is read from an executor thread and audio from the audio thread
+        self.file = open(trace_file, 'wb')
+        self.file.write(header_format.pack(trace_magic, trace_version, clock.time()))
+        self.records = 0
+        self.bytes_written = header_format.size
+        atexit.register(self.close)
+
+    def record(self, record_type, payload):
+        timestamp = self.clock.monotonic() - self.start_time
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(record_format.pack(record_type, timestamp, len(payload)))
+                self.file.write(payload)
+                self.records += 1
+                self.bytes_written += record_format.size + len(payload)
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+class TraceReader(object):
+    def __init__(self, trace_file, clock):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.file = open(trace_file, 'rb')
+        magic, version, self.recorded_start_time = header_format.unpack(self.file.read(header_format.size))
+        if magic != trace_magic or version != trace_version:
+            raise ValueError('Unsupported Sensor Trace File ' + trace_file)
+        self.start_time = clock.monotonic()
+        self.queues = {} # Records that have been read ahead, by type. Only types with a replay device are kept
+
+    def want(self, *record_types):
+        for record_type in record_types:
+            self.queues[record_type] = collections.deque()
+
+    def next_record(self, *record_types): # Returns the next record of any of the given types
+        with self.lock:
+            while True:
+                earliest = None
+                for record_type in record_types:
+                    if self.queues[record_type] and (earliest is None or self.queues[record_type][0][1] <
+                                                     self.queues[earliest][0][1]):
+                        earliest = record_type
+                if earliest is not None:
+                    return self.queues[earliest].popleft()
+                header = self.file.read(record_format.size)
+                if len(header) < record_format.size:
+                    raise TraceExhausted('Sensor Trace Exhausted')
+                record_type, timestamp, length = record_format.unpack(header)
+                payload = self.file.read(length)
+                if len(payload) < length:
+                    raise TraceExhausted('Sensor Trace Exhausted')
+                if record_type in self.queues:
+                    self.queues[record_type].append((record_type, timestamp, payload))
+
+    def wait_until(self, timestamp): # Replays at the recorded pace on the monitor's clock
+        delay = self.start_time + timestamp - self.clock.monotonic()
+        if delay > 0:
+            self.clock.sleep(delay)
+
+    def replay(self, *record_types):
+        record = self.next_record(*record_types)
+        self.wait_until(record[1])
+        return record
+
+class RecordingBME280(object):
+    def __init__(self, bme280, trace_writer):
+        self.bme280 = bme280
+        self.trace_writer = trace_writer
+    def read_sample(self): # Recorded as one record of each reading, so that the trace format is unchanged
+        sample = self.bme280.read_sample()
+        self.trace_writer.record(BME280_TEMPERATURE, struct.pack('<f', sample.temperature))
+        self.trace_writer.record(BME280_HUMIDITY, struct.pack('<f', sample.humidity))
+        self.trace_writer.record(BME280_PRESSURE, struct.pack('<f', sample.pressure))
+        return sample
+
+class RecordingPMS5003(object):
+    def __init__(self, pms5003, trace_writer, errors):
+        self.pms5003 = pms5003
+        self.trace_writer = trace_writer
+        self.errors = errors # (ReadTimeoutError, ChecksumMismatchError)
+    def read(self):
+        try:
+            pm_values = self.pms5003.read()
+        except self.errors as error:
+            for index in range(len(self.errors)):
+                if isinstance(error, self.errors[index]):
+                    self.trace_writer.record(PMS5003_ERROR, struct.pack('<B', index))
+                    break
+            raise
+        self.trace_writer.record(PMS5003_FRAME, bytes(pm_values.raw_data))
+        return pm_values
+    def reset(self):
+        self.pms5003.reset()
+
+class RecordingGas(object):
+    def __init__(self, gas, trace_writer):
+        self.gas = gas
+        self.trace_writer = trace_writer
+    def read_all(self):
+        gas_data = self.gas.read_all()
+        self.trace_writer.record(GAS, struct.pack('<3f', gas_data.reducing, gas_data.oxidising, gas_data.nh3))
+        return gas_data
+
+class RecordingLTR559(object):
+    def __init__(self, ltr559, trace_writer):
+        self.ltr559 = ltr559
+        self.trace_writer = trace_writer
+    def get_lux(self):
+        lux = self.ltr559.get_lux()
+        self.trace_writer.record(LTR559_LUX, struct.pack('<f', lux))
+        return lux
+    def get_proximity(self):
+        proximity = self.ltr559.get_proximity()
+        self.trace_writer.record(LTR559_PROXIMITY, struct.pack('<H', min(65535, int(proximity))))
+        return proximity
+
+class RecordingSGP30(object):
+    def __init__(self, sgp30, trace_writer):
+        self.sgp30 = sgp30
+        self.trace_writer = trace_writer
+    def start_measurement(self, run_while_waiting=None):
+        self.sgp30.start_measurement(run_while_waiting)
+        self.trace_writer.record(SGP30_WARMED_UP, b'')
+    def command(self, command_name, parameters=None):
+        result = self.sgp30.command(command_name, parameters)
+        if command_name == 'measure_air_quality':
+            self.trace_writer.record(SGP30_AIR_QUALITY, struct.pack('<2H', *result))
+        elif command_name == 'get_baseline':
+            self.trace_writer.record(SGP30_BASELINE, struct.pack('<2H', *result))
+        return result
+
+def recording_audio_callback(trace_writer, callback): # Wraps the noise stream callback to record each audio block
+    def record_audio_block(indata, frames, time, status):
+        trace_writer.record(AUDIO, indata[:, 0].astype(np.float16).tobytes())
+        callback(indata, frames, time, status)
+    return record_audio_block
+
+class ReplayBME280(object):
+    def __init__(self, trace_reader):
+        self.trace_reader = trace_reader
+        trace_reader.want(BME280_TEMPERATURE, BME280_HUMIDITY, BME280_PRESSURE)
+    def read_sample(self):
+        temperature = struct.unpack('<f', self.trace_reader.replay(BME280_TEMPERATURE)[2])[0]
+        humidity = struct.unpack('<f', self.trace_reader.replay(BME280_HUMIDITY)[2])[0]
+        pressure = struct.unpack('<f', self.trace_reader.replay(BME280_PRESSURE)[2])[0]
+        return ClimateSample(temperature, humidity, pressure, self.trace_reader.clock.time())
+
+class ReplayPMS5003(object): # Replays frames and read errors in their recorded order
+    def __init__(self, trace_reader, errors):
+        self.trace_reader = trace_reader
+        self.errors = errors
+        trace_reader.want(PMS5003_FRAME, PMS5003_ERROR)
+    def read(self):
+        record_type, timestamp, payload = self.trace_reader.replay(PMS5003_FRAME, PMS5003_ERROR)
+        if record_type == PMS5003_ERROR:
+            raise self.errors[struct.unpack('<B', payload)[0]]("Replayed PMS5003 Error")
+        return PMS5003FrameData(payload)
+    def reset(self):
+        pass
+
+class ReplayGasData(object):
+    def __init__(self, reducing, oxidising, nh3):
+        self.reducing = reducing
+        self.oxidising = oxidising
+        self.nh3 = nh3
+
+class ReplayGas(object):
+    def __init__(self, trace_reader):
+        self.trace_reader = trace_reader
+        trace_reader.want(GAS)
+    def read_all(self):
+        return ReplayGasData(*struct.unpack('<3f', self.trace_reader.replay(GAS)[2]))
+
+class ReplayLTR559(object):
+    def __init__(self, trace_reader):
+        self.trace_reader = trace_reader
+        trace_reader.want(LTR559_LUX, LTR559_PROXIMITY)
+    def get_lux(self):
+        return struct.unpack('<f', self.trace_reader.replay(LTR559_LUX)[2])[0]
+    def get_proximity(self):
+        return struct.unpack('<H', self.trace_reader.replay(LTR559_PROXIMITY)[2])[0]
+
+class ReplaySGP30(object):
+    def __init__(self, trace_reader):
+        self.trace_reader = trace_reader
+        trace_reader.want(SGP30_AIR_QUALITY, SGP30_BASELINE, SGP30_WARMED_UP)
+    def start_measurement(self, run_while_waiting=None): # Takes as long as the recorded warm up
+        self.trace_reader.replay(SGP30_WARMED_UP)
+    def command(self, command_name, parameters=None):
+        if command_name == 'measure_air_quality':
+            return list(struct.unpack('<2H', self.trace_reader.replay(SGP30_AIR_QUALITY)[2]))
+        elif command_name == 'get_baseline':
+            return list(struct.unpack('<2H', self.trace_reader.replay(SGP30_BASELINE)[2]))
+        return []
+
+class ReplayInputStream(object): # Delivers recorded audio blocks to the noise callback from the event loop at their
+    # recorded times
+    def __init__(self, trace_reader, callback):
+        self.trace_reader = trace_reader
+        self.callback = callback
+        self.handle = None
+        trace_reader.want(AUDIO)
+    def schedule_next_block(self):
+        try:
+            record_type, timestamp, payload = self.trace_reader.next_record(AUDIO)
+        except TraceExhausted:
+            self.handle = None
+            return
+        block = np.frombuffer(payload, dtype=np.float16).astype(np.float32).reshape(-1, 1)
+        self.handle = self.loop.call_at(self.trace_reader.start_time + timestamp, self.deliver_block, block)
+    def deliver_block(self, block):
+        self.callback(block, len(block), None, None)
+        self.schedule_next_block()
+    def __enter__(self):
+        self.loop = asyncio.get_event_loop()
+        self.schedule_next_block()
+        return self
+    def __exit__(self, *args):
+        self.abort()
+    def abort(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None